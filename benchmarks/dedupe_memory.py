@@ -0,0 +1,101 @@
+"""Compare the memory used to dedupe Record rows before and after the
+compact dedupe index.
+
+    python benchmarks/dedupe_memory.py --records 5000000
+
+Rows are generated on the fly and dropped by the no-op flush, just like
+they are once a batch is written to the database, so the peak traced
+memory is what each strategy holds on to while an export is read.
+"""
+import argparse
+import datetime
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from healthkit_grafana import hkg_records  # noqa: E402
+
+BATCH_SIZE = 50000
+START = datetime.datetime(2015, 1, 1)
+
+
+def generate_rows(count):
+    """Yield quantity rows with one duplicate every 100 records."""
+    for i in range(count):
+        n = i - 1 if i % 100 == 99 else i
+        date = (START + datetime.timedelta(minutes=n)).strftime(
+            '%Y-%m-%d %H:%M:%S -0500')
+        yield (1, 'HeartRate', "Jane's Apple Watch", '8.0',
+               '<<HKDevice: 0x283f1c5a0>, name:Apple Watch, '
+               'manufacturer:Apple Inc., model:Watch, hardware:Watch6,1, '
+               'software:8.0>', date, date, date, 'count/min', str(n % 180))
+
+
+def discard(rows):
+    return True
+
+
+def legacy_dedupe(rows):
+    """The string keyed dict of row lists the sinks used to keep."""
+    duplicates = {}
+    batch = []
+
+    for row in rows:
+        key = str(row[0]) + row[1] + row[2] + row[6] + row[7]
+
+        if key not in duplicates:
+            duplicates[key] = []
+
+        duplicates[key].append(row)
+
+        if len(duplicates[key]) > 1:
+            continue
+
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            discard(batch)
+            batch = []
+
+
+def compact_dedupe(rows):
+    sink = hkg_records.RecordSink('hk_quantity_record', discard, BATCH_SIZE)
+
+    for row in rows:
+        sink.add(row)
+
+    sink.flush()
+
+
+def measure(dedupe, count):
+    tracemalloc.start()
+    start = datetime.datetime.now()
+    dedupe(generate_rows(count))
+    elapsed = datetime.datetime.now() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=5000000)
+    parser.add_argument('--strategy', choices=('legacy', 'compact', 'both'),
+                        default='both')
+    args = parser.parse_args()
+
+    strategies = [('legacy', legacy_dedupe), ('compact', compact_dedupe)]
+    for name, dedupe in strategies:
+        if args.strategy not in (name, 'both'):
+            continue
+
+        peak, elapsed = measure(dedupe, args.records)
+        print("%-8s %s records: peak %.1f MB, %.0f bytes/record, took %s"
+              % (name, args.records, peak / 1024 / 1024,
+                 peak / args.records, elapsed))
+
+
+if __name__ == '__main__':
+    main()
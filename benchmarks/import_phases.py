@@ -0,0 +1,307 @@
+"""Time every phase of an import of a synthetic export.
+
+    python benchmarks/import_phases.py --records 200000 --clean \
+        --output report.json --baseline last_report.json
+
+Writes an export with synthetic_export.py (or reads ``--export``), then
+runs the importer's own functions one phase at a time against the
+database the HKG_DB_* variables point to:
+
+    parse_export_xml        streaming the Record elements out of export.xml
+    quantity_record         extracting quantity rows from their elements
+    category_record         extracting category rows from their elements
+    extract_children        extracting MetadataEntry and heart beat rows
+    HKGDatabase.insert_*    every batch written to a table
+    import_*                workouts, activity summaries and clinical
+                            records, including the rows they build
+
+Each phase reports its rows, seconds, rows per second and the peak RSS
+of the process once it finished. The phases run one after another in
+this process, with HKG_WORKERS=1 and HKG_WRITERS=0, so every second is
+charged to exactly one phase; the other HKG_* settings are honoured.
+``--output`` saves the report as JSON and ``--baseline`` compares the
+rows per second against an earlier report. Use a scratch database:
+``--clean`` deletes all imported data except hk_person first.
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import synthetic_export  # noqa: E402
+
+# sql/delete_all_data.sql without the people the records belong to
+CLEAN_SQL = """
+    TRUNCATE public.hk_workout, public.hk_quantity_sample,
+        public.hk_category_sample, public.hk_quantity_hour, public.hk_source,
+        public.hk_device, public.hk_clinical_record, public.hk_activity_summary
+        CASCADE;
+"""
+# Methods that write a table, not the helpers they share
+INSERT_METHODS = ('insert_quantity_records', 'insert_category_records',
+                  'insert_record_metadata', 'insert_heart_beats',
+                  'insert_workouts', 'insert_workout_metadata',
+                  'insert_workout_events', 'insert_workout_routes',
+                  'replace_route_points', 'insert_activity_summaries',
+                  'insert_clinical_records', 'insert_clinical_observations')
+REGRESSION_THRESHOLD = 0.9
+# Phases that take a few milliseconds are too noisy to compare
+MIN_COMPARE_SECONDS = 0.1
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+class PhaseTimer(object):
+    """Adds up the rows and seconds of every phase in the order first run."""
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, name, rows, seconds):
+        phase = self.phases.setdefault(name, {'name': name, 'calls': 0,
+                                              'rows': 0, 'seconds': 0.0})
+        phase['calls'] += 1
+        phase['rows'] += rows
+        phase['seconds'] += seconds
+        phase['peak_rss_mb'] = round(peak_rss_mb(), 1)
+
+    def wrap(self, name, function):
+        """Return ``function`` timed as ``name``, with the length of its
+        last argument as the rows of a call."""
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.add(name, len(args[-1]),
+                     time.perf_counter() - start)
+            return result
+
+        return timed
+
+    def report(self):
+        phases = []
+        for phase in self.phases.values():
+            phase = dict(phase, seconds=round(phase['seconds'], 4))
+            phase['rows_per_second'] = round(
+                phase['rows'] / phase['seconds']) if phase['seconds'] else None
+            phases.append(phase)
+
+        return phases
+
+
+def configure_importer(export_path):
+    """Point the importer at the export before it reads its settings."""
+    os.environ['HKG_EXPORT_FILE_PATH'] = export_path
+    os.environ['HKG_WORKERS'] = '1'
+    os.environ['HKG_WRITERS'] = '0'
+    os.environ['HKG_TABLE_LOADERS'] = '1'
+    os.environ['HKG_SKIP_UNCHANGED'] = 'false'
+    os.environ['HKG_INCREMENTAL'] = 'false'
+    os.environ['HKG_ROLLUPS'] = 'false'
+    os.environ.pop('HKG_PARSE_CACHE', None)
+
+    from healthkit_grafana import health_kit_grafana
+    return health_kit_grafana
+
+
+def time_parse(importer, timer):
+    elements = {tag: [] for tag in importer.EXPORT_TAGS if tag != 'Record'}
+    record_count = 0
+
+    start = time.perf_counter()
+    for _ in importer.parse_export_xml(elements):
+        record_count += 1
+    timer.add('parse_export_xml', record_count, time.perf_counter() - start)
+
+    return elements
+
+
+def time_extract(importer, timer):
+    """Extract and dedupe the rows of every Record like the router does."""
+    from healthkit_grafana import hkg_records
+
+    rows = {}
+    sinks = {kind: hkg_records.RecordSink(
+                 table, rows.setdefault(kind, []).extend, sys.maxsize,
+                 key=hkg_records.ROW_KEYS[kind])
+             for kind, (table, _) in importer.RECORD_SINKS.items()}
+    router = hkg_records.RecordRouter(importer.DEFAULT_PERSON_ID, {})
+    routes = {}
+    seconds = dict.fromkeys(hkg_records.EXTRACTORS, 0.0)
+    counts = dict.fromkeys(hkg_records.EXTRACTORS, 0)
+    child_seconds = 0.0
+    child_count = 0
+
+    for record in importer.parse_export_xml({tag: [] for tag in
+                                             importer.EXPORT_TAGS}):
+        record_type = record.get('type', '')
+        route = routes.get(record_type)
+        if route is None:
+            route = routes[record_type] = \
+                hkg_records.classify_record_type(record_type)
+
+        kind, hk_type = route
+        if kind not in counts:
+            continue
+
+        start = time.perf_counter()
+        row = hkg_records.EXTRACTORS[kind](importer.DEFAULT_PERSON_ID,
+                                           hk_type, record)
+        seconds[kind] += time.perf_counter() - start
+        counts[kind] += 1
+        sinks[kind].add(row)
+
+        if len(record):
+            start = time.perf_counter()
+            children = router.extract_children(row, record)
+            child_seconds += time.perf_counter() - start
+            for child_kind, child_rows in children:
+                child_count += len(child_rows)
+                for child_row in child_rows:
+                    sinks[child_kind].add(child_row)
+
+    for sink in sinks.values():
+        sink.flush()
+    for kind in counts:
+        timer.add(hkg_records.EXTRACTORS[kind].__name__, counts[kind],
+                  seconds[kind])
+    timer.add('extract_children', child_count, child_seconds)
+
+    return rows
+
+
+def time_inserts(importer, timer, rows, elements, clean):
+    from healthkit_grafana import hkg_database
+    from healthkit_grafana import hkg_migrations
+
+    importer.connect_to_db()
+    database = importer.DATABASE
+    if not hkg_migrations.migrate(database):
+        sys.exit("Couldn't migrate the database schema.")
+
+    if clean and not database.execute(CLEAN_SQL):
+        sys.exit("Couldn't delete the data in the database.")
+
+    for name in INSERT_METHODS:
+        setattr(hkg_database.HKGDatabase, name,
+                timer.wrap('HKGDatabase.' + name,
+                           getattr(hkg_database.HKGDatabase, name)))
+
+    for kind, (_, method) in importer.RECORD_SINKS.items():
+        for batch in hkg_database.iter_chunks(rows[kind],
+                                              importer.RECORD_BATCH_SIZE):
+            getattr(database, method)(batch)
+
+    timer.wrap('import_workouts', importer.import_workouts)(
+        database, elements['Workout'])
+    timer.wrap('import_activity_summaries',
+               importer.import_activity_summaries)(
+        database, elements['ActivitySummary'])
+    timer.wrap('import_clinical_records', importer.import_clinical_records)(
+        database, elements['ClinicalRecord'])
+
+    database.close()
+
+
+def compare(phases, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {phase['name']: phase
+                    for phase in json.load(baseline_file)['phases']}
+
+    regressions = 0
+    print("\nRows/sec against %s" % baseline_path)
+    for phase in phases:
+        before = baseline.get(phase['name'], {}).get('rows_per_second')
+        after = phase['rows_per_second']
+        if not before or not after:
+            continue
+
+        ratio = after / before
+        flag = ''
+        if phase['seconds'] < MIN_COMPARE_SECONDS:
+            flag = '  too short'
+        elif ratio < REGRESSION_THRESHOLD:
+            flag = '  slower'
+            regressions += 1
+        print("  %-45s %10s %10s %6.2fx%s"
+              % (phase['name'], before, after, ratio, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    synthetic_export.add_arguments(parser)
+    parser.add_argument('--export',
+                        help="Benchmark this unpacked export instead of a "
+                             "synthetic one")
+    parser.add_argument('--clean', action='store_true',
+                        help="Delete all imported data before inserting")
+    parser.add_argument('--output', help="Write the JSON report here")
+    parser.add_argument('--baseline',
+                        help="Compare against an earlier JSON report and "
+                             "exit with 1 if a phase got >10%% slower")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        export_path = args.export
+        if export_path is None:
+            export_path = synthetic_export.write_export(
+                directory, **synthetic_export.export_arguments(args))
+
+        importer = configure_importer(export_path)
+        if not importer.check_for_files():
+            sys.exit("%s isn't an export." % export_path)
+
+        timer = PhaseTimer()
+        elements = time_parse(importer, timer)
+        rows = time_extract(importer, timer)
+        time_inserts(importer, timer, rows, elements, args.clean)
+
+        report = {
+            'created': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'export': {
+                'path': args.export,
+                'export_xml_bytes': os.path.getsize(
+                    os.path.join(export_path, 'export.xml')),
+                'synthetic': None if args.export else
+                synthetic_export.export_arguments(args),
+            },
+            'settings': {name: os.environ[name] for name in sorted(os.environ)
+                         if name.startswith('HKG_') and
+                         not name.startswith('HKG_DB_') and
+                         name != 'HKG_EXPORT_FILE_PATH'},
+            'phases': timer.report(),
+        }
+
+    print("%-45s %9s %9s %10s %9s"
+          % ('phase', 'rows', 'seconds', 'rows/sec', 'RSS MB'))
+    for phase in report['phases']:
+        print("%-45s %9s %9.3f %10s %9.1f"
+              % (phase['name'], phase['rows'], phase['seconds'],
+                 phase['rows_per_second'], phase['peak_rss_mb']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline and compare(report['phases'], args.baseline):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Time the Grafana panel queries of the dashboards against the database.
+
+    python benchmarks/panel_queries.py --days 30 --repeat 5
+
+Connects with the same HKG_DB_* environment variables as the importer.
+Every panel that reads hk_quantity_record or hk_category_record is run
+with its Grafana macros expanded for a time range of ``--days`` days
+ending at the newest quantity record, so the numbers can be compared
+before and after a schema change on the same data. The best of
+``--repeat`` runs is reported per panel.
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import re
+
+import psycopg2
+
+DASHBOARD_DIRECTORY = os.path.join(os.path.dirname(__file__), '..', 'grafana',
+                                   'dashboard_definitions')
+RECORD_TABLES = re.compile(r'\bhk_(quantity|category)_record\b')
+TIME_FILTER = re.compile(r'\$__timeFilter\((\w+)\)')
+TIME_GROUP_ALIAS = re.compile(r"\$__timeGroupAlias\((\w+), '1([dh])'[^)]*\)")
+BUCKET_SECONDS = {'d': 86400, 'h': 3600}
+
+
+def panel_queries(path):
+    """Yield the title and SQL of every panel target of a dashboard."""
+    def walk(node, title):
+        if isinstance(node, dict):
+            title = node.get('title', title)
+            if 'rawSql' in node:
+                yield title, node['rawSql']
+            for value in node.values():
+                yield from walk(value, title)
+        elif isinstance(node, list):
+            for value in node:
+                yield from walk(value, title)
+
+    with open(path) as file:
+        yield from walk(json.load(file), None)
+
+
+def expand_macros(sql, time_from, time_to):
+    """Expand the Grafana macros the way its PostgreSQL datasource does."""
+    sql = TIME_FILTER.sub(
+        lambda match: "%s BETWEEN '%s' AND '%s'" % (
+            match.group(1), time_from.isoformat(), time_to.isoformat()),
+        sql)
+    sql = TIME_GROUP_ALIAS.sub(
+        lambda match: 'floor(extract(epoch from %s)/%s)*%s AS "time"' % (
+            match.group(1), BUCKET_SECONDS[match.group(2)],
+            BUCKET_SECONDS[match.group(2)]),
+        sql)
+    sql = sql.replace('${__from:date:seconds}',
+                      str(int(time_from.timestamp())))
+    sql = sql.replace('${__to:date:seconds}', str(int(time_to.timestamp())))
+
+    return sql
+
+
+def best_time(cursor, sql, repeat):
+    best = None
+    for _ in range(repeat):
+        start = datetime.datetime.now()
+        cursor.execute(sql)
+        cursor.fetchall()
+        elapsed = (datetime.datetime.now() - start).total_seconds()
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dashboard', action='append',
+                        help="Dashboard title, defaults to every dashboard")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Print the time of every panel")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(host=os.environ['HKG_DB_HOST'],
+                                  database=os.environ['HKG_DB_NAME'],
+                                  user=os.environ['HKG_DB_USERNAME'],
+                                  password=os.environ['HKG_DB_PASSWORD'])
+    cursor = connection.cursor()
+    cursor.execute("SELECT max(start_date) FROM hk_quantity_record;")
+    time_to = cursor.fetchone()[0]
+    if time_to is None:
+        parser.error("hk_quantity_record is empty, import an export first")
+    time_from = time_to - datetime.timedelta(days=args.days)
+
+    print("Time range %s to %s" % (time_from, time_to))
+    for path in sorted(glob.glob(os.path.join(DASHBOARD_DIRECTORY,
+                                              '*.json'))):
+        dashboard = os.path.splitext(os.path.basename(path))[0]
+        if args.dashboard and dashboard not in args.dashboard:
+            continue
+
+        total = 0
+        count = 0
+        for title, sql in panel_queries(path):
+            if not RECORD_TABLES.search(sql):
+                continue
+
+            elapsed = best_time(cursor,
+                                expand_macros(sql, time_from, time_to),
+                                args.repeat)
+            total += elapsed
+            count += 1
+            if args.verbose:
+                print("  %-40s %8.1f ms" % (title, elapsed * 1000))
+
+        print("%-30s %3s panels %8.1f ms" % (dashboard, count, total * 1000))
+
+    cursor.close()
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
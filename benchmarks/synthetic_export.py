@@ -0,0 +1,370 @@
+"""Write a synthetic Apple Health export for benchmarking the importer.
+
+    python benchmarks/synthetic_export.py /tmp/export --records 1000000
+
+The export has the layout of an unzipped export.zip: export.xml with Me,
+Record, Correlation, Workout, ActivitySummary and ClinicalRecord elements,
+the GPX files of the workout routes under workout-routes and the FHIR
+JSON of the clinical records under clinical-records. Record types, their
+metadata and the share of duplicates follow what a watch and a phone
+write, and records are spread over ``--years`` so every partition of the
+record tables gets rows. The same arguments always write the same files.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+
+EXPORT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S -0500'
+GPX_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+END_DATE = datetime.datetime(2022, 6, 1, 8, 0, 0)
+
+WATCH = ("Jane's Apple Watch", '8.0',
+         '&lt;&lt;HKDevice: 0x283f1c5a0&gt;, name:Apple Watch, '
+         'manufacturer:Apple Inc., model:Watch, hardware:Watch6,1, '
+         'software:8.0&gt;')
+PHONE = ("Jane's iPhone", '15.1',
+         '&lt;&lt;HKDevice: 0x281b6c3c0&gt;, name:iPhone, '
+         'manufacturer:Apple Inc., model:iPhone, hardware:iPhone13,2, '
+         'software:15.1&gt;')
+HEALTH = ('Health', '15.1', None)
+
+# (share of the records, type, source, unit, value, minutes, metadata)
+RECORD_TYPES = (
+    (0.40, 'HKQuantityTypeIdentifierHeartRate', WATCH, 'count/min',
+     lambda: random.randint(48, 160), 0,
+     '  <MetadataEntry key="HKMetadataKeyHeartRateMotionContext" '
+     'value="0"/>\n'),
+    (0.20, 'HKQuantityTypeIdentifierStepCount', PHONE, 'count',
+     lambda: random.randint(1, 120), 1, None),
+    (0.12, 'HKQuantityTypeIdentifierActiveEnergyBurned', WATCH, 'Cal',
+     lambda: round(random.uniform(0.05, 2.5), 3), 1, None),
+    (0.08, 'HKQuantityTypeIdentifierDistanceWalkingRunning', PHONE, 'mi',
+     lambda: round(random.uniform(0.001, 0.08), 5), 1, None),
+    (0.03, 'HKQuantityTypeIdentifierHeartRateVariabilitySDNN', WATCH, 'ms',
+     lambda: round(random.uniform(20, 90), 3), 1,
+     '  <HeartRateVariabilityMetadataList>\n'
+     '   <InstantaneousBeatsPerMinute bpm="71" time="8:02:03.45 AM"/>\n'
+     '   <InstantaneousBeatsPerMinute bpm="73" time="8:02:04.27 AM"/>\n'
+     '   <InstantaneousBeatsPerMinute bpm="72" time="8:02:05.10 AM"/>\n'
+     '  </HeartRateVariabilityMetadataList>\n'),
+    (0.10, 'HKCategoryTypeIdentifierSleepAnalysis', WATCH, None,
+     lambda: random.choice(('HKCategoryValueSleepAnalysisAsleep',
+                            'HKCategoryValueSleepAnalysisInBed')), 5, None),
+    (0.05, 'HKCategoryTypeIdentifierAppleStandHour', WATCH, None,
+     lambda: random.choice(('HKCategoryValueAppleStandHourStood',
+                            'HKCategoryValueAppleStandHourIdle')), 60, None),
+    (0.02, 'HKDataTypeSleepDurationGoal', HEALTH, 'hr', lambda: 8, 0, None),
+)
+# One record in DUPLICATE_INTERVAL is written twice, as devices do
+DUPLICATE_INTERVAL = 500
+CORRELATION_INTERVAL = 2000
+
+EXPORT_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE HealthData [
+<!ELEMENT HealthData (ExportDate,Me,(Record|Correlation|Workout|\
+ActivitySummary|ClinicalRecord)*)>
+<!ATTLIST HealthData
+  locale CDATA #REQUIRED
+>
+]>
+<HealthData locale="en_US">
+ <ExportDate value="%s"/>
+ <Me HKCharacteristicTypeIdentifierDateOfBirth="1980-01-02" \
+HKCharacteristicTypeIdentifierBiologicalSex="HKBiologicalSexFemale" \
+HKCharacteristicTypeIdentifierBloodType="HKBloodTypeNotSet" \
+HKCharacteristicTypeIdentifierFitzpatrickSkinType=\
+"HKFitzpatrickSkinTypeNotSet" \
+HKCharacteristicTypeIdentifierCardioFitnessMedicationsUse="None"/>
+"""
+
+WORKOUT = """ <Workout workoutActivityType="HKWorkoutActivityTypeRunning" \
+duration="%(minutes)s" durationUnit="min" totalDistance="%(distance)s" \
+totalDistanceUnit="km" totalEnergyBurned="%(energy)s" \
+totalEnergyBurnedUnit="kcal" sourceName="%(source)s" sourceVersion="8.0" \
+device="%(device)s" creationDate="%(end)s" startDate="%(start)s" \
+endDate="%(end)s">
+  <MetadataEntry key="HKIndoorWorkout" value="0"/>
+  <MetadataEntry key="HKTimeZone" value="America/Chicago"/>
+  <MetadataEntry key="HKWeatherTemperature" value="68 degF"/>
+  <WorkoutEvent type="HKWorkoutEventTypeSegment" date="%(start)s" \
+duration="%(minutes)s" durationUnit="min"/>
+  <WorkoutEvent type="HKWorkoutEventTypePause" date="%(pause)s"/>
+  <WorkoutEvent type="HKWorkoutEventTypeResume" date="%(resume)s"/>
+"""
+WORKOUT_ROUTE = """  <WorkoutRoute sourceName="%(source)s" \
+sourceVersion="8.0" creationDate="%(end)s" startDate="%(start)s" \
+endDate="%(end)s">
+   <MetadataEntry key="HKMetadataKeySyncVersion" value="2"/>
+   <FileReference path="/workout-routes/%(route)s"/>
+  </WorkoutRoute>
+"""
+GPX_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="Apple Health Export" \
+xmlns="http://www.topografix.com/GPX/1/1" \
+xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<metadata><time>%s</time></metadata>
+<trk><name>Route %s</name><trkseg>
+"""
+GPX_POINT = ('<trkpt lon="%.6f" lat="%.6f"><ele>%.2f</ele><time>%s</time>'
+             '<extensions><speed>%.2f</speed><course>%.1f</course>'
+             '<hAcc>%.1f</hAcc><vAcc>%.1f</vAcc></extensions></trkpt>\n')
+ACTIVITY_SUMMARY = """ <ActivitySummary dateComponents="%s" \
+activeEnergyBurned="%.3f" activeEnergyBurnedGoal="600" \
+activeEnergyBurnedUnit="Cal" appleMoveTime="0" appleMoveTimeGoal="0" \
+appleExerciseTime="%s" appleExerciseTimeGoal="30" appleStandHours="%s" \
+appleStandHoursGoal="12"/>
+"""
+CLINICAL_RECORD = """ <ClinicalRecord type="DiagnosticReport" \
+identifier="%s" sourceName="labcorp" sourceURL="https://fhir.labcorp.com" \
+fhirVersion="1.0.2" receivedDate="%s" \
+resourceFilePath="/clinical-records/%s"/>
+"""
+LAB_TESTS = (('LDL Cholesterol', 'mg/dL', 60, 160, 0, 99),
+             ('HDL Cholesterol', 'mg/dL', 35, 90, 39, 200),
+             ('Triglycerides', 'mg/dL', 50, 250, 0, 149),
+             ('Glucose', 'mg/dL', 70, 130, 65, 99),
+             ('Hemoglobin A1c', '%', 4.5, 7.5, 4.8, 5.6))
+
+
+def export_date(date):
+    return date.strftime(EXPORT_DATE_FORMAT)
+
+
+def source_attributes(source):
+    attributes = 'sourceName="%s" sourceVersion="%s"' % source[:2]
+    if source[2]:
+        attributes += ' device="%s"' % source[2]
+
+    return attributes
+
+
+def record_element(record_type, date, indent=' '):
+    share, hk_type, source, unit, value, minutes, metadata = record_type
+    end = date + datetime.timedelta(minutes=minutes)
+    element = '%s<Record type="%s" %s%s creationDate="%s" startDate="%s" ' \
+              'endDate="%s" value="%s"' % (
+                  indent, hk_type, source_attributes(source),
+                  ' unit="%s"' % unit if unit else '', export_date(end),
+                  export_date(date), export_date(end), value())
+
+    if metadata:
+        return element + '>\n' + metadata + indent + '</Record>\n'
+
+    return element + '/>\n'
+
+
+def write_records(export_file, records, start, years):
+    step = datetime.timedelta(days=365.25 * years) / max(records, 1)
+    weights = [record_type[0] for record_type in RECORD_TYPES]
+
+    for index, record_type in enumerate(
+            random.choices(RECORD_TYPES, weights, k=records)):
+        date = start + step * index
+        date -= datetime.timedelta(microseconds=date.microsecond)
+        element = record_element(record_type, date)
+        export_file.write(element)
+
+        if index % DUPLICATE_INTERVAL == DUPLICATE_INTERVAL - 1:
+            export_file.write(element)
+
+        if index % CORRELATION_INTERVAL == CORRELATION_INTERVAL - 1:
+            write_blood_pressure(export_file, date)
+
+
+def write_blood_pressure(export_file, date):
+    source = ('Omron', '1.0', None)
+    systolic = (0, 'HKQuantityTypeIdentifierBloodPressureSystolic', source,
+                'mmHg', lambda: random.randint(105, 140), 0, None)
+    diastolic = (0, 'HKQuantityTypeIdentifierBloodPressureDiastolic', source,
+                 'mmHg', lambda: random.randint(65, 90), 0, None)
+
+    export_file.write(' <Correlation type="HKCorrelationTypeIdentifierBlood'
+                      'Pressure" %s creationDate="%s" startDate="%s" '
+                      'endDate="%s">\n' % (source_attributes(source),
+                                           export_date(date),
+                                           export_date(date),
+                                           export_date(date)))
+    export_file.write(record_element(systolic, date, '  '))
+    export_file.write(record_element(diastolic, date, '  '))
+    export_file.write(' </Correlation>\n')
+
+
+def write_route(path, start, points):
+    latitude, longitude, heading = 41.88, -87.63, random.uniform(0, 6.28)
+
+    with open(path, 'w') as route_file:
+        route_file.write(GPX_HEADER % (start.strftime(GPX_DATE_FORMAT),
+                                       start.date()))
+        for second in range(points):
+            heading += random.gauss(0, 0.05)
+            latitude += 0.00002 * math.cos(heading)
+            longitude += 0.00002 * math.sin(heading)
+            route_file.write(GPX_POINT % (
+                longitude, latitude, 180 + second * 0.01,
+                (start + datetime.timedelta(seconds=second)).strftime(
+                    GPX_DATE_FORMAT),
+                random.uniform(2, 3.5), random.uniform(0, 360),
+                random.uniform(2, 8), random.uniform(1, 5)))
+        route_file.write('</trkseg></trk>\n</gpx>\n')
+
+
+def write_workouts(export_file, directory, workouts, route_points, start,
+                   years):
+    step = datetime.timedelta(days=365.25 * years) / max(workouts, 1)
+
+    for index in range(workouts):
+        workout_start = (start + step * index).replace(second=0,
+                                                       microsecond=0)
+        minutes = random.randint(20, 75)
+        end = workout_start + datetime.timedelta(minutes=minutes)
+        values = {
+            'minutes': minutes,
+            'distance': round(minutes / 6.0, 3),
+            'energy': minutes * 11,
+            'source': WATCH[0],
+            'device': WATCH[2],
+            'start': export_date(workout_start),
+            'end': export_date(end),
+            'pause': export_date(workout_start +
+                                 datetime.timedelta(minutes=10)),
+            'resume': export_date(workout_start +
+                                  datetime.timedelta(minutes=11)),
+            'route': 'route_%s_%s.gpx' % (workout_start.strftime('%Y-%m-%d'),
+                                          index),
+        }
+        export_file.write(WORKOUT % values)
+
+        if route_points:
+            export_file.write(WORKOUT_ROUTE % values)
+            write_route(os.path.join(directory, 'workout-routes',
+                                     values['route']),
+                        workout_start + datetime.timedelta(hours=5),
+                        route_points)
+
+        export_file.write(' </Workout>\n')
+
+
+def write_activity_summaries(export_file, summaries, start):
+    for index in range(summaries):
+        day = start.date() + datetime.timedelta(days=index)
+        export_file.write(ACTIVITY_SUMMARY % (
+            day.isoformat(), random.uniform(200, 900), random.randint(0, 90),
+            random.randint(4, 16)))
+
+
+def lab_report(identifier, date):
+    observations = []
+
+    for index, (name, unit, low, high, normal_low, normal_high) in \
+            enumerate(LAB_TESTS):
+        value = round(random.uniform(low, high), 1)
+        observations.append({
+            'resourceType': 'Observation',
+            'id': str(index),
+            'effectiveDateTime': date.strftime(GPX_DATE_FORMAT),
+            'code': {'coding': [{'display': name}], 'text': name},
+            'interpretation': {'coding': [{
+                'code': 'N' if normal_low <= value <= normal_high else 'H'}]},
+            'referenceRange': [{'low': {'value': normal_low},
+                                'high': {'value': normal_high}}],
+            'valueQuantity': {'unit': unit, 'value': value},
+        })
+    observations.append({'resourceType': 'Observation', 'id': 'comment',
+                         'valueString': 'Fasting'})
+
+    return {
+        'resourceType': 'DiagnosticReport',
+        'id': identifier,
+        'subject': {'reference': 'Patient/1'},
+        'effectiveDateTime': date.strftime(GPX_DATE_FORMAT),
+        'issued': (date + datetime.timedelta(days=2)).strftime(
+            GPX_DATE_FORMAT),
+        'category': {'coding': [{'code': 'LAB'}]},
+        'code': {'text': 'Lipid Panel'},
+        'contained': observations,
+    }
+
+
+def write_clinical_records(export_file, directory, clinical_records, start,
+                           years):
+    step = datetime.timedelta(days=365.25 * years) / max(clinical_records, 1)
+
+    for index in range(clinical_records):
+        date = start + step * index
+        identifier = 'report-%s' % index
+        file_name = 'DiagnosticReport-%s.json' % identifier
+        with open(os.path.join(directory, 'clinical-records', file_name),
+                  'w') as report_file:
+            json.dump(lab_report(identifier, date), report_file)
+
+        export_file.write(CLINICAL_RECORD % (identifier, export_date(date),
+                                             file_name))
+
+
+def write_export(directory, records, workouts=None, summaries=None,
+                 clinical_records=20, route_points=600, years=4, seed=1):
+    """Write a synthetic export into ``directory`` and return its path.
+
+    Workouts and activity summaries default to one per 1000 and 500
+    records, about what a watch wearer's export has.
+    """
+    random.seed(seed)
+    workouts = records // 1000 if workouts is None else workouts
+    summaries = records // 500 if summaries is None else summaries
+    start = END_DATE - datetime.timedelta(days=365.25 * years)
+
+    os.makedirs(os.path.join(directory, 'workout-routes'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'clinical-records'), exist_ok=True)
+
+    with open(os.path.join(directory, 'export.xml'), 'w') as export_file:
+        export_file.write(EXPORT_HEADER % export_date(END_DATE))
+        write_records(export_file, records, start, years)
+        write_workouts(export_file, directory, workouts, route_points, start,
+                       years)
+        write_activity_summaries(export_file, summaries, start)
+        write_clinical_records(export_file, directory, clinical_records,
+                               start, years)
+        export_file.write('</HealthData>\n')
+
+    return directory
+
+
+def add_arguments(parser):
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--workouts', type=int,
+                        help="Defaults to one per 1000 records")
+    parser.add_argument('--summaries', type=int,
+                        help="Activity summaries, one per 500 records by "
+                             "default")
+    parser.add_argument('--clinical-records', type=int, default=20)
+    parser.add_argument('--route-points', type=int, default=600,
+                        help="Track points per workout route, 0 for no "
+                             "routes")
+    parser.add_argument('--years', type=float, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def export_arguments(args):
+    return {'records': args.records, 'workouts': args.workouts,
+            'summaries': args.summaries,
+            'clinical_records': args.clinical_records,
+            'route_points': args.route_points, 'years': args.years,
+            'seed': args.seed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    start = datetime.datetime.now()
+    write_export(args.directory, **export_arguments(args))
+    print("Wrote %s in %s" % (args.directory, datetime.datetime.now() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,159 @@
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import json
+import multiprocessing
+import multiprocessing.connection
 import os
 import pathlib
+import re
+import signal
+import time
 from healthkit_grafana import hkg_logger
+from healthkit_grafana import hkg_cache
+from healthkit_grafana import hkg_checkpoint
 from healthkit_grafana import hkg_database
-from xml.dom import minidom
+from healthkit_grafana import hkg_export
+from healthkit_grafana import hkg_manifest
+from healthkit_grafana import hkg_metrics
+from healthkit_grafana import hkg_migrations
+from healthkit_grafana import hkg_pipeline
+from healthkit_grafana import hkg_records
+from healthkit_grafana import hkg_routes
+from healthkit_grafana import hkg_watch
+from xml.etree import ElementTree
 
 LOGGER: hkg_logger = hkg_logger.LOGGER
-DATABASE: hkg_database
+DATABASE: hkg_database.HKGDatabase = None
+WATERMARKS: hkg_records.HighWaterMarks = None
+MANIFEST: hkg_manifest.ImportManifest = None
+WRITER_POOL: hkg_pipeline.WriterPool = None
+DATE_RANGES: hkg_records.DateRanges = None
+EXPORT = None
+PARSE_CACHE_WRITER: hkg_cache.ParseCacheWriter = None
+CHECKPOINT: hkg_checkpoint.ImportCheckpoint = None
 
-EXPORT_DIR_PATH = os.environ.get(
-    'HKG_EXPORT_FILE_PATH',
-    '/opt/healthkit_grafana/apple_health_export')
-EXPORT_XML_PATH = EXPORT_DIR_PATH + "/export.xml"
+
+class HKGImportException(Exception):
+    pass
+
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def get_exports(setting):
+    """Return the (person name, path) of every export in ``setting``.
+
+    Exports are separated by commas and may start with ``name=``. The
+    name ends at the first ``=``, so a path can contain one but then needs
+    a name in front. A lone export without a name belongs to the default
+    person, several exports are named after their directory unless they
+    are given a name.
+    """
+    exports = []
+    for export in setting.split(','):
+        export = export.strip()
+        if not export:
+            continue
+
+        if '=' not in export:
+            exports.append((None, export))
+            continue
+
+        name, _, path = export.partition('=')
+        # A slash before the = is a path that contains one
+        if not name.strip() or '/' in name or not path.strip():
+            raise HKGImportException(
+                "%s in HKG_EXPORT_FILE_PATH needs a name and a path, like "
+                "name=/path/to/export." % export)
+        exports.append((name.strip(), path.strip()))
+
+    if len(exports) > 1:
+        exports = [(name or os.path.basename(os.path.normpath(
+            os.path.dirname(path) if path.endswith('.zip') else path)), path)
+                   for name, path in exports]
+
+    return exports or [(None, setting)]
+
+
+try:
+    EXPORTS = get_exports(os.environ.get(
+        'HKG_EXPORT_FILE_PATH',
+        '/opt/healthkit_grafana/apple_health_export'))
+except HKGImportException as setting_ex:
+    LOGGER.error(setting_ex)
+    exit(42)
+EXPORT_DIR_PATH = EXPORTS[0][1]
+EXPORT_XML_PATH = EXPORT_DIR_PATH + "/" + hkg_export.EXPORT_XML
+EXPORT_TAGS = ('Me', 'Record', 'Workout', 'ActivitySummary', 'ClinicalRecord')
+RECORD_BATCH_SIZE = int(os.environ.get('HKG_RECORD_BATCH_SIZE', 50000))
+WORKOUT_BATCH_SIZE = int(os.environ.get('HKG_WORKOUT_BATCH_SIZE', 1000))
+PAGE_SIZE = int(os.environ.get('HKG_PAGE_SIZE', 1000))
+COMMIT_INTERVAL = int(os.environ.get('HKG_COMMIT_INTERVAL', 10000))
+COPY_TABLES = [t.strip() for t in os.environ.get(
+    'HKG_COPY_TABLES',
+    'hk_quantity_record,hk_category_record,hk_record_metadata,hk_heart_beat'
+).split(',') if t.strip()]
+COPY_FORMAT = os.environ.get('HKG_COPY_FORMAT', hkg_database.COPY_BINARY)
+
+PERSON_IMPORTS = int(os.environ.get('HKG_PERSON_IMPORTS',
+                                    os.cpu_count() or 1))
+WATCH = env_flag('HKG_WATCH')
+WATCH_INTERVAL = float(os.environ.get('HKG_WATCH_INTERVAL', 30))
+WATCH_SETTLE = float(os.environ.get('HKG_WATCH_SETTLE', 60))
+WATCH_RETRY = float(os.environ.get('HKG_WATCH_RETRY', 900))
+INCREMENTAL = env_flag('HKG_INCREMENTAL', WATCH)
+WATERMARK_TABLES = ('hk_quantity_record', 'hk_category_record',
+                    'hk_record_metadata', 'hk_heart_beat', 'hk_workout',
+                    'hk_activity_summary')
+# (table, HKGDatabase insert method) the rows of every kind are written
+# with, see hkg_records.register_record_type to add a kind
+RECORD_SINKS = {
+    hkg_records.QUANTITY: ('hk_quantity_record', 'insert_quantity_records'),
+    hkg_records.CATEGORY: ('hk_category_record', 'insert_category_records'),
+    hkg_records.METADATA: ('hk_record_metadata', 'insert_record_metadata'),
+    hkg_records.HEART_BEAT: ('hk_heart_beat', 'insert_heart_beats'),
+}
+IMPORT_TABLES = WATERMARK_TABLES + ('hk_clinical_record', )
+SKIP_UNCHANGED = env_flag('HKG_SKIP_UNCHANGED', True)
+ROLLUPS = env_flag('HKG_ROLLUPS', True)
+WORKERS = int(os.environ.get('HKG_WORKERS', os.cpu_count() or 1))
+SHARDED_PARSE = env_flag('HKG_SHARDED_PARSE', True)
+SHARD_SIZE = int(os.environ.get('HKG_SHARD_SIZE', 32 * 1024 * 1024))
+TABLE_LOADERS = int(os.environ.get('HKG_TABLE_LOADERS', 3))
+WRITERS = int(os.environ.get('HKG_WRITERS', 2))
+WRITE_QUEUE_SIZE = int(os.environ.get('HKG_WRITE_QUEUE_SIZE', 4))
+PARSE_CACHE_PATH = os.environ.get('HKG_PARSE_CACHE') or None
+WORKOUT_ROUTES = env_flag('HKG_WORKOUT_ROUTES', True)
+ROUTE_TOLERANCE = float(os.environ.get('HKG_ROUTE_TOLERANCE', 0))
+CHECKPOINT_INTERVAL = int(os.environ.get('HKG_CHECKPOINT_INTERVAL', 500000))
+METRICS_REPORT_PATH = os.environ.get('HKG_METRICS_REPORT') or None
+METRICS_PROMETHEUS_PATH = os.environ.get('HKG_METRICS_PROMETHEUS') or None
+PROFILE_MODES = [m.strip() for m in os.environ.get(
+    'HKG_PROFILE', '').split(',') if m.strip()]
+PROFILE_PATH = os.environ.get('HKG_PROFILE_PATH', 'health_kit_grafana.prof')
 
 DEFAULT_PERSON_ID = 1
-QUANTITY_PREFIX = 'HKQuantityTypeIdentifier'
-CATEGORY_PREFIX = 'HKCategoryTypeIdentifier'
+# The person the export being imported belongs to, None until the id of a
+# named person is looked up
+PERSON_ID = DEFAULT_PERSON_ID
+PERSON_NAME = None
+# hk_person columns read from the <Me> element and the prefix of the values
+ME_CHARACTERISTICS = {
+    'dob': ('HKCharacteristicTypeIdentifierDateOfBirth', ''),
+    'biological_sex': ('HKCharacteristicTypeIdentifierBiologicalSex',
+                       'HKBiologicalSex'),
+    'blood_type': ('HKCharacteristicTypeIdentifierBloodType', 'HKBloodType'),
+    'fitzpatrick_skin_type': (
+        'HKCharacteristicTypeIdentifierFitzpatrickSkinType',
+        'HKFitzpatrickSkinType'),
+}
 WORKOUT_TYPE_PREFIX = "HKWorkoutActivityType"
 
 LAB_TYPE_DIAGNOSTIC_REPORT = 'DiagnosticReport'
@@ -32,24 +169,38 @@ HKCategoryValueHeadphoneAudioExposureEventSevenDayLimit = \
 
 
 def check_for_files() -> bool:
+    global EXPORT, EXPORT_XML_PATH
     result = True
 
-    if not os.path.isdir(EXPORT_DIR_PATH):
+    EXPORT = hkg_export.open_export(EXPORT_DIR_PATH)
+    if EXPORT is None:
         LOGGER.error("The EXPORT_DIR_PATH environment variable must point "
-                     "to a directory. Instead I have: %s" % EXPORT_DIR_PATH)
-        result = False
+                     "to a directory or an export.zip. Instead I have: %s"
+                     % EXPORT_DIR_PATH)
+        return False
 
-    if not os.path.isfile(EXPORT_XML_PATH):
+    EXPORT_XML_PATH = EXPORT.location(hkg_export.EXPORT_XML)
+    if not EXPORT.isfile(hkg_export.EXPORT_XML):
         LOGGER.error("The export.xml file is either missing or not a file. "
                      "Please ensure that the following exists and is a "
-                     "valid file: %s" % EXPORT_DIR_PATH)
+                     "valid file: %s" % EXPORT_XML_PATH)
         result = False
+    elif not EXPORT.unpacked:
+        LOGGER.info("Reading the export straight out of %s." % EXPORT.path)
 
     return result
 
 
 def connect_to_db():
     global DATABASE
+
+    if DATABASE is not None:
+        if DATABASE.is_connected():
+            return
+        LOGGER.warning("Lost the database connection, connecting again.")
+        DATABASE.close()
+        DATABASE = None
+
     LOGGER.info("Connecting to Database.")
 
     db_host, db_name, db_username, db_password = None, None, None, None
@@ -60,164 +211,236 @@ def connect_to_db():
         db_username = os.environ['HKG_DB_USERNAME']
         db_password = os.environ['HKG_DB_PASSWORD']
     except KeyError as ke:
-        print("Key not found %s", ke)
-        exit(42)
+        raise HKGImportException("Key not found %s" % ke)
 
     DATABASE = hkg_database.HKGDatabase(db_host, db_name, db_username,
-                                        db_password)
+                                        db_password, copy_tables=COPY_TABLES,
+                                        page_size=PAGE_SIZE,
+                                        commit_interval=COMMIT_INTERVAL,
+                                        copy_format=COPY_FORMAT)
     # noinspection PyBroadException
     try:
         DATABASE.connect_to_db()
     except Exception:
+        DATABASE = None
         LOGGER.error("Could not connect to database after 10 retries. "
                      "Make sure the database is running and your credentials "
                      "are correct.")
-        LOGGER.error("Export failed.")
-        exit(42)
+        raise HKGImportException("Export failed.")
+
 
+def start_writers():
+    global WRITER_POOL
+
+    if WRITERS < 1:
+        return
+
+    LOGGER.info("Starting %s database writers." % WRITERS)
+    # noinspection PyBroadException
+    try:
+        WRITER_POOL = hkg_pipeline.WriterPool(DATABASE, WRITERS,
+                                              WRITE_QUEUE_SIZE)
+    except Exception:
+        LOGGER.error("Could not open the writer connections.")
+        raise HKGImportException("Export failed.")
+
+
+def stop_writers(loaded_tables):
+    """Wait for the queued writes and drop the tables that failed."""
+    global WRITER_POOL
+
+    if WRITER_POOL is None:
+        return loaded_tables
 
-def parse_export_xml() -> []:
     start = datetime.datetime.now()
-    LOGGER.info("Parsing export file.")
+    failed_tables = WRITER_POOL.close()
+    WRITER_POOL = None
+    LOGGER.info("Waiting for the database writers took %s seconds."
+                % (datetime.datetime.now() - start))
+    hkg_metrics.phase_done('stop_writers', start)
 
-    xml_doc = minidom.parse(EXPORT_XML_PATH)
-    me = xml_doc.getElementsByTagName('Me')
-    if me:
-        LOGGER.info("Me element found.")
-    else:
-        LOGGER.warning("No <Me> element found.")
+    return [table for table in loaded_tables if table not in failed_tables]
 
-    records = xml_doc.getElementsByTagName('Record')
-    if records:
-        LOGGER.info("%s records found." % len(records))
-    else:
-        LOGGER.warning("No <Record> elements found.")
 
-    workouts = xml_doc.getElementsByTagName('Workout')
-    if workouts:
-        LOGGER.info("%s workouts found." % len(workouts))
-    else:
-        LOGGER.warning("No <Workout> elements found.")
+def get_writer(table, method):
+    """Return the callable that writes a batch of rows to a table.
 
-    activity_summaries = xml_doc.getElementsByTagName('ActivitySummary')
-    if activity_summaries:
-        LOGGER.info(
-            "%s activity_summaries found." % len(activity_summaries))
-    else:
-        LOGGER.warning("No <ActivitySummary> elements found.")
+    With writer threads running the batch is queued and written in the
+    background, otherwise it is written right away on DATABASE.
+    """
+    if WRITER_POOL is None:
+        return getattr(DATABASE, method)
 
-    clinical_records = xml_doc.getElementsByTagName('ClinicalRecord')
-    if records:
-        LOGGER.info("%s clinical_records found." % len(clinical_records))
-    else:
-        LOGGER.warning("No <ClinicalRecord> elements found.")
+    return WRITER_POOL.writer(table, method)
 
-    read_done = datetime.datetime.now()
-    LOGGER.info("Reading export.xml took %s seconds." % (read_done - start))
 
-    return me, records, workouts, activity_summaries, clinical_records
+def load_manifest():
+    global MANIFEST
 
+    if not SKIP_UNCHANGED:
+        return
 
-def get_quantity_records(xml_records):
-    result = []
-    duplicates = {}
-    dup_count = 0
-
-    for record in xml_records:
-        record_type = record.getAttribute('type')
-
-        if record_type.startswith(QUANTITY_PREFIX):
-            record_type = record_type.removeprefix(QUANTITY_PREFIX)
-            value = record.getAttribute('value')
-            if not value:
-                value = 0.0
-
-            key = str(DEFAULT_PERSON_ID) + record_type + \
-                record.getAttribute('sourceName') + \
-                record.getAttribute('startDate') + \
-                record.getAttribute('endDate')
-
-            quantity_record = (
-                DEFAULT_PERSON_ID,
-                record_type,
-                record.getAttribute('sourceName'),
-                record.getAttribute('sourceVersion'),
-                record.getAttribute('device'),
-                record.getAttribute('creationDate'),
-                record.getAttribute('startDate'),
-                record.getAttribute('endDate'),
-                record.getAttribute('unit'),
-                value
-            )
-            if key not in duplicates:
-                duplicates[key] = []
+    entries = DATABASE.get_manifest()
+    if entries is None:
+        LOGGER.warning("Couldn't load the manifest of imported files, "
+                       "importing everything.")
+        entries = {}
 
-            duplicates[key].append(quantity_record)
+    MANIFEST = hkg_manifest.ImportManifest(entries)
 
-            if len(duplicates[key]) == 1:
-                result.append(quantity_record)
-            else:
-                dup_count += 1
-                LOGGER.debug("Found duplicate records: %s" % duplicates[key])
 
-    LOGGER.info("Found %s quantity records and %s duplicates."
-                % (len(result), dup_count))
+def save_manifest():
+    if MANIFEST and MANIFEST.pending:
+        DATABASE.save_manifest(MANIFEST.rows())
 
-    return result
 
+def load_watermarks():
+    global WATERMARKS
 
-def get_category_records(xml_records):
-    result = []
-    duplicates = {}
-    dup_count = 0
-
-    for record in xml_records:
-        record_type = record.getAttribute('type')
-
-        if record_type.startswith("HKCategoryTypeIdentifier"):
-            value = record.getAttribute('value')
-            if not value:
-                value = "Not Set"
-
-            # This is ugly but...
-            # My data has records where type, source, start, and end
-            # dates are all the same and the create date is seconds off
-            # Since I can only depend on those 4 items being present
-            # those are the unique constraints on the db. The other option
-            # (and this may be valid) is to do nothing on conflict vs update
-            # the other fields.
-            key = str(DEFAULT_PERSON_ID) + record_type + \
-                record.getAttribute('sourceName') + \
-                record.getAttribute('startDate') + \
-                record.getAttribute('endDate')
-
-            category_record = (
-                DEFAULT_PERSON_ID,
-                record_type,
-                record.getAttribute('sourceName'),
-                record.getAttribute('sourceVersion'),
-                record.getAttribute('device'),
-                record.getAttribute('creationDate'),
-                record.getAttribute('startDate'),
-                record.getAttribute('endDate'),
-                record.getAttribute('unit'),
-                value
-            )
-            if key not in duplicates:
-                duplicates[key] = []
+    if not INCREMENTAL:
+        return
+
+    marks = DATABASE.get_watermarks()
+
+    if marks is None:
+        LOGGER.warning("Couldn't load the high-water marks of previous "
+                       "imports, importing everything.")
+        marks = {}
+
+    WATERMARKS = hkg_records.HighWaterMarks(marks)
+    LOGGER.info("Incremental import, %s high-water marks loaded."
+                % len(marks))
+
+
+def save_watermarks(loaded_tables):
+    if not WATERMARKS:
+        return
+
+    for table, count in WATERMARKS.skipped.items():
+        LOGGER.info("Skipped %s %s rows at or below their high-water mark."
+                    % (count, table))
+
+    failed_tables = set(WATERMARK_TABLES) - set(loaded_tables)
+    if failed_tables:
+        LOGGER.warning("Not advancing the high-water marks of %s since "
+                       "they didn't load cleanly." % sorted(failed_tables))
+
+    DATABASE.save_watermarks(WATERMARKS.advanced(loaded_tables))
+
+
+def load_checkpoint():
+    """Pick up the progress of an interrupted import of this export."""
+    global CHECKPOINT
+
+    if CHECKPOINT_INTERVAL < 1:
+        return
+
+    export_path = os.path.abspath(EXPORT_XML_PATH)
+    size, mtime, _ = get_export_fingerprint()
+    # The rows the sinks accept depend on the high-water marks as well
+    filters = 'incremental:%s' % WATERMARKS.digest(PERSON_ID) \
+        if WATERMARKS else 'full'
+    saved = DATABASE.get_checkpoint(PERSON_ID, export_path)
+    CHECKPOINT = hkg_checkpoint.ImportCheckpoint(
+        PERSON_ID, export_path, "%s:%r:%s" % (size, mtime, filters), saved)
+
+    if CHECKPOINT.resumed:
+        LOGGER.info("Resuming the interrupted import of %s, %s and the "
+                    "routes of %s workouts were already committed."
+                    % (EXPORT_XML_PATH, CHECKPOINT.table_rows,
+                       len(CHECKPOINT.routes)))
+    elif saved is not None:
+        LOGGER.info("%s or the high-water marks changed since its import "
+                    "was interrupted, importing it from the start."
+                    % EXPORT_XML_PATH)
+
+
+def save_record_checkpoint(sinks):
+    """Flush the sinks, wait for their writes and save how far they got.
+    """
+    if CHECKPOINT.failed:
+        return
+
+    for sink in sinks:
+        sink.flush()
+
+    failed_tables = WRITER_POOL.drain() if WRITER_POOL else set()
+    if failed_tables or any(sink.failed for sink in sinks):
+        # Rows behind a failed write must not be skipped by the next run
+        CHECKPOINT.failed = True
+        LOGGER.warning("A write failed, no more checkpoints are saved.")
+        return
 
-            duplicates[key].append(category_record)
+    CHECKPOINT.records_committed(
+        {sink.table: sink.row_count for sink in sinks})
+    if DATABASE.save_checkpoint(CHECKPOINT.row()):
+        LOGGER.info("Saved a checkpoint at %s."
+                    % {sink.table: sink.row_count for sink in sinks})
 
-            if len(duplicates[key]) == 1:
-                result.append(category_record)
+
+def clear_checkpoint():
+    """Forget the checkpoint once the import got to the end. Tables that
+    failed are imported again as a whole by the next run."""
+    if CHECKPOINT:
+        DATABASE.delete_checkpoint(CHECKPOINT.person_id,
+                                   CHECKPOINT.export_path)
+
+
+def parse_export_xml(elements):
+    """Yield the Record elements of export.xml one at a time.
+
+    Records make up nearly all of an export so they are streamed to the
+    caller instead of being loaded into a DOM. The comparatively few Me,
+    Workout, ActivitySummary and ClinicalRecord elements are appended to
+    the matching list in ``elements`` for the import steps that run after
+    the records.
+    """
+    start = datetime.datetime.now()
+    LOGGER.info("Parsing export file.")
+    record_count = 0
+
+    with EXPORT.open(hkg_export.EXPORT_XML) as export_file:
+        for tag, element in hkg_export.iter_export_elements(
+                export_file, EXPORT_TAGS):
+            if tag == 'Record':
+                record_count += 1
+                yield element
             else:
-                dup_count += 1
-                LOGGER.debug("Found duplicate records: %s" % duplicates[key])
+                elements[tag].append(element)
 
-    LOGGER.info("Found %s category records and %s duplicates." %
-                (len(result), dup_count))
+    log_export_elements(elements, record_count)
+    read_done = datetime.datetime.now()
+    LOGGER.info("Streaming export.xml took %s seconds." % (read_done - start))
+    hkg_metrics.phase_done('parse_export_xml', start)
 
-    return result
+
+def log_export_elements(elements, record_count):
+    if elements['Me']:
+        LOGGER.info("Me element found.")
+    else:
+        LOGGER.warning("No <Me> element found.")
+
+    if record_count:
+        LOGGER.info("%s records found." % record_count)
+    else:
+        LOGGER.warning("No <Record> elements found.")
+
+    if elements['Workout']:
+        LOGGER.info("%s workouts found." % len(elements['Workout']))
+    else:
+        LOGGER.warning("No <Workout> elements found.")
+
+    if elements['ActivitySummary']:
+        LOGGER.info(
+            "%s activity_summaries found." % len(elements['ActivitySummary']))
+    else:
+        LOGGER.warning("No <ActivitySummary> elements found.")
+
+    if elements['ClinicalRecord']:
+        LOGGER.info(
+            "%s clinical_records found." % len(elements['ClinicalRecord']))
+    else:
+        LOGGER.warning("No <ClinicalRecord> elements found.")
 
 
 def get_observations_from_report(report):
@@ -293,16 +516,37 @@ def get_record_and_observations(report, hk_type, source_name, resource_path):
         missing_quantity_count
 
 
+#  Runs in a worker process when clinical records are loaded in parallel, so
+#  it only takes and returns picklable tuples. The report itself is only
+#  handed back when it produced nothing, for the debug log.
+def load_clinical_report(report_file_info):
+    export, hk_type, source_name, resource_path = report_file_info
+
+    with export.open(resource_path) as report_file:
+        report = json.load(report_file)
+
+    record, observations, missing_quantity_count = \
+        get_record_and_observations(report, hk_type, source_name,
+                                    resource_path)
+
+    if record and observations:
+        report = None
+
+    return record, observations, missing_quantity_count, report
+
+
 def get_clinical_records_and_observations(clinical_records_xml):
+    reports = []
     records = []
     all_observations = []
     observations_missing_quantity = 0
+    unchanged_files = 0
 
     for cr in clinical_records_xml:
-        record_id = cr.getAttribute('identifier')
-        hk_type = cr.getAttribute('type')
-        source_name = cr.getAttribute('sourceName')
-        resource_path = cr.getAttribute('resourceFilePath')
+        record_id = cr.get('identifier', '')
+        hk_type = cr.get('type', '')
+        source_name = cr.get('sourceName', '')
+        resource_path = cr.get('resourceFilePath', '')
 
         if not all([record_id, hk_type, source_name, resource_path]):
             LOGGER.error("Required field missing, skipping record %s" % cr)
@@ -318,32 +562,48 @@ def get_clinical_records_and_observations(clinical_records_xml):
                         "LabCorp so currently I'm playing it "
                         "safe and skipping record: %s" % cr)
 
-        file_path = EXPORT_DIR_PATH + resource_path
-        if not os.path.isfile(file_path):
+        file_path = EXPORT.location(resource_path)
+        if not EXPORT.isfile(resource_path):
             LOGGER.error("Skipping clinical record: %s.\n"
                          "I couldn't find the file resource at the "
                          "indicated path %s. Please ensure this path "
                          "is correct." % (cr, file_path))
             continue
 
-        with open(file_path) as report_file:
-            report = json.load(report_file)
-            record, observations, missing_quantity_count = \
-                get_record_and_observations(
-                    report, hk_type, source_name, resource_path
-                )
+        if MANIFEST and not MANIFEST.changed(
+                file_path, EXPORT.fingerprint(resource_path)):
+            LOGGER.debug("Skipping unchanged clinical record %s" % file_path)
+            unchanged_files += 1
+            continue
+
+        reports.append((EXPORT, hk_type, source_name, resource_path))
 
-            if record and observations:
-                records.append(record)
-                all_observations.extend(observations)
-            else:
-                LOGGER.debug("Report or observations were null. "
-                             "Record: %s Observations: %s" %
-                             (report, observations))
+    if WORKERS > 1 and len(reports) > 1:
+        LOGGER.info("Loading %s clinical record files with %s workers."
+                    % (len(reports), WORKERS))
+        chunk_size = max(1, len(reports) // (WORKERS * 4))
+        with concurrent.futures.ProcessPoolExecutor(WORKERS) as executor:
+            results = list(executor.map(load_clinical_report, reports,
+                                        chunksize=chunk_size))
+    else:
+        results = [load_clinical_report(report) for report in reports]
+
+    for record, observations, missing_quantity_count, report in results:
+        if record and observations:
+            records.append((PERSON_ID, ) + record)
+            all_observations.extend(observations)
+        else:
+            LOGGER.debug("Report or observations were null. "
+                         "Record: %s Observations: %s" %
+                         (report, observations))
 
-            observations_missing_quantity += missing_quantity_count
+        observations_missing_quantity += missing_quantity_count
 
-    empty_reports = len(clinical_records_xml) - len(records)
+    if unchanged_files > 0:
+        LOGGER.info("Skipped %s clinical record files that haven't changed "
+                    "since they were imported." % unchanged_files)
+
+    empty_reports = len(clinical_records_xml) - len(records) - unchanged_files
     if empty_reports > 0:
         LOGGER.warning("%s Reports were empty. This is normal for "
                        "records where all values are strings. It could "
@@ -360,31 +620,265 @@ def get_clinical_records_and_observations(clinical_records_xml):
 
 
 def import_me(me_xml):
+    """Store the characteristics in <Me> with the person in hk_person."""
     LOGGER.debug(me_xml)
+    if not me_xml:
+        return
+
+    characteristics = {}
+    for column, (attribute, prefix) in ME_CHARACTERISTICS.items():
+        value = me_xml[-1].get(attribute, '').removeprefix(prefix)
+        characteristics[column] = value if value not in ('', 'NotSet') \
+            else None
+
+    dob = characteristics['dob']
+    if dob is not None:
+        try:
+            datetime.date.fromisoformat(dob)
+        except ValueError:
+            LOGGER.warning("Ignoring the invalid date of birth %s." % dob)
+            characteristics['dob'] = None
+
+    if not DATABASE.update_person(PERSON_ID, characteristics):
+        LOGGER.warning("Couldn't store the characteristics of person %s."
+                       % PERSON_ID)
+
+
+def refresh_rollups():
+    """Bring the hourly rollups up to date with the import."""
+    if DATE_RANGES is None or not DATE_RANGES.ranges:
+        return
+
+    start = datetime.datetime.now()
+    if not DATABASE.refresh_rollups(DATE_RANGES.ranges):
+        LOGGER.warning("Couldn't refresh the rollups, they will be refreshed "
+                       "when the same records are imported again.")
+
+    LOGGER.info("Refreshing the rollups of %s series took %s seconds."
+                % (len(DATE_RANGES.ranges), datetime.datetime.now() - start))
+    hkg_metrics.phase_done('refresh_rollups', start)
+
+
+def get_export_shards():
+    """Return the prolog and byte ranges to parse export.xml in parallel.
+
+    None means the export is parsed by the streaming reader in this
+    process, either because sharding is turned off, there is only one
+    worker or shard, the export is still zipped, or the file doesn't have
+    the layout of an Apple export.
+    """
+    if not SHARDED_PARSE or WORKERS < 2 or not EXPORT.unpacked or \
+            EXPORT.size(hkg_export.EXPORT_XML) <= SHARD_SIZE:
+        return None
+
+    shards = hkg_export.export_shards(EXPORT_XML_PATH, SHARD_SIZE)
+    if shards is None:
+        LOGGER.warning("Couldn't find the <HealthData> element boundaries "
+                       "in %s, parsing it in a single process."
+                       % EXPORT_XML_PATH)
+        return None
+
+    prolog, ranges = shards
+    if len(ranges) < 2:
+        return None
+
+    return shards
+
+
+#  Runs in a worker process for the sharded parse. Records are turned into
+#  rows right away so only tuples travel back, and the few other elements
+#  are returned as they are. Dedupe happens in the importer process where
+#  the rows of every shard end up in the same sinks.
+def parse_export_shard(shard):
+    path, prolog, start, end, person_id = shard
+    router = hkg_records.RecordRouter(person_id, {})
+    rows = {}
+    elements = []
+
+    for tag, element in hkg_export.iter_shard_elements(path, prolog, start,
+                                                       end, EXPORT_TAGS):
+        if tag == 'Record':
+            kind, row = router.extract(element)
+            if row is None:
+                continue
+
+            rows.setdefault(kind, []).append(row)
+            if len(element):
+                for child_kind, child_rows in \
+                        router.extract_children(row, element):
+                    rows.setdefault(child_kind, []).extend(child_rows)
+        else:
+            elements.append((tag, element))
+
+    return rows, router.type_counts, router.invalid_count, elements
+
+
+def get_record_router():
+    def resume_rows(table):
+        return CHECKPOINT.resume_rows(table) if CHECKPOINT else 0
+
+    # Only quantities are rolled up
+    return hkg_records.RecordRouter(PERSON_ID, {
+        kind: hkg_records.RecordSink(
+            table, get_writer(table, method), RECORD_BATCH_SIZE, WATERMARKS,
+            DATE_RANGES if kind == hkg_records.QUANTITY else None,
+            resume_rows(table), hkg_records.ROW_KEYS[kind])
+        for kind, (table, method) in RECORD_SINKS.items()
+    }, PARSE_CACHE_WRITER, save_record_checkpoint if CHECKPOINT else None,
+        CHECKPOINT_INTERVAL)
+
+
+def get_export_fingerprint():
+    """Return the size, mtime and a function returning the content hash
+    of export.xml, hashing it only when the function is called.
+    """
+    fingerprint = EXPORT.fingerprint(hkg_export.EXPORT_XML)
+    if fingerprint is not None:
+        return fingerprint[0], fingerprint[1], lambda: fingerprint[2]
+
+    stat = os.stat(EXPORT_XML_PATH)
+    pending = MANIFEST.pending.get(os.path.abspath(EXPORT_XML_PATH)) \
+        if MANIFEST else None
+    if pending is not None and pending[:2] == (stat.st_size, stat.st_mtime):
+        # The manifest already hashed it
+        return pending[0], pending[1], lambda: pending[2]
+
+    return stat.st_size, stat.st_mtime, \
+        lambda: hkg_manifest.file_hash(EXPORT_XML_PATH)
+
+
+def open_parse_cache(elements):
+    """Return the parse cache if it was written from this export.xml.
+
+    Otherwise a cache writer is started, when a cache path is set, that
+    saves the rows of this parse and the ``elements`` it collects for the
+    next run.
+    """
+    global PARSE_CACHE_WRITER
+
+    cache_path = person_path(PARSE_CACHE_PATH)
+    if cache_path is None:
+        return None
+
+    uncached = set(RECORD_SINKS) - set(hkg_cache.KIND_ENCODINGS)
+    if uncached:
+        LOGGER.warning("The parse cache can't hold %s rows, it isn't used."
+                       % ", ".join(sorted(uncached)))
+        return None
+
+    size, mtime, content_hash = get_export_fingerprint()
+
+    if os.path.isfile(cache_path):
+        # noinspection PyBroadException
+        try:
+            cache = hkg_cache.ParseCache(cache_path)
+            if cache.matches(size, mtime, content_hash):
+                return cache
+            cache.close()
+            LOGGER.info("The parse cache %s is from another export, it will "
+                        "be written again." % cache_path)
+        except Exception as ex:
+            LOGGER.warning("Couldn't read the parse cache %s: %s"
+                           % (cache_path, ex))
+
+    PARSE_CACHE_WRITER = hkg_cache.ParseCacheWriter(
+        cache_path, (size, mtime, content_hash()), elements)
+
+    return None
+
+
+def import_records_cached(cache, elements):
+    """Import the records and elements of export.xml from the parse cache.
+    """
+    start = datetime.datetime.now()
+    LOGGER.info("Loading the parsed export from %s." % cache.path)
+    router = get_record_router()
+
+    for tag, element in cache.elements():
+        elements[tag].append(element)
+
+    router.route_rows({kind: cache.rows(kind, PERSON_ID)
+                       for kind in RECORD_SINKS},
+                      cache.type_counts, cache.invalid_count)
+    log_export_elements(elements, sum(cache.type_counts.values()))
+    loaded_tables = router.close()
+    cache.close()
+    LOGGER.info(
+        "Importing Records took %s" % (datetime.datetime.now() - start))
+    hkg_metrics.phase_done('import_records_cached', start)
+
+    return loaded_tables
 
 
 def import_records(records_xml):
-    global DATABASE
     start = datetime.datetime.now()
-    LOGGER.info("Importing %s Record elements." % len(records_xml))
-    quantity_records = get_quantity_records(records_xml)
-    category_records = get_category_records(records_xml)
+    LOGGER.info("Importing Record elements.")
+    router = get_record_router()
 
-    DATABASE.insert_quantity_records(quantity_records)
-    DATABASE.insert_category_records(category_records)
+    for record in records_xml:
+        router.route(record)
+
+    loaded_tables = router.close()
     LOGGER.info(
         "Importing Records took %s" % (datetime.datetime.now() - start))
+    hkg_metrics.phase_done('import_records', start)
 
+    return loaded_tables
 
-def import_workout_metadata(workout_id, metadata_xml):
-    metadata = []
 
-    if len(metadata_xml) == 0:
-        return
+def import_records_sharded(shards, elements):
+    """Parse export.xml in byte range shards and import their records.
+
+    The shards are parsed by a pool of processes while this process feeds
+    the resulting rows into the sinks, in export order, so duplicates are
+    resolved exactly like the streaming import does. At most two shards
+    per worker are in flight to keep memory bounded.
+    """
+    start = datetime.datetime.now()
+    prolog, ranges = shards
+    LOGGER.info("Parsing export file in %s shards with %s workers."
+                % (len(ranges), WORKERS))
+    router = get_record_router()
+    record_count = 0
+    pending = collections.deque()
+
+    def merge_shard(future):
+        nonlocal record_count
+        rows, type_counts, invalid_count, shard_elements = future.result()
+        record_count += sum(type_counts.values())
+        router.route_rows(rows, type_counts, invalid_count)
+
+        for tag, element in shard_elements:
+            elements[tag].append(element)
+
+    with concurrent.futures.ProcessPoolExecutor(WORKERS) as executor:
+        for range_start, range_end in ranges:
+            pending.append(executor.submit(
+                parse_export_shard,
+                (EXPORT_XML_PATH, prolog, range_start, range_end,
+                 PERSON_ID)))
+
+            if len(pending) >= WORKERS * 2:
+                merge_shard(pending.popleft())
+
+        while pending:
+            merge_shard(pending.popleft())
+
+    log_export_elements(elements, record_count)
+    loaded_tables = router.close()
+    LOGGER.info(
+        "Importing Records took %s" % (datetime.datetime.now() - start))
+    hkg_metrics.phase_done('import_records_sharded', start)
+
+    return loaded_tables
+
+
+def get_workout_metadata(workout_id, metadata_xml):
+    metadata = []
 
     for m in metadata_xml:
-        meta_key = m.getAttribute('key')
-        meta_val = m.getAttribute('value')
+        meta_key = m.get('key', '')
+        meta_val = m.get('value', '')
 
         if all([meta_key, meta_val]):
             if meta_key == 'HKExternalUUID':
@@ -392,20 +886,17 @@ def import_workout_metadata(workout_id, metadata_xml):
 
             metadata.append((workout_id, meta_key, meta_val))
 
-    DATABASE.insert_workout_metadata(metadata)
+    return metadata
 
 
-def import_workout_events(workout_id, events_xml):
+def get_workout_events(workout_id, events_xml):
     events = []
 
-    if len(events_xml) == 0:
-        return
-
     for event in events_xml:
-        event_type = event.getAttribute('type')
-        event_date = event.getAttribute('date')
-        duration = event.getAttribute('duration')
-        duration_unit = event.getAttribute('durationUnit')
+        event_type = event.get('type', '')
+        event_date = event.get('date', '')
+        duration = event.get('duration', '')
+        duration_unit = event.get('durationUnit', '')
 
         if len(duration) == 0:
             duration = None
@@ -415,91 +906,344 @@ def import_workout_events(workout_id, events_xml):
                 (workout_id, event_type, event_date, duration, duration_unit, )
             )
 
-    DATABASE.insert_workout_events(events)
+    return events
 
 
-def import_workouts(workouts_xml):
-    start = datetime.datetime.now()
-    LOGGER.info("Importing %s Workout elements." % len(workouts_xml))
+def get_workout_routes(workout_id, routes_xml, route_files):
+    """Return the hk_workout_route rows of a workout's WorkoutRoute elements
+    and add the export paths of their GPX files to ``route_files``.
+    """
+    routes = {}
+
+    for route in routes_xml:
+        source_name = route.get('sourceName', '')
+        file_reference = route.find('FileReference')
+        resource_path = '' if file_reference is None \
+            else file_reference.get('path', '')
+
+        if not all([source_name, resource_path, route.get('startDate'),
+                    route.get('endDate')]):
+            LOGGER.error("Required field missing, skipping workout route %s"
+                         % route)
+            continue
+
+        try:
+            creation_date = hkg_records.optional_value(
+                route.get('creationDate'), hkg_records.parse_export_date)
+            start_date = hkg_records.parse_export_date(route.get('startDate'))
+            end_date = hkg_records.parse_export_date(route.get('endDate'))
+        except ValueError as ve:
+            LOGGER.error("Invalid value, skipping workout route %s: %s"
+                         % (route, ve))
+            continue
+
+        # hk_workout_route_pkey without the workout_id, routes only holds
+        # the routes of this workout
+        routes[(end_date, start_date, source_name)] = (
+            workout_id, source_name, route.get('sourceVersion'),
+            route.get('device'), creation_date, start_date, end_date,
+            resource_path)
+        route_files.setdefault(workout_id, []).append(resource_path)
+
+    return list(routes.values())
+
+
+def import_workout_batch(database, workouts_xml, route_files):
+    workouts = {}
+    children = {}
 
     for workout in workouts_xml:
-        workout_activity_type = workout.getAttribute(
-            'workoutActivityType').removeprefix(WORKOUT_TYPE_PREFIX)
-        duration = workout.getAttribute('duration')
-        duration_unit = workout.getAttribute('durationUnit')
-        total_distance = workout.getAttribute('totalDistance')
-        total_distance_unit = workout.getAttribute('totalDistanceUnit')
-        total_energy_burned = workout.getAttribute('totalEnergyBurned')
-        total_energy_burned_unit = workout.getAttribute('totalEnergyBurnedUnit')
-        source_name = workout.getAttribute('sourceName')
-        source_version = workout.getAttribute('sourceVersion')
-        # device = workout.getAttribute('device')
-        creation_date = workout.getAttribute('creationDate')
-        start_date = workout.getAttribute('startDate')
-        end_date = workout.getAttribute('endDate')
-        workout_metadata = workout.getElementsByTagName('MetadataEntry')
-        workout_events = workout.getElementsByTagName('WorkoutEvent')
-        workout_route = workout.getElementsByTagName('WorkoutRoute')
-
-        if not all([workout_activity_type, source_name, start_date, end_date]):
+        workout_activity_type = workout.get(
+            'workoutActivityType', '').removeprefix(WORKOUT_TYPE_PREFIX)
+        duration_unit = workout.get('durationUnit', '')
+        total_distance_unit = workout.get('totalDistanceUnit', '')
+        total_energy_burned_unit = workout.get('totalEnergyBurnedUnit', '')
+        source_name = workout.get('sourceName', '')
+        source_version = workout.get('sourceVersion', '')
+        # device = workout.get('device', '')
+        workout_metadata = list(workout.iter('MetadataEntry'))
+        workout_events = list(workout.iter('WorkoutEvent'))
+        workout_route = list(workout.iter('WorkoutRoute'))
+
+        if not all([workout_activity_type, source_name,
+                    workout.get('startDate'), workout.get('endDate')]):
             LOGGER.error(
                 "Required field missing, skipping workout %s" % workout)
             continue
 
-        workout_id = DATABASE.insert_workout(
-            (workout_activity_type, duration, duration_unit,
-             total_distance, total_distance_unit,
-             total_energy_burned, total_energy_burned_unit,
-             source_name, source_version,
-             creation_date, start_date, end_date)
-        )
+        try:
+            duration = hkg_records.optional_value(
+                workout.get('duration'), float)
+            total_distance = hkg_records.optional_value(
+                workout.get('totalDistance'), float)
+            total_energy_burned = hkg_records.optional_value(
+                workout.get('totalEnergyBurned'), float)
+            creation_date = hkg_records.optional_value(
+                workout.get('creationDate'), hkg_records.parse_export_date)
+            start_date = hkg_records.parse_export_date(
+                workout.get('startDate'))
+            end_date = hkg_records.parse_export_date(workout.get('endDate'))
+        except ValueError as ve:
+            LOGGER.error("Invalid value, skipping workout %s: %s"
+                         % (workout, ve))
+            continue
 
-        if workout_id:
-            import_workout_metadata(workout_id, workout_metadata)
-            import_workout_events(workout_id, workout_events)
-        else:
+        key = (workout_activity_type, source_name, start_date, end_date)
+
+        if WATERMARKS and not WATERMARKS.is_new(
+                (PERSON_ID, 'hk_workout', workout_activity_type,
+                 source_name), key[2]):
+            continue
+
+        # Same natural key as hk_workout_unique, the last one wins just
+        # like it did when every workout was upserted on its own.
+        workouts[key] = (
+            PERSON_ID, workout_activity_type, duration, duration_unit,
+            total_distance, total_distance_unit,
+            total_energy_burned, total_energy_burned_unit,
+            source_name, source_version,
+            creation_date, start_date, end_date)
+        metadata_xml, events_xml, routes_xml = children.setdefault(
+            key, ([], [], []))
+        metadata_xml.extend(workout_metadata)
+        events_xml.extend(workout_events)
+        routes_xml.extend(workout_route)
+
+    if not workouts:
+        return True
+
+    workout_ids = database.insert_workouts(list(workouts.values()))
+    if workout_ids is None:
+        LOGGER.error("Couldn't insert a batch of %s workouts." % len(workouts))
+        return False
+
+    metadata = {}
+    events = []
+    routes = []
+
+    for key, (metadata_xml, events_xml, routes_xml) in children.items():
+        workout_id = workout_ids.get(key)
+
+        if not workout_id:
             LOGGER.error("Couldn't get ID from inserting workout.")
+            continue
+
+        # One statement can't update the same metadata row twice
+        for row in get_workout_metadata(workout_id, metadata_xml):
+            metadata[row[:2]] = row
+
+        events.extend(get_workout_events(workout_id, events_xml))
+        routes.extend(get_workout_routes(workout_id, routes_xml, route_files))
+
+    metadata_loaded = database.insert_workout_metadata(list(metadata.values()))
+    events_loaded = database.insert_workout_events(events)
+    routes_loaded = database.insert_workout_routes(routes)
+
+    return metadata_loaded and events_loaded and routes_loaded
+
+
+def get_changed_routes(route_files):
+    """Return the (workout id, GPX paths) of the routes that need loading.
+
+    A workout's points are replaced as a whole, so all of its files are
+    loaded again as soon as one of them changed.
+    """
+    routes = []
+    missing_files = 0
+    unchanged_routes = 0
+    committed_routes = 0
+
+    for workout_id, file_paths in route_files.items():
+        existing_paths = [path for path in file_paths if EXPORT.isfile(path)]
+        missing_files += len(file_paths) - len(existing_paths)
+
+        if not existing_paths:
+            continue
+
+        if MANIFEST:
+            # Every file has to be checked, so its fingerprint is saved
+            changed = [MANIFEST.changed(EXPORT.location(path),
+                                        EXPORT.fingerprint(path))
+                       for path in existing_paths]
+            if not any(changed):
+                unchanged_routes += 1
+                continue
+
+        if CHECKPOINT and workout_id in CHECKPOINT.routes:
+            committed_routes += 1
+            continue
+
+        routes.append((workout_id, existing_paths))
+
+    if missing_files > 0:
+        LOGGER.warning("Couldn't find %s workout route files referenced by "
+                       "export.xml." % missing_files)
+
+    if unchanged_routes > 0:
+        LOGGER.info("Skipped %s workout routes that haven't changed since "
+                    "they were imported." % unchanged_routes)
+
+    if committed_routes > 0:
+        LOGGER.info("Skipped %s workout routes an earlier run already "
+                    "committed." % committed_routes)
+
+    return routes
+
+
+def import_workout_routes(database, route_files):
+    """Load the track points of the workouts' GPX files.
+
+    The files are parsed by WORKERS processes and their points are sent
+    with COPY, one transaction per batch of routes holding at least
+    COMMIT_INTERVAL points.
+    """
+    start = datetime.datetime.now()
+    routes = [(workout_id, EXPORT, file_paths, ROUTE_TOLERANCE)
+              for workout_id, file_paths in get_changed_routes(route_files)]
+
+    if not routes:
+        return True
+
+    LOGGER.info("Importing %s workout routes." % len(routes))
+    result = True
+    point_count = 0
+    workout_ids = []
+    points = []
+
+    def flush():
+        nonlocal result
+        if workout_ids:
+            replaced = database.replace_route_points(workout_ids, points)
+            if replaced and CHECKPOINT:
+                CHECKPOINT.routes_committed(workout_ids)
+                database.save_checkpoint(CHECKPOINT.row())
+            result = replaced and result
+        workout_ids.clear()
+        points.clear()
+
+    with contextlib.ExitStack() as stack:
+        if WORKERS > 1 and len(routes) > 1:
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(WORKERS))
+            chunk_size = max(1, len(routes) // (WORKERS * 4))
+            results = executor.map(hkg_routes.load_route, routes,
+                                   chunksize=chunk_size)
+        else:
+            results = map(hkg_routes.load_route, routes)
+
+        for workout_id, route_points, error in results:
+            if error:
+                LOGGER.error("Skipping the route of workout %s: %s"
+                             % (workout_id, error))
+                result = False
+                continue
+
+            workout_ids.append(workout_id)
+            points.extend(route_points)
+            point_count += len(route_points)
+            if len(points) >= COMMIT_INTERVAL:
+                flush()
+
+        flush()
+
+    LOGGER.info("Importing %s route points took %s"
+                % (point_count, datetime.datetime.now() - start))
+    hkg_metrics.phase_done('import_workout_routes', start)
+
+    return result
+
+
+def import_workouts(database, workouts_xml):
+    start = datetime.datetime.now()
+    LOGGER.info("Importing %s Workout elements." % len(workouts_xml))
+
+    result = True
+    route_files = {}
+
+    for batch in hkg_database.iter_chunks(workouts_xml, WORKOUT_BATCH_SIZE):
+        result = import_workout_batch(database, batch, route_files) and result
+
+    if WORKOUT_ROUTES:
+        result = import_workout_routes(database, route_files) and result
 
     LOGGER.info(
         "Importing Workouts took %s" % (datetime.datetime.now() - start))
+    hkg_metrics.phase_done('import_workouts', start)
 
+    return result
+
+
+def summary_day(summary_date):
+    return datetime.datetime.strptime(summary_date, '%Y-%m-%d').replace(
+        tzinfo=datetime.timezone.utc)
+
+
+def optional_float(value):
+    return hkg_records.optional_value(value, float)
 
-def import_activity_summaries(summaries_xml):
+
+def optional_int(value):
+    return hkg_records.optional_value(value, int)
+
+
+def import_activity_summaries(database, summaries_xml):
     start = datetime.datetime.now()
     LOGGER.info("Importing %s Activity Summary elements." % len(summaries_xml))
     summaries = []
 
     for summary in summaries_xml:
-        summary_date = summary.getAttribute('dateComponents')
+        summary_date = summary.get('dateComponents', '')
 
         if not summary_date:
             LOGGER.error("Date was null for summary: %s" % summary)
             continue
 
-        active_energy_burned = summary.getAttribute('activeEnergyBurned')
-        active_energy_burned_goal = summary.getAttribute(
-            'activeEnergyBurnedGoal')
-        active_energy_burned_unit = summary.getAttribute(
-            'activeEnergyBurnedUnit')
-        apple_move_time = summary.getAttribute('appleMoveTime')
-        apple_move_time_goal = summary.getAttribute('appleMoveTimeGoal')
-        apple_exercise_time = summary.getAttribute('appleExerciseTime')
-        apple_exercise_time_goal = summary.getAttribute(
-            'appleExerciseTimeGoal')
-        apple_stand_hours = summary.getAttribute('appleStandHours')
-        apple_stand_hours_goal = summary.getAttribute('appleStandHoursGoal')
+        try:
+            day = summary_day(summary_date)
+            active_energy_burned = optional_float(
+                summary.get('activeEnergyBurned'))
+            active_energy_burned_goal = optional_float(
+                summary.get('activeEnergyBurnedGoal'))
+            apple_move_time = optional_int(summary.get('appleMoveTime'))
+            apple_move_time_goal = optional_int(
+                summary.get('appleMoveTimeGoal'))
+            apple_exercise_time = optional_int(
+                summary.get('appleExerciseTime'))
+            apple_exercise_time_goal = optional_int(
+                summary.get('appleExerciseTimeGoal'))
+            apple_stand_hours = optional_int(summary.get('appleStandHours'))
+            apple_stand_hours_goal = optional_int(
+                summary.get('appleStandHoursGoal'))
+        except ValueError as ve:
+            LOGGER.error("Invalid value, skipping summary %s: %s"
+                         % (summary, ve))
+            continue
+
+        # The summary of the newest day keeps filling up until that day is
+        # over, so it is imported again by the next incremental run.
+        if WATERMARKS and not WATERMARKS.is_new(
+                (PERSON_ID, 'hk_activity_summary', '', ''),
+                day, reload_mark=True):
+            continue
+
+        active_energy_burned_unit = summary.get(
+            'activeEnergyBurnedUnit', '')
 
         summaries.append(
-            (summary_date, active_energy_burned, active_energy_burned_goal,
-             active_energy_burned_unit, apple_move_time, apple_move_time_goal,
+            (PERSON_ID, day.date(), active_energy_burned,
+             active_energy_burned_goal, active_energy_burned_unit,
+             apple_move_time, apple_move_time_goal,
              apple_exercise_time, apple_exercise_time_goal,
              apple_stand_hours, apple_stand_hours_goal)
         )
 
-    DATABASE.insert_activity_summaries(summaries)
+    result = database.insert_activity_summaries(summaries)
 
     end = datetime.datetime.now() - start
     LOGGER.info("Importing Activity Summaries took %s seconds." % end)
+    hkg_metrics.phase_done('import_activity_summaries', start)
+
+    return result
 
 
 def remove_duplicate_clinical_records(clinical_records_xml):
@@ -511,7 +1255,7 @@ def remove_duplicate_clinical_records(clinical_records_xml):
 
     for cr in clinical_records_xml:
         # This should never be null
-        identifier = cr.getAttribute('identifier')
+        identifier = cr.get('identifier', '')
 
         if identifier not in id_record_map:
             id_record_map[identifier] = cr
@@ -520,13 +1264,16 @@ def remove_duplicate_clinical_records(clinical_records_xml):
 
     clinical_path = EXPORT_DIR_PATH + "/clinical-records/"
 
-    if os.path.isdir(clinical_path):
+    if not EXPORT.unpacked:
+        # Files inside export.zip stay where they are
+        skipped = len(duplicates)
+    elif os.path.isdir(clinical_path):
         duplicate_path = os.path.join(clinical_path, 'duplicates')
 
         pathlib.Path(duplicate_path).mkdir(exist_ok=True)
 
         for dup in duplicates:
-            file_path = dup.getAttribute('resourceFilePath')
+            file_path = dup.get('resourceFilePath', '')
 
             current_path = os.path.join(
                 clinical_path, os.path.basename(file_path))
@@ -555,8 +1302,7 @@ def remove_duplicate_clinical_records(clinical_records_xml):
     return id_record_map.values()
 
 
-def import_clinical_records(clinical_records_xml):
-    global DATABASE
+def import_clinical_records(database, clinical_records_xml):
     start = datetime.datetime.now()
     LOGGER.info("Importing %s Clinical Record (lab results) elements."
                 % len(clinical_records_xml))
@@ -564,45 +1310,303 @@ def import_clinical_records(clinical_records_xml):
     records, observations = \
         get_clinical_records_and_observations(clinical_records_xml)
 
-    DATABASE.insert_clinical_records(records)
-    DATABASE.insert_clinical_observations(observations)
+    records_loaded = database.insert_clinical_records(records)
+    observations_loaded = database.insert_clinical_observations(observations)
     end = datetime.datetime.now() - start
     LOGGER.info("Importing Clinical Records took %s seconds." % end)
+    hkg_metrics.phase_done('import_clinical_records', start)
 
+    return records_loaded and observations_loaded
 
-def import_data():
-    global DATABASE
+
+def prepare_database():
+    """Connect and bring the schema and the importer's tables up to date.
+    """
+    connect_to_db()
+    if not hkg_migrations.migrate(DATABASE):
+        raise HKGImportException(
+            "Couldn't bring the database schema up to date.")
+
+    if (INCREMENTAL or SKIP_UNCHANGED or CHECKPOINT_INTERVAL > 0) and \
+            not DATABASE.create_import_tables():
+        raise HKGImportException(
+            "Couldn't create the importer's state tables.")
+
+
+def run_import():
+    """Import the export and return whether every table loaded."""
+    global DATE_RANGES, PERSON_ID
     start = datetime.datetime.now()
     LOGGER.info("Starting Health Kit Exporter.")
 
+    reset_import_state()
     if not check_for_files():
-        LOGGER.error("Export Failed. Check the logs for errors and try again.")
-        exit(42)
+        raise HKGImportException(
+            "Export Failed. Check the logs for errors and try again.")
+
+    prepare_database()
+    if PERSON_ID is None:
+        PERSON_ID = DATABASE.get_person_id(PERSON_NAME)
+        if PERSON_ID is None:
+            raise HKGImportException(
+                "Couldn't add %s to hk_person." % PERSON_NAME)
+        LOGGER.info("Importing the export of %s, person %s."
+                    % (PERSON_NAME, PERSON_ID))
+
+    load_manifest()
+    if MANIFEST and not MANIFEST.changed(
+            EXPORT_XML_PATH, EXPORT.fingerprint(hkg_export.EXPORT_XML)):
+        LOGGER.info("%s hasn't changed since it was last imported, there is "
+                    "nothing to do. Set HKG_SKIP_UNCHANGED=false to import "
+                    "it anyway." % EXPORT_XML_PATH)
+        return True
+
+    load_watermarks()
+    load_checkpoint()
+    if ROLLUPS:
+        DATE_RANGES = hkg_records.DateRanges()
+    start_writers()
+    elements = {tag: [] for tag in EXPORT_TAGS if tag != 'Record'}
+    loaded_tables = []
 
-    connect_to_db()
-    me, records, workouts, activity_summaries, \
-        clinical_records = None, None, None, None, None
-    # noinspection PyBroadException
     try:
-        me, records, workouts, activity_summaries, \
-            clinical_records = parse_export_xml()
-    except Exception as ex:
+        cache = open_parse_cache(elements)
+        shards = None if cache else get_export_shards()
+        if cache:
+            loaded_tables.extend(import_records_cached(cache, elements))
+        elif shards:
+            loaded_tables.extend(import_records_sharded(shards, elements))
+        else:
+            loaded_tables.extend(import_records(parse_export_xml(elements)))
+    except ElementTree.ParseError as ex:
         LOGGER.error(
-            "Encountered the following error while parsing export.", ex)
-        LOGGER.error("Parsing of %s failed. Make sure it's a valid "
-                     "Apple HealthKit export and try again." % EXPORT_XML_PATH)
-        exit(42)
-
-    import_me(me)
-    import_records(records)
-    import_workouts(workouts)
-    import_activity_summaries(activity_summaries)
-    unique_records = remove_duplicate_clinical_records(clinical_records)
-    import_clinical_records(unique_records)
+            "Encountered the following error while parsing export: %s" % ex)
+        raise HKGImportException(
+            "Parsing of %s failed. Make sure it's a valid Apple HealthKit "
+            "export and try again." % EXPORT_XML_PATH)
+
+    import_me(elements['Me'])
+    unique_records = remove_duplicate_clinical_records(
+        elements['ClinicalRecord'])
+    # These tables don't depend on each other, so each one is loaded on its
+    # own pooled connection while the writers finish the records.
+    loaded_tables.extend(DATABASE.load_tables({
+        'hk_workout': lambda database: import_workouts(
+            database, elements['Workout']),
+        'hk_activity_summary': lambda database: import_activity_summaries(
+            database, elements['ActivitySummary']),
+        'hk_clinical_record': lambda database: import_clinical_records(
+            database, unique_records),
+    }, TABLE_LOADERS))
+    loaded_tables = stop_writers(loaded_tables)
+    # The server may have gone away while the writers were at it
+    DATABASE.reconnect()
+    refresh_rollups()
+    save_watermarks(loaded_tables)
+
+    clean = set(IMPORT_TABLES) <= set(loaded_tables)
+    if clean:
+        save_manifest()
+    else:
+        LOGGER.warning("Some tables didn't load cleanly, the files will be "
+                       "imported again by the next run.")
+    clear_checkpoint()
 
     end = datetime.datetime.now()
     LOGGER.info("Exiting, everything took %s seconds." % (end - start))
 
+    return clean
+
+
+def reset_import_state():
+    """Forget what the previous import of this process left behind.
+
+    Only the database connections are kept, so watch mode imports every
+    export on warm connections. Their caches of lookup ids and partitions
+    are dropped.
+    """
+    global WATERMARKS, MANIFEST, DATE_RANGES, CHECKPOINT, PARSE_CACHE_WRITER
+
+    if WRITER_POOL is not None:
+        stop_writers([])
+    if DATABASE is not None:
+        DATABASE.clear_caches()
+    WATERMARKS = None
+    MANIFEST = None
+    DATE_RANGES = None
+    CHECKPOINT = None
+    PARSE_CACHE_WRITER = None
+
+
+def person_path(path):
+    """Return the file ``path`` of the person being imported.
+
+    With several exports every person gets files of their own, named
+    after them, e.g. report-alice.json.
+    """
+    if path is None or PERSON_NAME is None or len(EXPORTS) < 2:
+        return path
+
+    root, extension = os.path.splitext(path)
+    return "%s-%s%s" % (root, re.sub(r'[^\w.-]+', '_', PERSON_NAME),
+                        extension)
+
+
+def use_export(name, path):
+    """Point the next import at the export of the person ``name``."""
+    global PERSON_ID, PERSON_NAME, EXPORT_DIR_PATH, EXPORT_XML_PATH
+
+    PERSON_ID = DEFAULT_PERSON_ID if name is None else None
+    PERSON_NAME = name
+    EXPORT_DIR_PATH = path
+    EXPORT_XML_PATH = path + "/" + hkg_export.EXPORT_XML
+
+
+def import_data():
+    """Run an import and write its metrics and profile when configured.
+
+    Returns whether every table loaded.
+    """
+    with hkg_metrics.import_run(person_path(METRICS_REPORT_PATH),
+                                person_path(METRICS_PROMETHEUS_PATH),
+                                PROFILE_MODES,
+                                person_path(PROFILE_PATH)) as metrics:
+        metrics.set('import_success', 0)
+        if run_import():
+            metrics.set('import_success', 1)
+            return True
+
+    return False
+
+
+#  Runs in a process of its own for every export of a multi-person import,
+#  with its own database connections, writers and parse workers.
+def import_person(name, path, workers):
+    global WORKERS
+
+    WORKERS = workers
+    use_export(name, path)
+    try:
+        clean = import_data()
+    except HKGImportException as ex:
+        LOGGER.error(ex)
+        exit(42)
+
+    # The parent only sees the exit code
+    if not clean:
+        exit(1)
+
+
+def import_people():
+    """Import the exports of several people side by side.
+
+    Every export is imported by a process of its own, HKG_PERSON_IMPORTS
+    at a time, so parsing, which is bound by the CPU, runs on as many
+    cores as there are people. The parse workers of HKG_WORKERS are
+    divided among them. Each process opens its own connection pool, so
+    the database sees up to HKG_PERSON_IMPORTS times the connections of
+    one import.
+    """
+    global DATABASE
+
+    names = [name for name, _ in EXPORTS]
+    if len(set(names)) < len(names):
+        raise HKGImportException(
+            "Every export needs a person of its own, got %s." % names)
+
+    # Migrated up front, the imports would race each other for it
+    prepare_database()
+    # A forked process can't use the connection of its parent
+    DATABASE.close()
+    DATABASE = None
+
+    concurrency = max(1, min(PERSON_IMPORTS, len(EXPORTS)))
+    workers = max(1, WORKERS // concurrency)
+    start = datetime.datetime.now()
+    LOGGER.info("Importing the exports of %s people, %s at a time with %s "
+                "workers each." % (len(EXPORTS), concurrency, workers))
+    pending = list(EXPORTS)
+    running = {}
+    failed = []
+
+    while pending or running:
+        while pending and len(running) < concurrency:
+            name, path = pending.pop(0)
+            process = multiprocessing.Process(
+                target=import_person, args=(name, path, workers),
+                name='import-%s' % name)
+            process.start()
+            running[process.sentinel] = (name, process)
+
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            name, process = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                failed.append(name)
+
+    LOGGER.info("Importing the exports of %s people took %s seconds."
+                % (len(EXPORTS), datetime.datetime.now() - start))
+    if failed:
+        raise HKGImportException(
+            "The imports of %s failed or didn't load cleanly."
+            % ", ".join(failed))
+
+
+def stop_watching(signum, frame):
+    raise SystemExit(0)
+
+
+def watch_exports():
+    """Import every new export that lands at HKG_EXPORT_FILE_PATH.
+
+    Runs until the process is stopped. With several exports each one is
+    watched and imported on its own, one after the other. A failed import
+    is logged and the same export tried again after HKG_WATCH_RETRY
+    seconds.
+    """
+    LOGGER.info("Watching %s for new exports every %s seconds."
+                % (", ".join(path for _, path in EXPORTS), WATCH_INTERVAL))
+    watchers = [(name, path, hkg_watch.ExportWatcher(path, WATCH_SETTLE,
+                                                     WATCH_RETRY))
+                for name, path in EXPORTS]
+    # docker stop sends SIGTERM, exit through the finally blocks instead
+    signal.signal(signal.SIGTERM, stop_watching)
+
+    try:
+        while True:
+            for name, path, watcher in watchers:
+                if not watcher.poll():
+                    continue
+
+                LOGGER.info("Importing the export in %s." % path)
+                use_export(name, path)
+                success = False
+                # noinspection PyBroadException
+                try:
+                    success = import_data()
+                except HKGImportException as ex:
+                    LOGGER.error(ex)
+                except Exception:
+                    LOGGER.exception("The import failed.")
+                watcher.done(success)
+                LOGGER.info("Waiting for the next export.")
+
+            time.sleep(WATCH_INTERVAL)
+    finally:
+        LOGGER.info("Stopped watching for exports.")
+        if DATABASE is not None:
+            DATABASE.close()
+
 
 if __name__ == "__main__":
-    import_data()
+    try:
+        if WATCH:
+            watch_exports()
+        elif len(EXPORTS) > 1:
+            import_people()
+        else:
+            use_export(*EXPORTS[0])
+            import_data()
+    except HKGImportException as ex:
+        LOGGER.error(ex)
+        exit(42)
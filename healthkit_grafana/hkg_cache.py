@@ -0,0 +1,340 @@
+import array
+import datetime
+import itertools
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from xml.etree import ElementTree
+from healthkit_grafana import hkg_logger
+from healthkit_grafana import hkg_records
+
+LOGGER = hkg_logger.LOGGER
+
+CACHE_MAGIC = b'HKGCACHE'
+# Bump whenever the rows the record extractors produce change
+CACHE_VERSION = 4
+CACHE_PREFIX = struct.Struct('<8sQ')
+ALIGNMENT = 8
+SPILL_SIZE = 1024 * 1024
+DECODE_SIZE = 50000
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+NULL_DATE = -2 ** 63
+NULL_CODE = -1
+
+# Encoding of every column of the rows each record extractor returns,
+# except the person_id they start with. It isn't cached since the person
+# may have another id by the next run, e.g. after delete_all_data.sql.
+INT = 'int'
+TEXT = 'text'
+DATE = 'date'
+FLOAT = 'float'
+RECORD_ENCODINGS = (TEXT, TEXT, TEXT, TEXT, DATE, DATE, DATE, TEXT)
+KIND_ENCODINGS = {
+    hkg_records.QUANTITY: RECORD_ENCODINGS + (FLOAT, ),
+    hkg_records.CATEGORY: RECORD_ENCODINGS + (TEXT, ),
+    hkg_records.METADATA: (TEXT, TEXT, DATE, DATE, TEXT, TEXT),
+    hkg_records.HEART_BEAT: (TEXT, DATE, DATE, INT),
+}
+TYPECODES = {INT: 'q', TEXT: 'i', DATE: 'q', FLOAT: 'd'}
+
+
+class DateCodes(dict):
+    """Maps datetimes to microseconds since the epoch.
+
+    The start, end and creation date of a record are mostly the same, so
+    most dates are looked up instead of converted again.
+    """
+
+    def __missing__(self, date):
+        value = NULL_DATE if date is None else \
+            (date - EPOCH) // datetime.timedelta(microseconds=1)
+        self[date] = value
+        return value
+
+
+def float_value(value):
+    return float('nan') if value is None else value
+
+
+class ColumnWriter(object):
+    """Appends the values of one column to a temporary file.
+
+    Values are packed into a typed array and spilled to the file whenever
+    the array holds SPILL_SIZE values, so writing a cache takes a few MB
+    of memory no matter how many rows the export has. Text is dictionary
+    encoded: the file holds codes and ``dictionary`` the distinct values.
+    """
+
+    def __init__(self, encoding, directory):
+        self.encoding = encoding
+        self.values = array.array(TYPECODES[encoding])
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.dictionary = {}
+        self.date_codes = DateCodes()
+
+        if encoding == TEXT:
+            self.encode = self.encode_text
+        elif encoding == DATE:
+            self.encode = self.date_codes.__getitem__
+        elif encoding == FLOAT:
+            self.encode = float_value
+        else:
+            self.encode = int
+
+    def encode_text(self, value):
+        if value is None:
+            return NULL_CODE
+
+        code = self.dictionary.get(value)
+        if code is None:
+            code = len(self.dictionary)
+            self.dictionary[value] = code
+
+        return code
+
+    def extend(self, values):
+        self.values.extend(map(self.encode, values))
+        # Neighbouring records share dates, older ones rarely come back
+        if len(self.date_codes) > DECODE_SIZE:
+            self.date_codes.clear()
+
+        if len(self.values) >= SPILL_SIZE:
+            self.spill()
+
+    def spill(self):
+        self.values.tofile(self.file)
+        del self.values[:]
+
+    def copy_to(self, output):
+        """Write the column to ``output`` and return its description."""
+        self.spill()
+        offset = output.tell()
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, output)
+        self.file.close()
+        length = output.tell() - offset
+        output.write(b'\0' * (-length % ALIGNMENT))
+
+        return {'encoding': self.encoding, 'offset': offset,
+                'length': length, 'dictionary': list(self.dictionary)}
+
+
+class ParseCacheWriter(object):
+    """Writes the rows parsed out of an export into a columnar cache file.
+
+    The record router hands over every extracted row, deduplicated on the
+    same key as the record sinks, before high-water marks are applied, so
+    the cache holds the whole export. Rows are buffered and encoded
+    DECODE_SIZE at a time, a column at a time. The Me, Workout,
+    ActivitySummary and ClinicalRecord elements are few, they are kept as
+    XML. The file is only replaced once it was written completely.
+    """
+
+    def __init__(self, path, fingerprint, elements):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.elements = elements
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.columns = {kind: [ColumnWriter(encoding, self.directory)
+                               for encoding in encodings]
+                        for kind, encodings in KIND_ENCODINGS.items()}
+        self.row_counts = dict.fromkeys(KIND_ENCODINGS, 0)
+        self.rows = {kind: [] for kind in KIND_ENCODINGS}
+        self.seen = set()
+
+    def add(self, kind, row):
+        rows = self.rows.get(kind)
+        if rows is None:
+            return
+
+        key = hash((kind, ) + hkg_records.ROW_KEYS[kind](row))
+        if key in self.seen:
+            return
+        self.seen.add(key)
+
+        rows.append(row)
+        if len(rows) >= DECODE_SIZE:
+            self.encode(kind)
+
+    def encode(self, kind):
+        """Move the buffered rows of a kind into its columns."""
+        rows = self.rows[kind]
+        if rows:
+            for column, values in zip(self.columns[kind],
+                                      itertools.islice(zip(*rows), 1, None)):
+                column.extend(values)
+            self.row_counts[kind] += len(rows)
+            rows.clear()
+
+    def close(self, type_counts, invalid_count):
+        start = datetime.datetime.now()
+        temporary_path = self.path + '.tmp'
+
+        try:
+            self.write(temporary_path, type_counts, invalid_count)
+        except Exception:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        os.replace(temporary_path, self.path)
+        LOGGER.info("Writing the parse cache %s took %s seconds."
+                    % (self.path, datetime.datetime.now() - start))
+
+    def write(self, path, type_counts, invalid_count):
+        with open(path, 'wb') as output:
+            output.write(CACHE_PREFIX.pack(CACHE_MAGIC, 0))
+            kinds = {}
+            for kind, columns in self.columns.items():
+                self.encode(kind)
+                kinds[kind] = {
+                    'rows': self.row_counts[kind],
+                    'columns': [column.copy_to(output) for column in columns],
+                }
+
+            offset = output.tell()
+            output.write(b'<HKGElements>')
+            for tag_elements in self.elements.values():
+                for element in tag_elements:
+                    output.write(ElementTree.tostring(element))
+            output.write(b'</HKGElements>')
+            elements = {'offset': offset, 'length': output.tell() - offset}
+
+            header = json.dumps({
+                'version': CACHE_VERSION,
+                'byteorder': sys.byteorder,
+                'fingerprint': self.fingerprint,
+                'type_counts': type_counts,
+                'invalid_count': invalid_count,
+                'kinds': kinds,
+                'elements': elements,
+            }).encode()
+            header_offset = output.tell()
+            output.write(header)
+            output.seek(0)
+            output.write(CACHE_PREFIX.pack(CACHE_MAGIC, header_offset))
+
+
+class DateCache(dict):
+    """Maps microseconds since the epoch to the datetime they stand for.
+
+    Dates repeat a lot, the start and end of most records are the same,
+    so every distinct value is only converted once per slice of rows.
+    """
+
+    def __missing__(self, value):
+        date = None if value == NULL_DATE else \
+            EPOCH + datetime.timedelta(microseconds=value)
+        self[value] = date
+        return date
+
+
+class ParseCache(object):
+    """A parse cache file, memory mapped for reading.
+
+    Columns are read straight from the mapping as typed memoryviews and
+    decoded DECODE_SIZE rows at a time, one column after the other, so
+    only a slice of the rows is ever turned into Python objects.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as cache_file:
+            self.map = mmap.mmap(cache_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+        magic, header_offset = CACHE_PREFIX.unpack_from(self.map)
+        if magic != CACHE_MAGIC or header_offset == 0:
+            raise ValueError("%s isn't a parse cache" % path)
+
+        self.header = json.loads(self.map[header_offset:])
+        self.dates = DateCache()
+
+    @property
+    def type_counts(self):
+        return self.header['type_counts']
+
+    @property
+    def invalid_count(self):
+        return self.header['invalid_count']
+
+    def matches(self, size, mtime, content_hash):
+        """Whether the cache was written from the export fingerprinted.
+
+        ``content_hash`` is only called when size or mtime differ.
+        """
+        if self.header['version'] != CACHE_VERSION or \
+                self.header['byteorder'] != sys.byteorder:
+            return False
+
+        cached = self.header['fingerprint']
+        if cached[:2] == [size, mtime]:
+            return True
+
+        return cached[2] == content_hash()
+
+    def column(self, description):
+        view = memoryview(self.map)[description['offset']:
+                                    description['offset'] +
+                                    description['length']]
+        return view.cast(TYPECODES[description['encoding']])
+
+    def decoder(self, description):
+        """Return a function that turns a slice of a column into values."""
+        encoding = description['encoding']
+
+        if encoding == TEXT:
+            # The null code -1 picks the None at the end
+            dictionary = [sys.intern(value)
+                          for value in description['dictionary']]
+            dictionary.append(None)
+            return lambda codes: list(map(dictionary.__getitem__, codes))
+
+        if encoding == DATE:
+            return lambda values: list(map(self.dates.__getitem__, values))
+
+        if encoding == FLOAT:
+            return lambda values: [None if value != value else value
+                                   for value in values]
+
+        return list
+
+    def rows(self, kind, person_id):
+        """Yield the rows of one kind in the order they were parsed, as
+        rows of ``person_id``."""
+        kind_header = self.header['kinds'].get(kind)
+        if kind_header is None:
+            return
+
+        columns = [(self.column(description), self.decoder(description))
+                   for description in kind_header['columns']]
+
+        for start in range(0, kind_header['rows'], DECODE_SIZE):
+            end = start + DECODE_SIZE
+            # Only the dates of one slice are kept, like ColumnWriter does
+            self.dates.clear()
+            yield from zip(itertools.repeat(person_id),
+                           *[decode(column[start:end].tolist())
+                             for column, decode in columns])
+
+    def elements(self):
+        """Yield the (tag, element) pairs that were kept as XML."""
+        location = self.header['elements']
+        root = ElementTree.fromstring(
+            self.map[location['offset']:
+                     location['offset'] + location['length']])
+
+        for element in root:
+            yield element.tag, element
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            # A column view is still referenced, the map goes with it
+            pass
@@ -0,0 +1,50 @@
+import json
+import threading
+
+
+class ImportCheckpoint(object):
+    """How far an import of one export got before it was interrupted.
+
+    The record sinks count the rows they accept, after deduplication and
+    high-water marks, in export order. Once every accepted row of a sink
+    is committed its count is saved, together with the workouts whose
+    route points were replaced. The next run of the same export, matched
+    by its fingerprint, skips writing that many rows of every table and
+    the routes of those workouts. It still reads them, so duplicates,
+    high-water marks and rollup ranges come out exactly as they would
+    have in one uninterrupted run. The checkpoint is deleted once a run
+    gets to the end.
+
+    The fingerprint covers the high-water marks an incremental import
+    starts from, and whether it is one, since they decide which rows the
+    sinks accept. A checkpoint saved under other marks is ignored.
+    """
+
+    def __init__(self, person_id, export_path, fingerprint, saved=None):
+        self.person_id = person_id
+        self.export_path = export_path
+        self.fingerprint = fingerprint
+        self.resumed = saved is not None and saved[0] == fingerprint
+        self.table_rows = dict(saved[1]) if self.resumed else {}
+        self.routes = set(saved[2]) if self.resumed else set()
+        # Set after a failed write, the rows behind it must be written again
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def resume_rows(self, table):
+        """Rows of ``table`` that an earlier run already committed."""
+        return self.table_rows.get(table, 0)
+
+    def records_committed(self, table_rows):
+        with self.lock:
+            self.table_rows.update(table_rows)
+
+    def routes_committed(self, workout_ids):
+        with self.lock:
+            self.routes.update(workout_ids)
+
+    def row(self):
+        """Return the hkg_import_checkpoint row of the progress so far."""
+        with self.lock:
+            return (self.person_id, self.export_path, self.fingerprint,
+                    json.dumps(self.table_rows), sorted(self.routes))
@@ -1,7 +1,284 @@
+import concurrent.futures
+import contextlib
+import datetime
+import itertools
+import re
+import struct
+import threading
+import time
 import psycopg2
 import psycopg2.extras as extras
 from retry import retry
 from healthkit_grafana import hkg_logger
+from healthkit_grafana import hkg_metrics
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# The record tables store ids of hk_source and hk_device, the views named
+# after the record tables show the names again.
+RECORD_TABLES = {
+    'hk_quantity_record': 'hk_quantity_sample',
+    'hk_category_record': 'hk_category_sample',
+}
+RECORD_COLUMNS = ('person_id', 'hk_type', 'source_id', 'source_version',
+                  'device_id', 'creation_date', 'start_date', 'end_date',
+                  'unit', 'hk_value')
+RECORD_KEY_COLUMNS = ('person_id', 'hk_type', 'source_id', 'start_date',
+                      'end_date')
+RECORD_UPDATE_COLUMNS = ('source_version', 'device_id', 'creation_date',
+                         'unit', 'hk_value')
+RECORD_COLUMN_TYPES = ('int4', 'text', 'int4', 'text', 'int4', 'timestamptz',
+                       'timestamptz', 'timestamptz', 'text')
+
+RECORD_METADATA_COLUMNS = ('person_id', 'hk_type', 'source_id', 'start_date',
+                           'end_date', 'meta_key', 'meta_value')
+RECORD_METADATA_COLUMN_TYPES = ('int4', 'text', 'int4', 'timestamptz',
+                                'timestamptz', 'text', 'text')
+HEART_BEAT_COLUMNS = ('person_id', 'source_id', 'record_start', 'beat_time',
+                      'bpm')
+HEART_BEAT_KEY_COLUMNS = ('person_id', 'source_id', 'beat_time')
+HEART_BEAT_COLUMN_TYPES = ('int4', 'int4', 'timestamptz', 'timestamptz',
+                           'int4')
+
+ROUTE_POINT_COLUMNS = ('workout_id', 'point_time', 'latitude', 'longitude',
+                       'elevation', 'speed', 'course', 'horizontal_accuracy',
+                       'vertical_accuracy')
+ROUTE_POINT_COLUMN_TYPES = ('int4', 'timestamptz') + ('float8', ) * 7
+
+ROLLUP_HOUR_SQL = """
+    DELETE FROM public.hk_quantity_hour
+    WHERE person_id = %(person_id)s AND hk_type = %(hk_type)s
+      AND bucket >= %(first_hour)s AND bucket <= %(last_hour)s;
+
+    INSERT INTO public.hk_quantity_hour
+    SELECT person_id, hk_type, source_id,
+           date_trunc('hour', start_date AT TIME ZONE 'UTC')
+               AT TIME ZONE 'UTC',
+           count(*), sum(hk_value), min(hk_value), max(hk_value)
+    FROM public.hk_quantity_sample
+    WHERE person_id = %(person_id)s AND hk_type = %(hk_type)s
+      AND start_date >= %(first_hour)s
+      AND start_date < %(last_hour)s + interval '1 hour'
+    GROUP BY 1, 2, 3, 4;
+"""
+
+# Whether a table is partitioned and the names of its partitions
+PARTITIONS_SQL = """
+    SELECT c.relkind = 'p',
+           array(SELECT p.relname FROM pg_inherits i
+                 JOIN pg_class p ON p.oid = i.inhrelid
+                 WHERE i.inhparent = c.oid)
+    FROM pg_class c
+    WHERE c.oid = %s::regclass;
+"""
+
+# (table, id column, value column) of the dictionary encoded values
+SOURCE_LOOKUP = ('hk_source', 'source_id', 'source_name')
+DEVICE_LOOKUP = ('hk_device', 'device_id', 'device')
+
+COPY_SPECIAL_CHARACTERS = re.compile('[\\\\\t\n\r]')
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+COPY_TEXT = 'text'
+COPY_BINARY = 'binary'
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+BINARY_COPY_TRAILER = struct.pack('!h', -1)
+BINARY_NULL = struct.pack('!i', -1)
+BINARY_LENGTH = struct.Struct('!i')
+BINARY_INT4 = struct.Struct('!ii')
+BINARY_INT8 = struct.Struct('!iq')
+BINARY_FLOAT8 = struct.Struct('!id')
+PG_EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def conflict_update_sql(constraint, update_columns):
+    if len(update_columns) == 1:
+        # A column list needs at least two columns
+        return "ON CONFLICT ON CONSTRAINT %s " \
+               "DO UPDATE SET %s = EXCLUDED.%s;" % (
+                   constraint, update_columns[0], update_columns[0])
+
+    return "ON CONFLICT ON CONSTRAINT %s " \
+           "DO UPDATE " \
+           "SET (%s) = (%s);" % (
+               constraint,
+               ", ".join(update_columns),
+               ", ".join("EXCLUDED." + c for c in update_columns))
+
+
+def copy_text(value):
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, str):
+        if COPY_SPECIAL_CHARACTERS.search(value):
+            return value.translate(COPY_ESCAPES)
+        return value
+
+    return str(value)
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def binary_int4(value):
+    return BINARY_INT4.pack(4, value)
+
+
+def binary_float8(value):
+    return BINARY_FLOAT8.pack(8, value)
+
+
+def binary_timestamptz(value):
+    return BINARY_INT8.pack(8, (value - PG_EPOCH) // ONE_MICROSECOND)
+
+
+def binary_text(value):
+    data = value.encode()
+    return BINARY_LENGTH.pack(len(data)) + data
+
+
+BINARY_ENCODERS = {
+    'int4': binary_int4,
+    'float8': binary_float8,
+    'timestamptz': binary_timestamptz,
+    'text': binary_text,
+}
+
+
+class CopyStream(object):
+    """A read-only file object that renders rows in COPY text format.
+
+    Rows are pulled from the iterable only as psycopg2 asks for more data,
+    so a generator can be streamed into COPY without building the whole
+    payload in memory.
+    """
+
+    header = b''
+    trailer = b''
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = self.header
+        self.row_count = 0
+        self.byte_count = 0
+        self.done = False
+
+    def render(self, row):
+        return ("\t".join(map(copy_text, row)) + "\n").encode()
+
+    def read(self, size=-1):
+        lines = [self.buffer]
+        length = len(self.buffer)
+
+        while size < 0 or length < size:
+            row = next(self.rows, None)
+            if row is None:
+                if not self.done:
+                    lines.append(self.trailer)
+                    self.done = True
+                break
+
+            line = self.render(row)
+            lines.append(line)
+            length += len(line)
+            self.row_count += 1
+
+        data = b''.join(lines)
+        if size < 0:
+            size = len(data)
+
+        self.buffer = data[size:]
+        self.byte_count += min(size, len(data))
+        return data[:size]
+
+
+class BinaryCopyStream(CopyStream):
+    """A CopyStream that renders rows in COPY binary format.
+
+    Postgres stores binary values as they are instead of parsing text, so
+    the rows must hold the Python types matching ``column_types``: int
+    for int4, float for float8, aware datetimes for timestamptz and str
+    for text. The encoding of repeated text values, like sources and
+    devices, is cached for the lifetime of the stream.
+    """
+
+    header = BINARY_COPY_HEADER
+    trailer = BINARY_COPY_TRAILER
+
+    def __init__(self, rows, column_types):
+        super().__init__(rows)
+        self.field_count = struct.pack('!h', len(column_types))
+        self.text_cache = {}
+        self.encoders = [self.cached_text if column_type == 'text'
+                         else BINARY_ENCODERS[column_type]
+                         for column_type in column_types]
+
+    def cached_text(self, value):
+        data = self.text_cache.get(value)
+
+        if data is None:
+            data = binary_text(value)
+            self.text_cache[value] = data
+
+        return data
+
+    def render(self, row):
+        fields = [self.field_count]
+
+        for encode, value in zip(self.encoders, row):
+            fields.append(BINARY_NULL if value is None else encode(value))
+
+        return b''.join(fields)
+
+
+class LookupCache(object):
+    """Ids of hk_source and hk_device values, shared by pooled connections.
+
+    Ids are resolved once per distinct value and import. The lock makes
+    sure only one connection inserts a new value at a time.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def get(self, lookup):
+        return self.ids.setdefault(lookup[0], {})
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+
+
+class PartitionCache(object):
+    """Partitions of the record tables, shared by pooled connections.
+
+    ``names`` maps a record table to the names of its partitions, or to
+    None when the table isn't partitioned. The lock makes sure only one
+    connection creates a partition at a time.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.names.clear()
 
 
 class HKGDatabaseException(Exception):
@@ -9,13 +286,26 @@ class HKGDatabaseException(Exception):
 
 
 class HKGDatabase(object):
-    def __init__(self, host, name, user, password):
+    def __init__(self, host, name, user, password, copy_tables=(),
+                 page_size=1000, commit_interval=10000,
+                 copy_format=COPY_BINARY):
         self.logger = hkg_logger.LOGGER
         self.host = host
         self.name = name
         self.username = user
         self.password = password
         self.connection = None
+        # Rows per execute_values statement and rows per transaction
+        self.page_size = page_size
+        self.commit_interval = commit_interval
+        # Tables loaded with COPY into a staging table instead of upserts
+        self.copy_tables = set(copy_tables)
+        self.copy_format = copy_format
+        self.lookups = LookupCache()
+        self.partitions = PartitionCache()
+        # Connected databases handed out by acquire() for parallel loads
+        self.idle = []
+        self.pool_lock = threading.Lock()
 
     #  Wait up to 17 mins attempting to reconnect
     @retry((Exception, psycopg2.DatabaseError), tries=10, delay=1, backoff=2)
@@ -52,26 +342,456 @@ class HKGDatabase(object):
 
         return result
 
+    def is_connected(self):
+        """Whether the connection is open and the server still answers."""
+        if not self.connection or self.connection.closed:
+            return False
+
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            self.connection.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def clear_caches(self):
+        """Forget the lookup ids and partitions, which rows deleted since
+        the last import, e.g. by delete_all_data.sql, may have outdated."""
+        self.lookups.clear()
+        self.partitions.clear()
+
+    def rollback(self):
+        """Roll back the open transaction and return whether it worked.
+
+        Error handlers call this after a failed statement, when the server
+        may be gone as well, so it logs instead of raising.
+        """
+        try:
+            self.connection.rollback()
+        except (Exception, psycopg2.Error) as error_ex:
+            self.logger.error("Error on rollback.")
+            self.logger.error("Error: " + str(error_ex))
+            return False
+
+        return True
+
+    def reconnect(self):
+        """Connect again if the connection was lost, e.g. to a restart of
+        the server. Raises like connect_to_db once its retries are up."""
+        if self.connection is not None and not self.connection.closed:
+            return
+
+        self.connection = None
+        self.connect_to_db()
+
     def close(self):
+        with self.pool_lock:
+            idle, self.idle = self.idle, []
+
+        for database in idle:
+            database.close()
+
         self.connection.close()
 
-    def insert_values(self, records, sql):
+    def acquire(self):
+        """Return a pooled database with a connection of its own.
+
+        Idle pooled databases are reused, otherwise a new one is connected
+        with the same settings and the same retries as connect_to_db.
+        """
+        with self.pool_lock:
+            database = self.idle.pop() if self.idle else None
+
+        if database is not None:
+            database.reconnect()
+            return database
+
+        database = HKGDatabase(self.host, self.name, self.username,
+                               self.password, copy_tables=self.copy_tables,
+                               page_size=self.page_size,
+                               commit_interval=self.commit_interval,
+                               copy_format=self.copy_format)
+        database.lookups = self.lookups
+        database.partitions = self.partitions
+        database.connect_to_db()
+
+        return database
+
+    def release(self, database):
+        if database.connection is None or database.connection.closed:
+            return
+
+        # noinspection PyBroadException
+        try:
+            database.connection.rollback()
+        except Exception:
+            database.close()
+            return
+
+        with self.pool_lock:
+            self.idle.append(database)
+
+    @contextlib.contextmanager
+    def borrow(self):
+        database = self.acquire()
+        try:
+            yield database
+        finally:
+            self.release(database)
+
+    def load_tables(self, loaders, workers):
+        """Run independent table loaders in parallel on pooled connections.
+
+        ``loaders`` maps a table name to a callable that takes a database
+        and returns whether the table loaded. A loader that fails or
+        raises only costs its own table. Returns the tables that loaded.
+        """
+        def load(table, loader):
+            start = datetime.datetime.now()
+            # noinspection PyBroadException
+            try:
+                with self.borrow() as database:
+                    loaded = loader(database)
+            except Exception as ex:
+                self.logger.error("Loading %s failed." % table)
+                self.logger.error("Error: " + str(ex))
+                loaded = False
+
+            self.logger.info("Loading %s took %s seconds."
+                             % (table, datetime.datetime.now() - start))
+            return loaded
+
+        with concurrent.futures.ThreadPoolExecutor(max(1, workers)) \
+                as executor:
+            futures = {table: executor.submit(load, table, loader)
+                       for table, loader in loaders.items()}
+
+        return [table for table, future in futures.items()
+                if future.result()]
+
+    def commit(self):
+        start = time.monotonic()
+        try:
+            self.connection.commit()
+        except (Exception, psycopg2.Error) as error_ex:
+            self.logger.error("Error on commit.")
+            self.logger.error("Error: " + str(error_ex))
+            self.rollback()
+            return False
+
+        hkg_metrics.observe('commit', time.monotonic() - start)
+        return True
+
+    def log_chunk(self, table, row_count, start, byte_count, round_trips):
+        elapsed = max(time.monotonic() - start, 1e-6)
+        hkg_metrics.observe('chunk', elapsed, table=table)
+        hkg_metrics.count('rows', row_count, table=table)
+        hkg_metrics.count('bytes_sent', byte_count, table=table)
+        hkg_metrics.count('round_trips', round_trips, table=table)
+        self.logger.debug("Loaded %s rows into %s in %.2f seconds "
+                          "(%.0f rows/sec)."
+                          % (row_count, table, elapsed, row_count / elapsed))
+
+    def insert_values(self, records, sql, table):
+        """Send ``records`` to the database in committed chunks.
+
+        ``records`` can be any iterable, including a generator. Rows are
+        pulled ``commit_interval`` at a time, sent with execute_values in
+        statements of ``page_size`` rows and committed, so memory stays
+        flat and a failure only loses the chunk that was in flight.
+        """
+        result = True
+        cursor = self.connection.cursor()
+        try:
+            for chunk in iter_chunks(records, self.commit_interval):
+                start = time.monotonic()
+                byte_count = 0
+                statement_count = 0
+                try:
+                    # One page per call, so the size of every statement
+                    # sent can be counted
+                    for page in iter_chunks(chunk, self.page_size):
+                        extras.execute_values(cursor, sql, page,
+                                              page_size=self.page_size)
+                        byte_count += len(cursor.query)
+                        statement_count += 1
+                except (Exception, psycopg2.Error) as error_ex:
+                    self.logger.error(
+                        "Error executing the following sql: %s" % sql)
+                    self.logger.error("Error: " + str(error_ex))
+                    self.rollback()
+                    result = False
+                    break
+
+                if not self.commit():
+                    result = False
+                    break
+
+                self.log_chunk(table, len(chunk), start, byte_count,
+                               statement_count + 1)
+        finally:
+            cursor.close()
+
+        return result
+
+    def copy_values(self, records, table, columns, key_columns, merge_sql,
+                    column_types=None):
+        """Bulk load ``records`` into ``table`` through a staging table.
+
+        Each chunk of ``commit_interval`` rows is streamed with COPY FROM
+        STDIN into a temporary staging table, which is never WAL logged
+        and private to this connection, and then merged into the target
+        with a single INSERT ... SELECT using ``merge_sql`` as its ON
+        CONFLICT clause. Rows that collide on ``key_columns`` inside one
+        chunk are collapsed since one statement can't update the same row
+        twice. When ``column_types`` is given and the copy format is binary
+        the rows are sent in COPY binary format, which spares the server
+        from parsing every value.
+        """
         result = True
+        staging = "hkg_staging_" + table
+        column_list = ", ".join(columns)
+        key_list = ", ".join(key_columns)
+        binary = self.copy_format == COPY_BINARY and column_types is not None
+        copy_sql = "COPY %s (%s) FROM STDIN%s;" % (
+            staging, column_list, " WITH (FORMAT binary)" if binary else "")
         cursor = self.connection.cursor()
         try:
-            extras.execute_values(cursor, sql, records)
+            for chunk in iter_chunks(records, self.commit_interval):
+                start = time.monotonic()
+                try:
+                    # A crash can only lose loads that are simply rerun
+                    cursor.execute("SET LOCAL synchronous_commit TO OFF;")
+                    cursor.execute(
+                        "CREATE TEMPORARY TABLE IF NOT EXISTS %s AS "
+                        "SELECT %s FROM public.%s WITH NO DATA;"
+                        % (staging, column_list, table))
+                    if binary:
+                        stream = BinaryCopyStream(chunk, column_types)
+                    else:
+                        stream = CopyStream(chunk)
+                    cursor.copy_expert(copy_sql, stream,
+                                       size=COPY_BUFFER_SIZE)
+                    cursor.execute(
+                        "INSERT INTO public.%s (%s) "
+                        "SELECT DISTINCT ON (%s) %s FROM %s "
+                        "ORDER BY %s %s"
+                        % (table, column_list, key_list, column_list,
+                           staging, key_list, merge_sql))
+                    cursor.execute("TRUNCATE %s;" % staging)
+                except (Exception, psycopg2.Error) as error_ex:
+                    self.logger.error(
+                        "Error copying records into %s" % table)
+                    self.logger.error("Error: " + str(error_ex))
+                    self.rollback()
+                    result = False
+                    break
+
+                if not self.commit():
+                    result = False
+                    break
+
+                # SET, CREATE, COPY, INSERT, TRUNCATE and the commit
+                self.log_chunk(table, len(chunk), start, stream.byte_count, 6)
+        finally:
+            cursor.close()
+
+        return result
+
+    def lookup_ids(self, lookup, values):
+        """Return the ids of ``values`` in a lookup table, adding new ones.
+        """
+        ids = self.lookups.get(lookup)
+        missing = [value for value in values if value not in ids]
+
+        if not missing:
+            return ids
+
+        table, id_column, value_column = lookup
+        with self.lookups.lock:
+            cursor = self.connection.cursor()
+            try:
+                extras.execute_values(
+                    cursor,
+                    "INSERT INTO public.%s (%s) VALUES %%s "
+                    "ON CONFLICT DO NOTHING;" % (table, value_column),
+                    [(value, ) for value in missing])
+                cursor.execute(
+                    "SELECT %s, %s FROM public.%s WHERE %s = ANY(%%s);"
+                    % (value_column, id_column, table, value_column),
+                    (missing, ))
+                ids.update(cursor.fetchall())
+            finally:
+                cursor.close()
+
+            # The ids have to be visible to every connection right away
+            if not self.commit():
+                raise HKGDatabaseException(
+                    "Couldn't add new values to %s" % table)
+
+        return ids
+
+    def encode_records(self, health_records):
+        """Replace the source and device of each record by their ids."""
+        sources = self.lookup_ids(SOURCE_LOOKUP,
+                                  {record[2] for record in health_records})
+        devices = self.lookup_ids(DEVICE_LOOKUP,
+                                  {record[4] for record in health_records
+                                   if record[4] is not None})
+
+        return [(r[0], r[1], sources[r[2]], r[3],
+                 None if r[4] is None else devices[r[4]],
+                 r[5], r[6], r[7], r[8], r[9]) for r in health_records]
+
+    def create_partitions(self, table, health_records):
+        """Create the yearly partitions of ``table`` the records fall in.
+
+        Runs in a transaction of its own before the records are written,
+        since a new partition locks the whole table until it's committed.
+        """
+        with self.partitions.lock:
+            cursor = self.connection.cursor()
+            try:
+                if table not in self.partitions.names:
+                    cursor.execute(PARTITIONS_SQL, ('public.' + table, ))
+                    partitioned, names = cursor.fetchone()
+                    self.partitions.names[table] = \
+                        set(names) if partitioned else None
+
+                names = self.partitions.names[table]
+                if names is None:
+                    return True
+
+                years = {record[6].astimezone(datetime.timezone.utc).year
+                         for record in health_records}
+                created = []
+                for year in sorted(years):
+                    partition = "%s_%s" % (table, year)
+                    if partition in names:
+                        continue
+
+                    if not created:
+                        # Another import process may be creating the same
+                        # partition, IF NOT EXISTS only sees it committed
+                        cursor.execute("SELECT pg_advisory_xact_lock("
+                                       "hashtext(%s));", (table, ))
+                    self.logger.info("Creating partition %s" % partition)
+                    cursor.execute(
+                        "CREATE TABLE IF NOT EXISTS public.%s PARTITION OF "
+                        "public.%s FOR VALUES FROM (%%s) TO (%%s);"
+                        % (partition, table),
+                        ('%s-01-01 00:00:00+00' % year,
+                         '%s-01-01 00:00:00+00' % (year + 1)))
+                    created.append(partition)
+            finally:
+                cursor.close()
+
+            if not self.commit():
+                raise HKGDatabaseException(
+                    "Couldn't create the partitions of %s" % table)
+
+            names.update(created)
+
+        return True
+
+    def insert_records(self, health_records, record_table, value_type):
+        table = RECORD_TABLES[record_table]
+        merge_sql = conflict_update_sql(table + '_unique',
+                                        RECORD_UPDATE_COLUMNS)
+
+        try:
+            health_records = self.encode_records(list(health_records))
+            self.create_partitions(table, health_records)
+        except (Exception, psycopg2.Error) as error_ex:
+            self.logger.error("Error preparing records for %s" % table)
+            self.logger.error("Error: " + str(error_ex))
+            self.rollback()
+            return False
+
+        if record_table in self.copy_tables:
+            return self.copy_values(health_records, table, RECORD_COLUMNS,
+                                    RECORD_KEY_COLUMNS, merge_sql,
+                                    RECORD_COLUMN_TYPES + (value_type, ))
+
+        upsert_sql = "INSERT INTO public.%s(%s) VALUES %%s %s" % (
+            table, ", ".join(RECORD_COLUMNS), merge_sql)
+
+        return self.insert_values(health_records, upsert_sql, table)
+
+    def insert_source_rows(self, rows, table, source_index, columns,
+                           key_columns, column_types):
+        """Write rows that hold a source name at ``source_index`` to a
+        table that stores the hk_source id instead, like the records."""
+        try:
+            rows = list(rows)
+            sources = self.lookup_ids(SOURCE_LOOKUP,
+                                      {row[source_index] for row in rows})
+            rows = [row[:source_index] + (sources[row[source_index]], ) +
+                    row[source_index + 1:] for row in rows]
+        except (Exception, psycopg2.Error) as error_ex:
+            self.logger.error("Error preparing records for %s" % table)
+            self.logger.error("Error: " + str(error_ex))
+            self.rollback()
+            return False
+
+        merge_sql = conflict_update_sql(
+            table + '_pkey',
+            [column for column in columns if column not in key_columns])
+
+        if table in self.copy_tables:
+            return self.copy_values(rows, table, columns, key_columns,
+                                    merge_sql, column_types)
+
+        upsert_sql = "INSERT INTO public.%s(%s) VALUES %%s %s" % (
+            table, ", ".join(columns), merge_sql)
+
+        return self.insert_values(rows, upsert_sql, table)
+
+    def refresh_rollups(self, date_ranges):
+        """Recompute the rollup buckets overlapping the imported ranges.
+
+        ``date_ranges`` maps (person_id, hk_type) to the first and last
+        start date that was imported. Every hour between them is
+        rebuilt from hk_quantity_sample, so rows that were inserted or
+        updated are both accounted for.
+        """
+        cursor = self.connection.cursor()
+        try:
+            for (person_id, hk_type), (first, last) in date_ranges.items():
+                first_hour = first.astimezone(datetime.timezone.utc).replace(
+                    minute=0, second=0, microsecond=0)
+                last_hour = last.astimezone(datetime.timezone.utc).replace(
+                    minute=0, second=0, microsecond=0)
+                cursor.execute(ROLLUP_HOUR_SQL, {
+                    'person_id': person_id,
+                    'hk_type': hk_type,
+                    'first_hour': first_hour,
+                    'last_hour': last_hour,
+                })
+        except (Exception, psycopg2.Error) as error_ex:
+            self.logger.error("Error refreshing the rollups.")
+            self.logger.error("Error: " + str(error_ex))
+            self.rollback()
+            return False
+        finally:
+            cursor.close()
+
+        return self.commit()
+
+    def execute(self, sql, data=None):
+        result = True
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, data)
         except (Exception, psycopg2.Error) as error_ex:
             self.logger.error("Error executing the following sql: %s" % sql)
             self.logger.error("Error: " + str(error_ex))
+            self.rollback()
             result = False
         else:
-            try:
-                self.connection.commit()
-            except (Exception, psycopg2.Error) as error_ex:
-                self.logger.error("Error on commit.")
-                self.logger.error("Error: " + str(error_ex))
-                self.connection.rollback()
-                result = False
+            result = self.commit()
         finally:
             cursor.close()
 
@@ -94,56 +814,70 @@ class HKGDatabase(object):
 
         return result
 
-    def insert_quantity_records(self, health_records):
-        upsert_sql = "INSERT INTO public.hk_quantity_record(" \
-                     "person_id, " \
-                     "hk_type, " \
-                     "hk_source, " \
-                     "source_version, " \
-                     "device, " \
-                     "creation_date, " \
-                     "start_date, " \
-                     "end_date, " \
-                     "unit, " \
-                     "hk_value) " \
-                     "VALUES %s " \
-                     "ON CONFLICT ON CONSTRAINT" \
-                     "  hk_quantity_record_unique " \
-                     "DO UPDATE " \
-                     "SET (source_version, device, " \
-                     "creation_date, unit, hk_value) = " \
-                     "(EXCLUDED.source_version, " \
-                     "EXCLUDED.device, EXCLUDED.creation_date, " \
-                     "EXCLUDED.unit, EXCLUDED.hk_value);"
+    def get_person_id(self, fullname):
+        """Return the id of the person with this name, adding them if they
+        aren't in hk_person yet. Returns None on an error."""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT min(person_id) FROM public.hk_person "
+                "WHERE fullname = %s;", (fullname, ))
+            person_id = cursor.fetchone()[0]
+            if person_id is None:
+                cursor.execute(
+                    "INSERT INTO public.hk_person (fullname) VALUES (%s) "
+                    "RETURNING person_id;", (fullname, ))
+                person_id = cursor.fetchone()[0]
+        except (Exception, psycopg2.Error) as error_ex:
+            self.logger.error("Error looking up the person %s" % fullname)
+            self.logger.error("Error: " + str(error_ex))
+            self.rollback()
+            return None
+        finally:
+            cursor.close()
+
+        return person_id if self.commit() else None
 
-        return self.insert_values(health_records, upsert_sql)
+    def update_person(self, person_id, characteristics):
+        """Store the characteristics of a person read from <Me>.
 
+        ``characteristics`` maps hk_person columns to values, a None
+        keeps what is stored.
+        """
+        columns = sorted(characteristics)
+        return self.execute(
+            "UPDATE public.hk_person SET %s WHERE person_id = %%s;"
+            % ", ".join("%s = COALESCE(%%s, %s)" % (column, column)
+                        for column in columns),
+            [characteristics[column] for column in columns] + [person_id])
+
+    @hkg_metrics.timed_insert
+    def insert_quantity_records(self, health_records):
+        return self.insert_records(health_records, 'hk_quantity_record',
+                                   'float8')
+
+    @hkg_metrics.timed_insert
     def insert_category_records(self, health_records):
-        upsert_sql = "INSERT INTO public.hk_category_record(" \
-                     "person_id, " \
-                     "hk_type, " \
-                     "hk_source, " \
-                     "source_version, " \
-                     "device, " \
-                     "creation_date, " \
-                     "start_date, " \
-                     "end_date, " \
-                     "unit, " \
-                     "hk_value) " \
-                     "VALUES %s " \
-                     "ON CONFLICT ON CONSTRAINT" \
-                     "  hk_category_record_unique " \
-                     "DO UPDATE " \
-                     "SET (source_version, device, " \
-                     "creation_date, unit, hk_value) = " \
-                     "(EXCLUDED.source_version, " \
-                     "EXCLUDED.device, EXCLUDED.creation_date, " \
-                     "EXCLUDED.unit, EXCLUDED.hk_value);"
+        return self.insert_records(health_records, 'hk_category_record',
+                                   'text')
+
+    @hkg_metrics.timed_insert
+    def insert_record_metadata(self, record_metadata):
+        return self.insert_source_rows(
+            record_metadata, 'hk_record_metadata', 2,
+            RECORD_METADATA_COLUMNS, RECORD_METADATA_COLUMNS[:6],
+            RECORD_METADATA_COLUMN_TYPES)
 
-        return self.insert_values(health_records, upsert_sql)
+    @hkg_metrics.timed_insert
+    def insert_heart_beats(self, heart_beats):
+        return self.insert_source_rows(
+            heart_beats, 'hk_heart_beat', 1, HEART_BEAT_COLUMNS,
+            HEART_BEAT_KEY_COLUMNS, HEART_BEAT_COLUMN_TYPES)
 
+    @hkg_metrics.timed_insert
     def insert_clinical_records(self, clinical_records):
         upsert_sql = "INSERT INTO public.hk_clinical_record(" \
+                     "  person_id," \
                      "  id," \
                      "  subject," \
                      "  effective_time," \
@@ -157,16 +891,19 @@ class HKGDatabase(object):
                      "ON CONFLICT ON CONSTRAINT" \
                      "  hk_clinical_record_pkey " \
                      "DO UPDATE " \
-                     "SET (subject, effective_time," \
+                     "SET (person_id, subject, effective_time," \
                      "issued_time, hk_type, source_name, " \
                      "resource_path, category, panel) = " \
-                     "(EXCLUDED.subject, EXCLUDED.effective_time, " \
+                     "(EXCLUDED.person_id, " \
+                     "EXCLUDED.subject, EXCLUDED.effective_time, " \
                      "EXCLUDED.issued_time, EXCLUDED.hk_type, " \
                      "EXCLUDED.source_name, EXCLUDED.resource_path, " \
                      "EXCLUDED.category, EXCLUDED.panel);"
 
-        return self.insert_values(clinical_records, upsert_sql)
+        return self.insert_values(clinical_records, upsert_sql,
+                                  'hk_clinical_record')
 
+    @hkg_metrics.timed_insert
     def insert_clinical_observations(self, clinical_observations):
         upsert_sql = "INSERT INTO public.hk_clinical_observation(" \
                      "  record_id," \
@@ -190,10 +927,13 @@ class HKGDatabase(object):
                      "EXCLUDED.ref_range_low, EXCLUDED.unit, " \
                      "EXCLUDED.value);"
 
-        return self.insert_values(clinical_observations, upsert_sql)
+        return self.insert_values(clinical_observations, upsert_sql,
+                                  'hk_clinical_observation')
 
+    @hkg_metrics.timed_insert
     def insert_activity_summaries(self, activity_summaries):
         upsert_sql = "INSERT INTO public.hk_activity_summary(" \
+                     "  person_id," \
                      "  summary_date," \
                      "  active_energy_burned," \
                      "  active_energy_burned_goal," \
@@ -223,20 +963,27 @@ class HKGDatabase(object):
                      "EXCLUDED.apple_stand_hours, " \
                      "EXCLUDED.apple_stand_hours_goal);"
 
-        return self.insert_values(activity_summaries, upsert_sql)
+        return self.insert_values(activity_summaries, upsert_sql,
+                                  'hk_activity_summary')
+
+    @hkg_metrics.timed_insert
+    def insert_workouts(self, workouts):
+        """Upsert a batch of workouts and map their natural keys to ids.
 
-    def insert_workout(self, workout) -> str:
-        result = ''
+        The keys are (workout_activity_type, source_name, start_date,
+        end_date) as in hk_workout_unique, without the person every
+        workout of a batch belongs to, and with the dates as the datetimes
+        psycopg2 returns. Returns None if the batch couldn't be stored.
+        """
+        result = {}
         upsert_sql = "INSERT INTO public.hk_workout(" \
-                     "workout_activity_type, " \
+                     "person_id, workout_activity_type, " \
                      "duration, duration_unit, " \
                      "total_distance, total_distance_unit, " \
                      "total_energy_burned, total_energy_burned_unit, " \
                      "source_name, source_version, " \
                      "creation_date, start_date, end_date" \
-                     ") VALUES (" \
-                     "   %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s" \
-                     ")" \
+                     ") VALUES %s " \
                      "ON CONFLICT ON CONSTRAINT" \
                      "  hk_workout_unique " \
                      "DO UPDATE " \
@@ -252,30 +999,41 @@ class HKGDatabase(object):
                      "EXCLUDED.total_energy_burned_unit, " \
                      "EXCLUDED.source_version, " \
                      "EXCLUDED.creation_date) " \
-                     "RETURNING workout_id;"
+                     "RETURNING workout_id, workout_activity_type, " \
+                     "source_name, start_date, end_date;"
 
         cursor = self.connection.cursor()
+        rows = []
+        byte_count = 0
+        statement_count = 0
         try:
-            cursor.execute(upsert_sql, workout)
-            result = cursor.fetchone()[0]
+            start = time.monotonic()
+            for page in iter_chunks(workouts, self.page_size):
+                rows.extend(extras.execute_values(cursor, upsert_sql, page,
+                                                  page_size=self.page_size,
+                                                  fetch=True))
+                byte_count += len(cursor.query)
+                statement_count += 1
         except (Exception, psycopg2.Error) as error_ex:
             self.logger.error(
                 "Error executing the following sql: %s" % upsert_sql)
             self.logger.error("Error: " + str(error_ex))
-            result = False
+            self.rollback()
+            result = None
         else:
-            try:
-                self.connection.commit()
-            except (Exception, psycopg2.Error) as error_ex:
-                self.logger.error("Error on commit.")
-                self.logger.error("Error: " + str(error_ex))
-                self.connection.rollback()
-                result = False
+            if self.commit():
+                self.log_chunk('hk_workout', len(workouts), start,
+                               byte_count, statement_count + 1)
+                for workout_id, *key in rows:
+                    result[tuple(key)] = workout_id
+            else:
+                result = None
         finally:
             cursor.close()
 
         return result
 
+    @hkg_metrics.timed_insert
     def insert_workout_metadata(self, workout_metadata):
         upsert_sql = "INSERT INTO public.hk_workout_metadata(" \
                      "  workout_id," \
@@ -287,8 +1045,10 @@ class HKGDatabase(object):
                      "DO UPDATE " \
                      "SET meta_value = EXCLUDED.meta_value;"
 
-        return self.insert_values(workout_metadata, upsert_sql)
+        return self.insert_values(workout_metadata, upsert_sql,
+                                  'hk_workout_metadata')
 
+    @hkg_metrics.timed_insert
     def insert_workout_events(self, workout_events):
         upsert_sql = "INSERT INTO public.hk_workout_event(" \
                      "  workout_id," \
@@ -301,4 +1061,190 @@ class HKGDatabase(object):
                      "  hk_workout_event_unique " \
                      "DO NOTHING;"
 
-        return self.insert_values(workout_events, upsert_sql)
+        return self.insert_values(workout_events, upsert_sql,
+                                  'hk_workout_event')
+
+    @hkg_metrics.timed_insert
+    def insert_workout_routes(self, workout_routes):
+        upsert_sql = "INSERT INTO public.hk_workout_route(" \
+                     "  workout_id," \
+                     "  source_name," \
+                     "  source_version," \
+                     "  device," \
+                     "  creation_date," \
+                     "  start_date," \
+                     "  end_date," \
+                     "  resource_path" \
+                     ") VALUES %s " + \
+                     conflict_update_sql('hk_workout_route_pkey',
+                                         ('source_version', 'device',
+                                          'creation_date', 'resource_path'))
+
+        return self.insert_values(workout_routes, upsert_sql,
+                                  'hk_workout_route')
+
+    @hkg_metrics.timed_insert
+    def replace_route_points(self, workout_ids, route_points):
+        """Replace the track points of the workouts in ``workout_ids``.
+
+        The old points are deleted and ``route_points`` are streamed in
+        with COPY in the same transaction, so a route that was imported
+        again, or with another tolerance, never keeps stale points.
+        """
+        binary = self.copy_format == COPY_BINARY
+        copy_sql = "COPY public.hk_workout_route_point (%s) FROM STDIN%s;" % (
+            ", ".join(ROUTE_POINT_COLUMNS),
+            " WITH (FORMAT binary)" if binary else "")
+        cursor = self.connection.cursor()
+        try:
+            start = time.monotonic()
+            cursor.execute("DELETE FROM public.hk_workout_route_point "
+                           "WHERE workout_id = ANY(%s);", (workout_ids, ))
+            if binary:
+                stream = BinaryCopyStream(route_points,
+                                          ROUTE_POINT_COLUMN_TYPES)
+            else:
+                stream = CopyStream(route_points)
+            cursor.copy_expert(copy_sql, stream, size=COPY_BUFFER_SIZE)
+        except (Exception, psycopg2.Error) as error_ex:
+            self.logger.error("Error copying route points.")
+            self.logger.error("Error: " + str(error_ex))
+            self.rollback()
+            return False
+        finally:
+            cursor.close()
+
+        if not self.commit():
+            return False
+
+        # DELETE, COPY and the commit
+        self.log_chunk('hk_workout_route_point', len(route_points), start,
+                       stream.byte_count, 3)
+        return True
+
+    def create_import_tables(self):
+        """Create the tables the importer keeps its own state in."""
+        return self.execute(
+            "CREATE TABLE IF NOT EXISTS public.hkg_import_watermark"
+            "("
+            "  person_id integer NOT NULL,"
+            "  table_name text NOT NULL,"
+            "  hk_type text NOT NULL,"
+            "  hk_source text NOT NULL,"
+            "  high_water timestamp with time zone NOT NULL,"
+            "  updated_at timestamp with time zone NOT NULL DEFAULT now(),"
+            "  CONSTRAINT hkg_import_watermark_pkey"
+            "    PRIMARY KEY (person_id, table_name, hk_type, hk_source)"
+            ");"
+            "CREATE TABLE IF NOT EXISTS public.hkg_import_manifest"
+            "("
+            "  file_path text NOT NULL,"
+            "  file_size bigint NOT NULL,"
+            "  file_mtime double precision NOT NULL,"
+            "  content_hash text NOT NULL,"
+            "  imported_at timestamp with time zone NOT NULL DEFAULT now(),"
+            "  CONSTRAINT hkg_import_manifest_pkey PRIMARY KEY (file_path)"
+            ");"
+            "CREATE TABLE IF NOT EXISTS public.hkg_import_checkpoint"
+            "("
+            "  person_id integer NOT NULL,"
+            "  export_path text NOT NULL,"
+            "  fingerprint text NOT NULL,"
+            "  table_rows jsonb NOT NULL,"
+            "  route_workouts integer[] NOT NULL,"
+            "  updated_at timestamp with time zone NOT NULL DEFAULT now(),"
+            "  CONSTRAINT hkg_import_checkpoint_pkey"
+            "    PRIMARY KEY (person_id, export_path)"
+            ");")
+
+    def get_watermarks(self):
+        rows = self.get_values(
+            "SELECT person_id, table_name, hk_type, hk_source, high_water "
+            "FROM public.hkg_import_watermark;")
+
+        if rows is False:
+            return None
+
+        return {tuple(row[:4]): row[4] for row in rows}
+
+    def save_watermarks(self, watermarks):
+        upsert_sql = "INSERT INTO public.hkg_import_watermark(" \
+                     "  person_id," \
+                     "  table_name," \
+                     "  hk_type," \
+                     "  hk_source," \
+                     "  high_water" \
+                     ") VALUES %s " \
+                     "ON CONFLICT ON CONSTRAINT" \
+                     "  hkg_import_watermark_pkey " \
+                     "DO UPDATE " \
+                     "SET (high_water, updated_at) = " \
+                     "(GREATEST(hkg_import_watermark.high_water, " \
+                     "EXCLUDED.high_water), now());"
+
+        return self.insert_values(watermarks, upsert_sql,
+                                  'hkg_import_watermark')
+
+    def get_manifest(self):
+        rows = self.get_values(
+            "SELECT file_path, file_size, file_mtime, content_hash "
+            "FROM public.hkg_import_manifest;")
+
+        if rows is False:
+            return None
+
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def save_manifest(self, manifest_rows):
+        upsert_sql = "INSERT INTO public.hkg_import_manifest(" \
+                     "  file_path," \
+                     "  file_size," \
+                     "  file_mtime," \
+                     "  content_hash" \
+                     ") VALUES %s " \
+                     "ON CONFLICT ON CONSTRAINT" \
+                     "  hkg_import_manifest_pkey " \
+                     "DO UPDATE " \
+                     "SET (file_size, file_mtime, content_hash, " \
+                     "imported_at) = " \
+                     "(EXCLUDED.file_size, EXCLUDED.file_mtime, " \
+                     "EXCLUDED.content_hash, now());"
+
+        return self.insert_values(manifest_rows, upsert_sql,
+                                  'hkg_import_manifest')
+
+    def get_checkpoint(self, person_id, export_path):
+        """Return the fingerprint, table rows and route workouts saved by
+        an interrupted import of the export, or None."""
+        rows = self.get_values(
+            "SELECT fingerprint, table_rows, route_workouts "
+            "FROM public.hkg_import_checkpoint "
+            "WHERE person_id = %s AND export_path = %s;",
+            (person_id, export_path))
+
+        if not rows:
+            return None
+
+        return rows[0]
+
+    def save_checkpoint(self, checkpoint_row):
+        return self.execute(
+            "INSERT INTO public.hkg_import_checkpoint("
+            "  person_id,"
+            "  export_path,"
+            "  fingerprint,"
+            "  table_rows,"
+            "  route_workouts"
+            ") VALUES (%s, %s, %s, %s, %s) "
+            "ON CONFLICT ON CONSTRAINT"
+            "  hkg_import_checkpoint_pkey "
+            "DO UPDATE "
+            "SET (fingerprint, table_rows, route_workouts, updated_at) = "
+            "(EXCLUDED.fingerprint, EXCLUDED.table_rows, "
+            "EXCLUDED.route_workouts, now());", checkpoint_row)
+
+    def delete_checkpoint(self, person_id, export_path):
+        return self.execute(
+            "DELETE FROM public.hkg_import_checkpoint "
+            "WHERE person_id = %s AND export_path = %s;",
+            (person_id, export_path))
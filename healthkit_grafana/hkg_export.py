@@ -0,0 +1,229 @@
+import io
+import os
+import time
+import zipfile
+from xml.etree import ElementTree
+
+EXPORT_XML = 'export.xml'
+EXPORT_ZIP = 'export.zip'
+
+ROOT_START_TAG = b'<HealthData'
+ROOT_END_TAG = b'</HealthData>'
+# Apple indents every direct child of <HealthData> by exactly one space and
+# nested elements by more, so a newline followed by ' <' (and not ' </')
+# always starts a new top-level element.
+SHARD_BOUNDARY = b'\n <'
+SHARD_SCAN_SIZE = 64 * 1024
+PROLOG_SCAN_SIZE = 1024 * 1024
+
+
+def iter_export_elements(source, tags):
+    """Stream (tag, element) pairs for the given tags out of an export.
+
+    The export is read with iterparse so only the element currently being
+    handled (plus whatever the caller decides to keep) is held in memory.
+    Every element that is a direct child of <HealthData> is detached from
+    the root once it has been yielded, which lets it be garbage collected
+    as soon as the caller drops its reference. Elements nested deeper,
+    like the <Record> children of a <Correlation>, are yielded as well and
+    released together with their parent.
+    """
+    depth = 0
+    root = None
+
+    for event, element in ElementTree.iterparse(source, ('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+            continue
+
+        depth -= 1
+
+        if element.tag in tags:
+            yield element.tag, element
+
+        if depth == 1:
+            root.clear()
+
+
+def find_shard_boundary(export_file, position, end):
+    """Return the offset of the first top-level element at or after position.
+    """
+    export_file.seek(position)
+    carry = b''
+
+    while position < end:
+        block = carry + export_file.read(min(SHARD_SCAN_SIZE, end - position))
+        block_start = position - len(carry)
+        position += len(block) - len(carry)
+        index = block.find(SHARD_BOUNDARY)
+
+        while index != -1 and index + 3 < len(block):
+            if block[index + 3:index + 4] != b'/':
+                return block_start + index + 1
+            index = block.find(SHARD_BOUNDARY, index + 1)
+
+        carry = block[-3:]
+
+    return end
+
+
+def export_shards(path, shard_size):
+    """Split the body of an export into byte ranges of whole elements.
+
+    Returns the prolog, everything up to and including the <HealthData>
+    start tag, and a list of (start, end) ranges that each begin at a top
+    level element. Wrapping a range in the prolog and a closing tag gives
+    a well formed document that parses to exactly the elements of that
+    range. None is returned when the file doesn't look like an Apple export
+    and can't be split safely.
+    """
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as export_file:
+        head = export_file.read(PROLOG_SCAN_SIZE)
+        root_start = head.find(ROOT_START_TAG)
+        if root_start == -1:
+            return None
+
+        prolog_end = head.find(b'>', root_start)
+        if prolog_end == -1:
+            return None
+        prolog = head[:prolog_end + 1]
+
+        export_file.seek(max(0, size - SHARD_SCAN_SIZE))
+        tail = export_file.read()
+        root_end = tail.rfind(ROOT_END_TAG)
+        if root_end == -1:
+            return None
+        body_end = size - len(tail) + root_end
+
+        shards = []
+        start = len(prolog)
+        while start < body_end:
+            end = find_shard_boundary(export_file, start + shard_size,
+                                      body_end)
+            shards.append((start, end))
+            start = end
+
+    return prolog, shards
+
+
+def iter_shard_elements(path, prolog, start, end, tags):
+    """Stream (tag, element) pairs out of one byte range of an export."""
+    with open(path, 'rb') as export_file:
+        export_file.seek(start)
+        body = export_file.read(end - start)
+
+    source = io.BytesIO(prolog + body + ROOT_END_TAG)
+    return iter_export_elements(source, tags)
+
+
+class ExportDirectory(object):
+    """An export that was unpacked into a directory.
+
+    Files are named by their path inside the export, like the
+    resourceFilePath of a ClinicalRecord or the path of a workout route's
+    FileReference.
+    """
+
+    unpacked = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def location(self, name):
+        return os.path.join(self.path, name.lstrip('/'))
+
+    def isfile(self, name):
+        return os.path.isfile(self.location(name))
+
+    def size(self, name):
+        return os.path.getsize(self.location(name))
+
+    def open(self, name):
+        return open(self.location(name), 'rb')
+
+    def fingerprint(self, name):
+        """Files on disk are fingerprinted by the import manifest."""
+        return None
+
+
+class ExportArchive(object):
+    """The export.zip written by the Health app, read without unpacking it.
+
+    Members are decompressed while they are read, so nothing is written
+    to disk. A member can't be read from an offset without decompressing
+    everything before it, which is why an archive is never parsed in
+    shards. The zip is opened again in every worker process it's sent to.
+    """
+
+    unpacked = False
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.archive = zipfile.ZipFile(self.path)
+        # The Health app puts everything into an apple_health_export folder
+        exports = sorted((name for name in self.archive.namelist()
+                          if name == EXPORT_XML
+                          or name.endswith('/' + EXPORT_XML)), key=len)
+        self.prefix = exports[0][:-len(EXPORT_XML)] if exports else None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['archive'] = None
+        return state
+
+    def member(self, name):
+        if self.archive is None:
+            self.archive = zipfile.ZipFile(self.path)
+
+        return self.archive.getinfo((self.prefix or '') + name.lstrip('/'))
+
+    def location(self, name):
+        return '%s!/%s' % (self.path, (self.prefix or '') + name.lstrip('/'))
+
+    def isfile(self, name):
+        try:
+            self.member(name)
+        except KeyError:
+            return False
+
+        return self.prefix is not None
+
+    def size(self, name):
+        return self.member(name).file_size
+
+    def open(self, name):
+        info = self.member(name)
+        return self.archive.open(info)
+
+    def fingerprint(self, name):
+        """Size, mtime and CRC-32 of a member, all read from the zip's
+        directory, so an unchanged member is recognized without reading it.
+        """
+        info = self.member(name)
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+
+        return info.file_size, mtime, 'crc32:%08x' % info.CRC
+
+
+def open_export(path):
+    """Return the export at ``path``.
+
+    ``path`` can be a directory with the unpacked export, a directory
+    holding export.zip instead, or the path of the zip itself. None is
+    returned when there is no export at all.
+    """
+    if os.path.isdir(path):
+        if not os.path.isfile(os.path.join(path, EXPORT_XML)) and \
+                zipfile.is_zipfile(os.path.join(path, EXPORT_ZIP)):
+            return ExportArchive(os.path.join(path, EXPORT_ZIP))
+
+        return ExportDirectory(path)
+
+    if zipfile.is_zipfile(path):
+        return ExportArchive(path)
+
+    return None
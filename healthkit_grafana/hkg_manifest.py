@@ -0,0 +1,54 @@
+import hashlib
+import os
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class ImportManifest(object):
+    """Size, mtime and content hash of every file that was imported.
+
+    ``changed`` compares a file against the entry stored by the last
+    successful import. A matching size and mtime is trusted without
+    reading the file; otherwise the content hash decides, so a file that
+    was only touched or copied is still recognized as unchanged. The new
+    fingerprints are kept in ``pending`` until the import succeeded and
+    they can be saved.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.pending = {}
+
+    def changed(self, path, fingerprint=None):
+        """``fingerprint`` is the (size, mtime, content hash) of a file
+        that isn't on disk by itself, like a member of export.zip.
+        """
+        path = os.path.abspath(path)
+        if fingerprint is None:
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+        else:
+            size, mtime, content_hash = fingerprint
+        entry = self.entries.get(path)
+
+        if entry is not None and entry[:2] == (size, mtime):
+            return False
+
+        if fingerprint is None:
+            content_hash = file_hash(path)
+        self.pending[path] = (size, mtime, content_hash)
+
+        return entry is None or entry[2] != content_hash
+
+    def rows(self):
+        return [(path,) + entry for path, entry in self.pending.items()]
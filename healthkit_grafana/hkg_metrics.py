@@ -0,0 +1,297 @@
+import collections
+import contextlib
+import cProfile
+import datetime
+import functools
+import io
+import json
+import math
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from healthkit_grafana import hkg_logger
+
+LOGGER = hkg_logger.LOGGER
+
+PROFILE_CPU = 'cpu'
+PROFILE_MEMORY = 'memory'
+PROFILE_TOP = 25
+METRIC_PREFIX = 'hkg_'
+
+# Help text of every metric in the Prometheus file
+METRIC_HELP = {
+    'phase': "Seconds spent in each phase of the import.",
+    'insert': "Seconds spent in each HKGDatabase insert method.",
+    'insert_rows': "Rows handed to each HKGDatabase insert method.",
+    'chunk': "Seconds per committed chunk of rows, by table.",
+    'commit': "Seconds per commit.",
+    'rows': "Rows sent to the database, by table.",
+    'bytes_sent': "Bytes of SQL and COPY data sent, by table.",
+    'round_trips': "Statements sent to the database, by table.",
+    'dedupe_hits': "Records dropped as duplicates, by table.",
+    'records_parsed': "Record elements read from export.xml, by kind.",
+    'invalid_records': "Records skipped for an invalid value.",
+    'import_start_time': "Unix time the last import started.",
+    'import_duration': "Seconds the last import took.",
+    'import_success': "1 if the last import loaded every table.",
+}
+
+
+class Metrics(object):
+    """Counters and timers of one import run.
+
+    Both are keyed by name and a sorted tuple of label pairs. Timers keep
+    the count, sum and maximum of their observations, which is what the
+    run report and a Prometheus summary need. Writer threads and table
+    loaders record concurrently, so every update holds the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.timers = {}
+        self.gauges = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+            self.gauges.clear()
+
+    def report(self):
+        """Return the metrics as a JSON friendly dict."""
+        def label_text(labels):
+            return ",".join("%s=%s" % label for label in labels) or 'all'
+
+        report = {'counters': {}, 'timers': {}, 'gauges': {}}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                report['counters'].setdefault(name, {})[
+                    label_text(labels)] = value
+            for (name, labels), (count, total, longest) in \
+                    sorted(self.timers.items()):
+                report['timers'].setdefault(name, {})[label_text(labels)] = {
+                    'count': count, 'seconds': round(total, 6),
+                    'max_seconds': round(longest, 6)}
+            for (name, labels), value in sorted(self.gauges.items()):
+                report['gauges'].setdefault(name, {})[
+                    label_text(labels)] = value
+
+        return report
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        def sample(name, labels, value):
+            label_list = ",".join(
+                '%s="%s"' % (key, str(label).replace('\\', '\\\\')
+                             .replace('"', '\\"'))
+                for key, label in labels)
+            return "%s%s %s\n" % (
+                name, "{%s}" % label_list if label_list else "",
+                prometheus_value(value))
+
+        def header(name, metric_type, help_name):
+            return "# HELP %s %s\n# TYPE %s %s\n" % (
+                name, METRIC_HELP.get(help_name, help_name), name,
+                metric_type)
+
+        lines = []
+        with self.lock:
+            counters = collections.defaultdict(list)
+            for (name, labels), value in sorted(self.counters.items()):
+                counters[name].append((labels, value))
+            for name, samples in counters.items():
+                metric = METRIC_PREFIX + name + '_total'
+                lines.append(header(metric, 'counter', name))
+                lines.extend(sample(metric, labels, value)
+                             for labels, value in samples)
+
+            timers = collections.defaultdict(list)
+            for (name, labels), values in sorted(self.timers.items()):
+                timers[name].append((labels, values))
+            for name, samples in timers.items():
+                metric = METRIC_PREFIX + name + '_seconds'
+                lines.append(header(metric, 'summary', name))
+                for labels, (count, total, longest) in samples:
+                    lines.append(sample(metric + '_sum', labels, total))
+                    lines.append(sample(metric + '_count', labels, count))
+                lines.append(header(metric + '_max', 'gauge', name))
+                lines.extend(sample(metric + '_max', labels, values[2])
+                             for labels, values in samples)
+
+            for (name, labels), value in sorted(self.gauges.items()):
+                metric = METRIC_PREFIX + name
+                lines.append(header(metric, 'gauge', name))
+                lines.append(sample(metric, labels, value))
+
+        return "".join(lines)
+
+
+METRICS = Metrics()
+
+
+def count(name, value=1, **labels):
+    METRICS.count(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    METRICS.observe(name, seconds, **labels)
+
+
+def phase_done(phase, start):
+    """Record the time since ``start``, a datetime, as a phase."""
+    METRICS.observe('phase', (datetime.datetime.now() - start)
+                    .total_seconds(), phase=phase)
+
+
+def timed_insert(method):
+    """Time an HKGDatabase insert method and count the rows it was given.
+
+    The rows are the method's last argument; generators aren't counted.
+    """
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            observe('insert', time.monotonic() - start,
+                    method=method.__name__)
+            if hasattr(args[-1], '__len__'):
+                count('insert_rows', len(args[-1]), method=method.__name__)
+
+    return timed
+
+
+class Profiler(object):
+    """The optional cProfile and tracemalloc capture of a run.
+
+    cProfile only sees the thread that started it, so the profile covers
+    parsing and everything the main thread writes, but not the writer
+    threads or table loaders.
+    """
+
+    def __init__(self, modes, profile_path):
+        self.modes = modes
+        self.profile_path = profile_path
+        self.profile = None
+
+    def start(self):
+        if PROFILE_MEMORY in self.modes:
+            tracemalloc.start()
+        if PROFILE_CPU in self.modes:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        """Stop profiling and return the summary for the run report."""
+        summary = {}
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.profile_path)
+            output = io.StringIO()
+            pstats.Stats(self.profile, stream=output).sort_stats(
+                'cumulative').print_stats(PROFILE_TOP)
+            summary['cpu'] = {'path': self.profile_path,
+                              'top': output.getvalue().splitlines()}
+            LOGGER.info("Wrote the CPU profile to %s." % self.profile_path)
+
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            summary['memory'] = {
+                'current_bytes': current,
+                'peak_bytes': peak,
+                'top': [str(statistic) for statistic in
+                        snapshot.statistics('lineno')[:PROFILE_TOP]],
+            }
+
+        return summary
+
+
+def prometheus_value(value):
+    """Format a sample value the way the exposition format spells it."""
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def write_file(path, text):
+    """Replace ``path`` in one step so readers never see half a file."""
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as output:
+        output.write(text)
+    os.replace(temporary_path, path)
+
+
+@contextlib.contextmanager
+def import_run(report_path=None, prometheus_path=None, profile_modes=(),
+               profile_path=None):
+    """Collect the metrics of one import and write them when it ends.
+
+    The JSON run report and the Prometheus file are written however the
+    import ends, including when it raises, with ``status`` telling
+    whether it finished. The caller sets the ``import_success`` gauge.
+    The metrics of an earlier import in the same process are dropped.
+    """
+    profiler = Profiler(profile_modes, profile_path) if profile_modes \
+        else None
+    started = datetime.datetime.now(datetime.timezone.utc)
+    status = 'failed'
+
+    METRICS.clear()
+    METRICS.set('import_start_time', started.timestamp())
+    if profiler:
+        profiler.start()
+
+    try:
+        yield METRICS
+        status = 'finished'
+    finally:
+        finished = datetime.datetime.now(datetime.timezone.utc)
+        seconds = (finished - started).total_seconds()
+        METRICS.set('import_duration', seconds)
+        profile = profiler.stop() if profiler else None
+
+        try:
+            if report_path:
+                report = {'started': started.isoformat(),
+                          'finished': finished.isoformat(),
+                          'seconds': seconds, 'status': status}
+                report.update(METRICS.report())
+                if profile:
+                    report['profile'] = profile
+                write_file(report_path, json.dumps(report, indent=2))
+                LOGGER.info("Wrote the run report to %s." % report_path)
+
+            if prometheus_path:
+                write_file(prometheus_path, METRICS.prometheus())
+        except OSError as ex:
+            LOGGER.error("Couldn't write the import metrics: %s" % ex)
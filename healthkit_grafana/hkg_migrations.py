@@ -0,0 +1,382 @@
+import psycopg2
+from healthkit_grafana import hkg_logger
+
+LOGGER = hkg_logger.LOGGER
+
+SCHEMA_VERSION_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS public.hkg_schema_version
+    (
+        version integer NOT NULL,
+        description text NOT NULL,
+        applied_at timestamp with time zone NOT NULL DEFAULT now(),
+        CONSTRAINT hkg_schema_version_pkey PRIMARY KEY (version)
+    );
+"""
+
+LOOKUP_TABLES_SQL = """
+    CREATE TABLE IF NOT EXISTS public.hk_source
+    (
+        source_id serial NOT NULL,
+        source_name text NOT NULL,
+        CONSTRAINT hk_source_pkey PRIMARY KEY (source_id),
+        CONSTRAINT hk_source_unique UNIQUE (source_name)
+    );
+
+    CREATE TABLE IF NOT EXISTS public.hk_device
+    (
+        device_id serial NOT NULL,
+        device text NOT NULL,
+        CONSTRAINT hk_device_pkey PRIMARY KEY (device_id),
+        CONSTRAINT hk_device_unique UNIQUE (device)
+    );
+"""
+
+RECORD_VIEW_SQL = """
+    CREATE VIEW public.%(view)s AS
+    SELECT r.record_id, r.person_id, r.hk_type, s.source_name AS hk_source,
+           r.source_version, d.device, r.creation_date, r.start_date,
+           r.end_date, r.unit, r.hk_value
+    FROM public.%(table)s r
+    JOIN public.hk_source s ON s.source_id = r.source_id
+    LEFT JOIN public.hk_device d ON d.device_id = r.device_id;
+"""
+
+# Moves the rows of a record table into a table that stores source and
+# device ids and replaces the old table with a view of the same name and
+# columns, so dashboards and ad hoc queries keep working unchanged.
+ENCODE_RECORD_TABLE_SQL = """
+    CREATE TABLE public.%(table)s
+    (
+        record_id serial NOT NULL,
+        person_id integer NOT NULL,
+        hk_type text NOT NULL,
+        source_id integer NOT NULL,
+        source_version text,
+        device_id integer,
+        creation_date timestamp with time zone,
+        start_date timestamp with time zone NOT NULL,
+        end_date timestamp with time zone NOT NULL,
+        unit text,
+        hk_value %(value_type)s,
+        CONSTRAINT %(table)s_pkey PRIMARY KEY (record_id),
+        CONSTRAINT %(table)s_person_id_fkey FOREIGN KEY (person_id)
+            REFERENCES public.hk_person (person_id),
+        CONSTRAINT %(table)s_source_id_fkey FOREIGN KEY (source_id)
+            REFERENCES public.hk_source (source_id),
+        CONSTRAINT %(table)s_device_id_fkey FOREIGN KEY (device_id)
+            REFERENCES public.hk_device (device_id),
+        CONSTRAINT %(table)s_unique
+            UNIQUE (person_id, hk_type, source_id, start_date, end_date)
+    );
+
+    INSERT INTO public.hk_source (source_name)
+    SELECT DISTINCT hk_source FROM public.%(view)s
+    ON CONFLICT DO NOTHING;
+
+    INSERT INTO public.hk_device (device)
+    SELECT DISTINCT device FROM public.%(view)s WHERE device IS NOT NULL
+    ON CONFLICT DO NOTHING;
+
+    INSERT INTO public.%(table)s (
+        record_id, person_id, hk_type, source_id, source_version, device_id,
+        creation_date, start_date, end_date, unit, hk_value)
+    SELECT r.record_id, r.person_id, r.hk_type, s.source_id,
+           r.source_version, d.device_id, r.creation_date, r.start_date,
+           r.end_date, r.unit, r.hk_value
+    FROM public.%(view)s r
+    JOIN public.hk_source s ON s.source_name = r.hk_source
+    LEFT JOIN public.hk_device d ON d.device = r.device;
+
+    SELECT setval(pg_get_serial_sequence('public.%(table)s', 'record_id'),
+                  coalesce(max(record_id), 0) + 1, false)
+    FROM public.%(table)s;
+
+    DROP TABLE public.%(view)s;
+""" + RECORD_VIEW_SQL
+
+# Hourly count/sum/min/max of every quantity series. Buckets are UTC hours,
+# which the dashboards group into the days of any timezone with a whole hour
+# offset.
+ROLLUP_TABLE_SQL = """
+    CREATE TABLE public.hk_quantity_hour
+    (
+        person_id integer NOT NULL,
+        hk_type text NOT NULL,
+        source_id integer NOT NULL,
+        bucket timestamp with time zone NOT NULL,
+        sample_count bigint NOT NULL,
+        value_sum double precision,
+        value_min double precision,
+        value_max double precision,
+        CONSTRAINT hk_quantity_hour_pkey
+            PRIMARY KEY (person_id, hk_type, source_id, bucket)
+    );
+
+    CREATE INDEX hk_quantity_hour_type_bucket_idx
+        ON public.hk_quantity_hour (hk_type, bucket);
+
+    CREATE VIEW public.hk_quantity_hourly AS
+    SELECT r.person_id, r.hk_type, s.source_name AS hk_source,
+           r.bucket AS start_date, r.sample_count, r.value_sum AS hk_sum,
+           r.value_min AS hk_min, r.value_max AS hk_max,
+           r.value_sum / r.sample_count AS hk_avg
+    FROM public.hk_quantity_hour r
+    JOIN public.hk_source s ON s.source_id = r.source_id;
+"""
+
+ROLLUP_BACKFILL_SQL = """
+    INSERT INTO public.hk_quantity_hour
+    SELECT person_id, hk_type, source_id,
+           date_trunc('hour', start_date AT TIME ZONE 'UTC')
+               AT TIME ZONE 'UTC',
+           count(*), sum(hk_value), min(hk_value), max(hk_value)
+    FROM public.hk_quantity_sample
+    GROUP BY 1, 2, 3, 4;
+"""
+
+# Replaces hk_quantity_sample by a table partitioned by the year of
+# start_date, so a dashboard's time range only scans the years it shows.
+# Partitions are yearly UTC ranges named hk_quantity_sample_<year>; the
+# importer creates the ones new records need. The primary key has to
+# include the partition key, the unique constraint already does.
+PARTITION_QUANTITY_SQL = """
+    DROP VIEW public.hk_quantity_record;
+
+    ALTER TABLE public.hk_quantity_sample
+        RENAME TO hk_quantity_sample_unpartitioned;
+    ALTER TABLE public.hk_quantity_sample_unpartitioned
+        RENAME CONSTRAINT hk_quantity_sample_pkey
+        TO hk_quantity_sample_unpartitioned_pkey;
+    ALTER TABLE public.hk_quantity_sample_unpartitioned
+        RENAME CONSTRAINT hk_quantity_sample_unique
+        TO hk_quantity_sample_unpartitioned_unique;
+
+    CREATE TABLE public.hk_quantity_sample
+    (
+        record_id integer NOT NULL
+            DEFAULT nextval('public.hk_quantity_sample_record_id_seq'),
+        person_id integer NOT NULL,
+        hk_type text NOT NULL,
+        source_id integer NOT NULL,
+        source_version text,
+        device_id integer,
+        creation_date timestamp with time zone,
+        start_date timestamp with time zone NOT NULL,
+        end_date timestamp with time zone NOT NULL,
+        unit text,
+        hk_value double precision,
+        CONSTRAINT hk_quantity_sample_pkey PRIMARY KEY (record_id, start_date),
+        CONSTRAINT hk_quantity_sample_person_id_fkey FOREIGN KEY (person_id)
+            REFERENCES public.hk_person (person_id),
+        CONSTRAINT hk_quantity_sample_source_id_fkey FOREIGN KEY (source_id)
+            REFERENCES public.hk_source (source_id),
+        CONSTRAINT hk_quantity_sample_device_id_fkey FOREIGN KEY (device_id)
+            REFERENCES public.hk_device (device_id),
+        CONSTRAINT hk_quantity_sample_unique
+            UNIQUE (person_id, hk_type, source_id, start_date, end_date)
+    ) PARTITION BY RANGE (start_date);
+
+    ALTER SEQUENCE public.hk_quantity_sample_record_id_seq
+        OWNED BY public.hk_quantity_sample.record_id;
+
+    DO $$
+    DECLARE
+        partition_year integer;
+    BEGIN
+        FOR partition_year IN
+            SELECT DISTINCT extract(year FROM start_date AT TIME ZONE 'UTC')
+            FROM public.hk_quantity_sample_unpartitioned
+        LOOP
+            EXECUTE format(
+                'CREATE TABLE public.%I PARTITION OF '
+                'public.hk_quantity_sample FOR VALUES FROM (%L) TO (%L)',
+                'hk_quantity_sample_' || partition_year,
+                partition_year || '-01-01 00:00:00+00',
+                partition_year + 1 || '-01-01 00:00:00+00');
+        END LOOP;
+    END
+    $$;
+
+    INSERT INTO public.hk_quantity_sample (
+        record_id, person_id, hk_type, source_id, source_version, device_id,
+        creation_date, start_date, end_date, unit, hk_value)
+    SELECT record_id, person_id, hk_type, source_id, source_version,
+           device_id, creation_date, start_date, end_date, unit, hk_value
+    FROM public.hk_quantity_sample_unpartitioned;
+
+    DROP TABLE public.hk_quantity_sample_unpartitioned;
+
+    CREATE INDEX hk_quantity_sample_type_start_idx
+        ON public.hk_quantity_sample (hk_type, start_date);
+    CREATE INDEX hk_quantity_sample_start_brin
+        ON public.hk_quantity_sample USING brin (start_date);
+
+    CREATE INDEX hk_category_sample_type_start_idx
+        ON public.hk_category_sample (hk_type, start_date);
+""" + RECORD_VIEW_SQL % {'table': 'hk_quantity_sample',
+                         'view': 'hk_quantity_record'}
+
+ROUTE_POINT_TABLE_SQL = """
+    CREATE TABLE public.hk_workout_route_point
+    (
+        workout_id integer NOT NULL,
+        point_time timestamp with time zone NOT NULL,
+        latitude double precision NOT NULL,
+        longitude double precision NOT NULL,
+        elevation double precision,
+        speed double precision,
+        course double precision,
+        horizontal_accuracy double precision,
+        vertical_accuracy double precision,
+        CONSTRAINT hk_workout_route_point_pkey
+            PRIMARY KEY (workout_id, point_time),
+        CONSTRAINT hk_workout_route_point_workout_id_fkey
+            FOREIGN KEY (workout_id)
+            REFERENCES public.hk_workout (workout_id)
+    );
+"""
+
+# The tables that were only ever written for the default person get its
+# id, the keys of workouts and activity summaries are made per person.
+# hk_person is matched by name, the date of birth comes from <Me> later.
+PERSON_COLUMNS_SQL = """
+    ALTER TABLE public.hk_person ALTER COLUMN dob DROP NOT NULL;
+
+    ALTER TABLE public.hk_workout
+        ADD COLUMN person_id integer NOT NULL DEFAULT 1,
+        ADD CONSTRAINT hk_workout_person_id_fkey FOREIGN KEY (person_id)
+            REFERENCES public.hk_person (person_id),
+        DROP CONSTRAINT hk_workout_unique,
+        ADD CONSTRAINT hk_workout_unique UNIQUE (person_id,
+            workout_activity_type, source_name, start_date, end_date);
+    ALTER TABLE public.hk_workout ALTER COLUMN person_id DROP DEFAULT;
+
+    ALTER TABLE public.hk_activity_summary
+        ADD COLUMN person_id integer NOT NULL DEFAULT 1,
+        ADD CONSTRAINT hk_activity_summary_person_id_fkey
+            FOREIGN KEY (person_id) REFERENCES public.hk_person (person_id),
+        DROP CONSTRAINT hk_activity_summary_pkey,
+        ADD CONSTRAINT hk_activity_summary_pkey
+            PRIMARY KEY (person_id, summary_date);
+    ALTER TABLE public.hk_activity_summary
+        ALTER COLUMN person_id DROP DEFAULT;
+
+    ALTER TABLE public.hk_clinical_record
+        ADD COLUMN person_id integer NOT NULL DEFAULT 1,
+        ADD CONSTRAINT hk_clinical_record_person_id_fkey
+            FOREIGN KEY (person_id) REFERENCES public.hk_person (person_id);
+    ALTER TABLE public.hk_clinical_record
+        ALTER COLUMN person_id DROP DEFAULT;
+"""
+
+RECORD_CHILD_TABLES_SQL = """
+    CREATE TABLE public.hk_record_metadata
+    (
+        person_id integer NOT NULL,
+        hk_type text NOT NULL,
+        source_id integer NOT NULL,
+        start_date timestamp with time zone NOT NULL,
+        end_date timestamp with time zone NOT NULL,
+        meta_key text NOT NULL,
+        meta_value text,
+        CONSTRAINT hk_record_metadata_pkey PRIMARY KEY (person_id, hk_type,
+            source_id, start_date, end_date, meta_key),
+        CONSTRAINT hk_record_metadata_person_id_fkey FOREIGN KEY (person_id)
+            REFERENCES public.hk_person (person_id),
+        CONSTRAINT hk_record_metadata_source_id_fkey FOREIGN KEY (source_id)
+            REFERENCES public.hk_source (source_id)
+    );
+
+    CREATE TABLE public.hk_heart_beat
+    (
+        person_id integer NOT NULL,
+        source_id integer NOT NULL,
+        record_start timestamp with time zone NOT NULL,
+        beat_time timestamp with time zone NOT NULL,
+        bpm integer NOT NULL,
+        CONSTRAINT hk_heart_beat_pkey
+            PRIMARY KEY (person_id, source_id, beat_time),
+        CONSTRAINT hk_heart_beat_person_id_fkey FOREIGN KEY (person_id)
+            REFERENCES public.hk_person (person_id),
+        CONSTRAINT hk_heart_beat_source_id_fkey FOREIGN KEY (source_id)
+            REFERENCES public.hk_source (source_id)
+    );
+"""
+
+MIGRATIONS = [
+    (1, "Store record sources and devices in lookup tables",
+     LOOKUP_TABLES_SQL +
+     ENCODE_RECORD_TABLE_SQL % {'table': 'hk_quantity_sample',
+                                'view': 'hk_quantity_record',
+                                'value_type': 'double precision'} +
+     ENCODE_RECORD_TABLE_SQL % {'table': 'hk_category_sample',
+                                'view': 'hk_category_record',
+                                'value_type': 'text'},
+     None),
+    (2, "Add hourly rollups of the quantity records",
+     ROLLUP_TABLE_SQL + ROLLUP_BACKFILL_SQL,
+     None),
+    # Keys and foreign keys on partitioned tables need PostgreSQL 11. The
+    # migrations after it are applied on older servers as well, so they
+    # must work on the unpartitioned hk_quantity_sample too.
+    (3, "Partition the quantity records by year and index type and date",
+     PARTITION_QUANTITY_SQL,
+     110000),
+    (4, "Add the track points of workout routes",
+     ROUTE_POINT_TABLE_SQL,
+     None),
+    (5, "Add the person to workouts, activity summaries and clinical records",
+     PERSON_COLUMNS_SQL,
+     None),
+    (6, "Add the metadata of records and the beats of HRV measurements",
+     RECORD_CHILD_TABLES_SQL,
+     None),
+]
+
+
+def migrate(database):
+    """Bring the schema created by create-tables.sh up to date.
+
+    Every migration that isn't recorded in hkg_schema_version yet runs in
+    its own transaction together with the row that records it, so a
+    failed migration leaves the schema as it was and is retried by the
+    next run. A migration that needs a newer PostgreSQL than the server
+    is skipped until the server is upgraded, the ones after it don't
+    depend on it and are applied anyway.
+    """
+    connection = database.connection
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute(SCHEMA_VERSION_TABLE_SQL)
+        cursor.execute("SELECT version FROM public.hkg_schema_version;")
+        applied = {row[0] for row in cursor.fetchall()}
+        connection.commit()
+
+        for version, description, sql, server_version in MIGRATIONS:
+            if version in applied:
+                continue
+
+            if server_version and connection.server_version < server_version:
+                LOGGER.warning("Schema version %s needs PostgreSQL %s or "
+                               "newer, the import continues without it."
+                               % (version, server_version // 10000))
+                continue
+
+            LOGGER.info("Migrating the schema to version %s: %s"
+                        % (version, description))
+            cursor.execute(sql)
+            cursor.execute(
+                "INSERT INTO public.hkg_schema_version "
+                "(version, description) VALUES (%s, %s);",
+                (version, description))
+            connection.commit()
+    except (Exception, psycopg2.Error) as error_ex:
+        LOGGER.error("Error migrating the schema.")
+        LOGGER.error("Error: " + str(error_ex))
+        database.rollback()
+        return False
+    finally:
+        cursor.close()
+
+    return True
@@ -0,0 +1,113 @@
+import queue
+import threading
+from healthkit_grafana import hkg_logger
+
+LOGGER = hkg_logger.LOGGER
+
+
+class WriterPool(object):
+    """Writes batches to the database on background threads.
+
+    The importer keeps parsing while the batches it already handed over
+    are written. Every writer thread holds one pooled connection of the
+    database for as long as it runs, since a psycopg2 connection can only
+    run one transaction at a time, and psycopg2 releases the GIL while it
+    waits on the server. The queue is bounded, so ``submit`` blocks once
+    the writers fall behind instead of letting parsed rows pile up in
+    memory.
+
+    A write is a callable that takes the writer's database and returns
+    whether it succeeded. Writes that depend on each other are submitted
+    as one callable so they run in order on the same connection. A failed
+    write marks its table as failed and the other tables keep loading.
+    """
+
+    def __init__(self, database, writers, queue_size):
+        self.database = database
+        # Connect in the caller's thread so a failed connect is raised there
+        self.databases = [database.acquire() for _ in range(writers)]
+        self.writes = queue.Queue(queue_size)
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.threads = []
+
+        for number, database in enumerate(self.databases):
+            thread = threading.Thread(target=self.run, args=(database,),
+                                      name='hkg-writer-%s' % number,
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self, database):
+        while True:
+            write = self.writes.get()
+            if write is None:
+                self.writes.task_done()
+                break
+
+            table, write_batch = write
+            try:
+                # noinspection PyBroadException
+                try:
+                    written = write_batch(database)
+                except Exception as ex:
+                    LOGGER.error("Writing a batch of %s failed: %s"
+                                 % (table, ex))
+                    database.rollback()
+                    written = False
+
+                if not written:
+                    with self.lock:
+                        self.failed.add(table)
+                    self.restore(database)
+            finally:
+                # Anything else would leave drain() and close() waiting
+                self.writes.task_done()
+
+    def restore(self, database):
+        """Reconnect a writer whose connection was lost, so the batches
+        after a failed one aren't written to a dead connection."""
+        # noinspection PyBroadException
+        try:
+            database.reconnect()
+        except Exception as ex:
+            LOGGER.error("Couldn't reconnect a database writer: %s" % ex)
+
+    def submit(self, table, write_batch):
+        """Queue a write, blocking while the queue is full.
+
+        Returns False once a write of ``table`` failed, so its sink ends
+        failed as well.
+        """
+        self.writes.put((table, write_batch))
+        with self.lock:
+            return table not in self.failed
+
+    def writer(self, table, method):
+        """Return a flush callable that queues rows for an insert method."""
+        def write_rows(rows):
+            return self.submit(
+                table, lambda database: getattr(database, method)(rows))
+
+        return write_rows
+
+    def drain(self):
+        """Wait until every queued write is done and return the tables that
+        failed so far. Writes can be submitted again afterwards."""
+        self.writes.join()
+
+        with self.lock:
+            return set(self.failed)
+
+    def close(self):
+        """Wait for every queued write and return the tables that failed."""
+        for _ in self.threads:
+            self.writes.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        for database in self.databases:
+            self.database.release(database)
+
+        return self.failed
@@ -0,0 +1,606 @@
+import collections
+import datetime
+import hashlib
+import logging
+import sys
+from healthkit_grafana import hkg_logger
+from healthkit_grafana import hkg_metrics
+
+LOGGER = hkg_logger.LOGGER
+
+QUANTITY_PREFIX = 'HKQuantityTypeIdentifier'
+CATEGORY_PREFIX = 'HKCategoryTypeIdentifier'
+DATA_TYPE_PREFIX = 'HKDataType'
+
+QUANTITY = 'quantity'
+CATEGORY = 'category'
+METADATA = 'metadata'
+HEART_BEAT = 'heart_beat'
+OTHER = 'other'
+
+METADATA_TAG = 'MetadataEntry'
+HEART_BEAT_LIST_TAG = 'HeartRateVariabilityMetadataList'
+HEART_BEAT_TYPE = 'InstantaneousBeatsPerMinute'
+ONE_DAY = datetime.timedelta(days=1)
+HALF_DAY = datetime.timedelta(hours=12)
+
+# e.g. 2021-03-01 08:00:00 -0500
+EXPORT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S %z'
+EXPORT_DATE_LENGTH = len('2021-03-01 08:00:00 -0500')
+
+TIMEZONES = {}
+
+
+def export_timezone(offset):
+    """Return the timezone of a +hhmm offset, built once per offset."""
+    timezone = TIMEZONES.get(offset)
+
+    if timezone is None:
+        delta = datetime.timedelta(hours=int(offset[1:3]),
+                                   minutes=int(offset[3:5]))
+        if offset[0] == '-':
+            delta = -delta
+        elif offset[0] != '+':
+            raise ValueError("Invalid UTC offset %s" % offset)
+
+        timezone = datetime.timezone(delta)
+        TIMEZONES[offset] = timezone
+
+    return timezone
+
+
+def parse_export_date(value):
+    """Parse a date of the export into an aware datetime.
+
+    Every date in export.xml has the same fixed width layout, so slicing
+    it is several times faster than strptime. Anything else still goes
+    through strptime.
+    """
+    if len(value) != EXPORT_DATE_LENGTH or value[19] != ' ':
+        return datetime.datetime.strptime(value, EXPORT_DATE_FORMAT)
+
+    return datetime.datetime(int(value[0:4]), int(value[5:7]),
+                             int(value[8:10]), int(value[11:13]),
+                             int(value[14:16]), int(value[17:19]),
+                             tzinfo=export_timezone(value[20:]))
+
+
+def record_dates(attributes):
+    """Return the creation, start and end dates of a Record.
+
+    Instantaneous samples share one timestamp for all three, so a date
+    equal to the one before it is not parsed again.
+    """
+    start_value = attributes.get('startDate', '')
+    end_value = attributes.get('endDate', '')
+    creation_value = attributes.get('creationDate')
+
+    start = parse_export_date(start_value)
+    end = start if end_value == start_value else parse_export_date(end_value)
+
+    if not creation_value:
+        creation = None
+    elif creation_value == start_value:
+        creation = start
+    elif creation_value == end_value:
+        creation = end
+    else:
+        creation = parse_export_date(creation_value)
+
+    return creation, start, end
+
+
+def optional_value(value, convert):
+    """Convert an attribute value, an empty or missing one becomes None."""
+    if not value:
+        return None
+
+    return convert(value)
+
+
+def interned(attributes, name):
+    """Return an attribute value shared with every equal value.
+
+    Sources, versions, devices and units repeat on nearly every record,
+    so a batch holds one copy of each instead of one per row.
+    """
+    return sys.intern(attributes.get(name, ''))
+
+
+def classify_record_type(record_type):
+    """Return the kind of a Record type and the hk_type stored for it.
+
+    Types registered by name win over the prefixes, which are tried in
+    the order they were registered.
+    """
+    route = RECORD_TYPES.get(record_type)
+    if route is not None:
+        return route
+
+    for prefix, kind, strip_prefix in TYPE_PREFIXES:
+        if record_type.startswith(prefix):
+            return kind, record_type.removeprefix(prefix) \
+                if strip_prefix else record_type
+
+    return OTHER, record_type
+
+
+def quantity_record(person_id, hk_type, record):
+    attributes = record.attrib
+    value = attributes.get('value')
+    value = float(value) if value else 0.0
+
+    creation_date, start_date, end_date = record_dates(attributes)
+
+    return (
+        person_id,
+        hk_type,
+        interned(attributes, 'sourceName'),
+        interned(attributes, 'sourceVersion'),
+        interned(attributes, 'device'),
+        creation_date,
+        start_date,
+        end_date,
+        interned(attributes, 'unit'),
+        value
+    )
+
+
+def category_record(person_id, hk_type, record):
+    attributes = record.attrib
+    value = attributes.get('value')
+    value = sys.intern(value) if value else "Not Set"
+
+    creation_date, start_date, end_date = record_dates(attributes)
+
+    return (
+        person_id,
+        hk_type,
+        interned(attributes, 'sourceName'),
+        interned(attributes, 'sourceVersion'),
+        interned(attributes, 'device'),
+        creation_date,
+        start_date,
+        end_date,
+        interned(attributes, 'unit'),
+        value
+    )
+
+
+def record_metadata(row, entry):
+    """Return the row of a MetadataEntry of a Record.
+
+    Rows are (person_id, hk_type, source, start_date, end_date, key,
+    value), tied to their Record by its natural key.
+    """
+    return [(row[0], row[1], row[2], row[6], row[7],
+             interned(entry.attrib, 'key'), entry.get('value'))]
+
+
+def beat_clock(value):
+    """Return the time of day of an InstantaneousBeatsPerMinute.
+
+    The iPhone writes it in its locale, e.g. 8:02:03.45 PM or
+    20:02:03,45, without a date.
+    """
+    clock, _, meridiem = value.partition(' ')
+    hours, minutes, seconds = clock.split(':')
+    hours = int(hours)
+    if meridiem:
+        hours = hours % 12 + (12 if meridiem.upper() == 'PM' else 0)
+
+    return datetime.timedelta(hours=hours, minutes=int(minutes),
+                              seconds=float(seconds.replace(',', '.')))
+
+
+def heart_beats(row, beat_list):
+    """Return the rows of the beat to beat heart rates of an HRV Record.
+
+    Rows are (person_id, source, record start, beat time, bpm). The time
+    of a beat is put on the day of the Record's start, in its timezone,
+    or on the next day when the measurement ran over midnight.
+    """
+    start = row[6]
+    midnight = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    beats = []
+
+    for beat in beat_list:
+        beat_time = midnight + beat_clock(beat.get('time', ''))
+        if beat_time < start - HALF_DAY:
+            beat_time += ONE_DAY
+        beats.append((row[0], row[2], start, beat_time,
+                      int(beat.get('bpm', ''))))
+
+    return beats
+
+
+def record_key(row):
+    """The natural key of a record row, as in the record tables' unique
+    constraints: person, type, source, start and end date.
+    """
+    return row[0], row[1], row[2], row[6], row[7]
+
+
+def metadata_key(row):
+    return row[:6]
+
+
+def heart_beat_key(row):
+    return row[0], HEART_BEAT_TYPE, row[1], row[3]
+
+
+# Extractors of the rows of Records by kind, called with the person id,
+# the hk_type and the Record element.
+EXTRACTORS = {
+    QUANTITY: quantity_record,
+    CATEGORY: category_record,
+}
+# (prefix, kind, whether the prefix is dropped from the hk_type) of the
+# Record types every kind is made of
+TYPE_PREFIXES = [
+    (QUANTITY_PREFIX, QUANTITY, True),
+    (CATEGORY_PREFIX, CATEGORY, False),
+    # Settings like the sleep goal, a number as well. They keep the prefix
+    # so they can't collide with the name of a quantity type.
+    (DATA_TYPE_PREFIX, QUANTITY, False),
+]
+# (kind, hk_type) of Record types that are routed by their full name
+RECORD_TYPES = {}
+# (kind, extractor) of the child elements of a Record by tag. Extractors
+# are called with the row of the Record and the child element and return
+# a list of rows.
+CHILD_EXTRACTORS = {
+    METADATA_TAG: (METADATA, record_metadata),
+    HEART_BEAT_LIST_TAG: (HEART_BEAT, heart_beats),
+}
+# The natural key of the rows of every kind, (person_id, hk_type, source,
+# date, ...). Rows with the same key are duplicates and the date is what
+# high-water marks and rollup ranges go by.
+ROW_KEYS = {
+    QUANTITY: record_key,
+    CATEGORY: record_key,
+    METADATA: metadata_key,
+    HEART_BEAT: heart_beat_key,
+}
+
+
+def register_record_type(kind, extractor, key=record_key, record_type=None,
+                         prefix=None, strip_prefix=False):
+    """Route the Records of a type, or of every type starting with
+    ``prefix``, to ``extractor`` as rows of ``kind``.
+
+    Registries are read by the parse worker processes as well, so
+    handlers have to be registered when their module is imported.
+    """
+    EXTRACTORS[kind] = extractor
+    ROW_KEYS[kind] = key
+    if record_type is not None:
+        RECORD_TYPES[record_type] = (kind, record_type.removeprefix(prefix)
+                                     if prefix and strip_prefix
+                                     else record_type)
+    elif prefix is not None:
+        TYPE_PREFIXES.append((prefix, kind, strip_prefix))
+
+
+def register_child(tag, kind, extractor, key):
+    """Turn the ``tag`` children of every Record into rows of ``kind``."""
+    CHILD_EXTRACTORS[tag] = (kind, extractor)
+    ROW_KEYS[kind] = key
+
+
+class HighWaterMarks(object):
+    """The newest date imported so far for every series of rows.
+
+    A series is keyed by (person_id, table_name, hk_type, hk_source).
+    ``is_new`` rejects rows dated at or below the mark loaded from the
+    database and remembers the newest date it let through, so the marks
+    can be advanced once the import has succeeded. Rows that can still
+    change after they were first exported, like the activity summary of
+    the export day, pass ``reload_mark=True`` so the row at the mark is
+    imported again.
+    """
+
+    def __init__(self, marks):
+        self.marks = marks
+        self.newest = {}
+        self.skipped = collections.Counter()
+
+    def is_new(self, key, date, reload_mark=False):
+        mark = self.marks.get(key)
+
+        if mark is not None and (date < mark or
+                                 date == mark and not reload_mark):
+            self.skipped[key[1]] += 1
+            return False
+
+        newest = self.newest.get(key)
+        if newest is None or date > newest:
+            self.newest[key] = date
+
+        return True
+
+    def digest(self, person_id):
+        """Return a digest of the marks of a person loaded from the
+        database, which decide the rows an incremental import accepts."""
+        marks = sorted((key, date.isoformat())
+                       for key, date in self.marks.items()
+                       if key[0] == person_id)
+        return hashlib.sha1(repr(marks).encode()).hexdigest()
+
+    def advanced(self, tables):
+        """Return the marks of the given tables that moved forward."""
+        return [key + (date,) for key, date in self.newest.items()
+                if key[1] in tables]
+
+
+class DateRanges(object):
+    """The earliest and latest start date imported for every series.
+
+    Series are keyed by (person_id, hk_type). The ranges tell which part
+    of the rollups has to be recomputed after an import.
+    """
+
+    def __init__(self):
+        self.ranges = {}
+
+    def add(self, key, date):
+        date_range = self.ranges.get(key)
+
+        if date_range is None:
+            self.ranges[key] = [date, date]
+        elif date < date_range[0]:
+            date_range[0] = date
+        elif date > date_range[1]:
+            date_range[1] = date
+
+
+class RecordSink(object):
+    """Collects the rows bound for one table and flushes them in batches.
+
+    Rows are deduplicated on the table's unique constraint before they are
+    handed to ``flush``. This is ugly but... My data has records where
+    type, source, start, and end dates are all the same and the create
+    date is seconds off. Since I can only depend on those 4 items being
+    present those are the unique constraints on the db. The other option
+    (and this may be valid) is to do nothing on conflict vs update the
+    other fields.
+
+    Only the hash of each key is remembered, so flushed rows can be freed
+    and the index costs a small, fixed amount per row no matter how long
+    the source and device strings are. The first row of every key is
+    kept for the duplicate report only when debug logging is on.
+
+    The first ``resume_rows`` rows the sink accepts were committed by an
+    interrupted run of the same export, they are counted but not written.
+
+    ``key`` returns the natural key of a row, see ROW_KEYS. Its first
+    three items name the series for the high-water marks and the fourth
+    is the date they go by.
+    """
+
+    def __init__(self, table, flush, batch_size, watermarks=None,
+                 date_ranges=None, resume_rows=0, key=record_key):
+        self.table = table
+        self.key = key
+        self.flush_rows = flush
+        self.batch_size = batch_size
+        self.watermarks = watermarks
+        self.date_ranges = date_ranges
+        self.rows = []
+        self.seen = set()
+        self.first_rows = {} if LOGGER.isEnabledFor(logging.DEBUG) else None
+        self.row_count = 0
+        self.resume_rows = resume_rows
+        self.duplicate_count = 0
+        self.failed = False
+
+    def add(self, row):
+        row_key = self.key(row)
+        if self.watermarks is not None and not self.watermarks.is_new(
+                (row_key[0], self.table, row_key[1], row_key[2]),
+                row_key[3]):
+            return
+
+        key = hash(row_key)
+
+        if key in self.seen:
+            self.duplicate_count += 1
+            if self.first_rows is not None:
+                LOGGER.debug("Found duplicate records: %s"
+                             % ([self.first_rows[key], row], ))
+            return
+
+        self.seen.add(key)
+        if self.first_rows is not None:
+            self.first_rows[key] = row
+
+        if self.date_ranges is not None:
+            self.date_ranges.add(row_key[:2], row_key[3])
+
+        self.row_count += 1
+        if self.row_count <= self.resume_rows:
+            return
+
+        self.rows.append(row)
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            if not self.flush_rows(self.rows):
+                self.failed = True
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        LOGGER.info("Found %s %s records and %s duplicates."
+                    % (self.row_count, self.table, self.duplicate_count))
+        if self.resume_rows:
+            LOGGER.info("Skipped the first %s %s records, an earlier run "
+                        "already committed them."
+                        % (min(self.resume_rows, self.row_count), self.table))
+        hkg_metrics.count('dedupe_hits', self.duplicate_count,
+                          table=self.table)
+        return not self.failed
+
+
+class RecordRouter(object):
+    """Classifies every Record exactly once and routes it to a sink.
+
+    The classification of each distinct type string is cached, so the
+    prefix checks run once per type instead of once per record. Child
+    elements of a Record, like its MetadataEntry, are routed by their tag
+    through CHILD_EXTRACTORS, a single lookup each. Records
+    whose kind has no sink are counted and reported when the router is
+    closed instead of being silently dropped. Records with a value that
+    can't be converted, like a malformed date, are logged and skipped.
+
+    With a ``checkpoint`` callable it's called with the sinks every
+    ``checkpoint_interval`` rows handed to them.
+    """
+
+    def __init__(self, person_id, sinks, cache=None, checkpoint=None,
+                 checkpoint_interval=0):
+        self.person_id = person_id
+        self.sinks = sinks
+        # Optional ParseCacheWriter that gets every extracted row
+        self.cache = cache
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.row_count = 0
+        self.next_checkpoint = checkpoint_interval \
+            if checkpoint and checkpoint_interval > 0 else float('inf')
+        self.type_counts = collections.Counter()
+        self.routes = {}
+        self.invalid_count = 0
+
+    def extract(self, record):
+        record_type = record.get('type', '')
+        self.type_counts[record_type] += 1
+
+        route = self.routes.get(record_type)
+        if route is None:
+            route = classify_record_type(record_type)
+            self.routes[record_type] = route
+
+        kind, hk_type = route
+        extractor = EXTRACTORS.get(kind)
+        if extractor is None:
+            return kind, None
+
+        try:
+            return kind, extractor(self.person_id, hk_type, record)
+        except ValueError as ve:
+            LOGGER.error("Skipping record with an invalid value %s: %s"
+                         % (record.attrib, ve))
+            self.invalid_count += 1
+            return kind, None
+
+    def extract_children(self, row, record):
+        """Return the (kind, rows) of the children of a Record that have
+        an extractor, given the row extracted from the Record."""
+        children = []
+
+        for child in record:
+            handler = CHILD_EXTRACTORS.get(child.tag)
+            if handler is None:
+                continue
+
+            kind, extractor = handler
+            try:
+                children.append((kind, extractor(row, child)))
+            except ValueError as ve:
+                LOGGER.error("Skipping %s with an invalid value %s: %s"
+                             % (child.tag, record.attrib, ve))
+                self.invalid_count += 1
+
+        return children
+
+    def route(self, record):
+        kind, row = self.extract(record)
+        if row is None:
+            return
+
+        self.add(kind, row)
+
+        # len() is free, most Records have no children to look at
+        if len(record):
+            for child_kind, child_rows in self.extract_children(row, record):
+                for child_row in child_rows:
+                    self.add(child_kind, child_row)
+
+    def add(self, kind, row):
+        if self.cache is not None:
+            self.cache.add(kind, row)
+
+        sink = self.sinks.get(kind)
+        if sink is not None:
+            sink.add(row)
+            self.count_row()
+
+    def count_row(self):
+        self.row_count += 1
+
+        if self.row_count >= self.next_checkpoint:
+            self.checkpoint(list(self.sinks.values()))
+            self.next_checkpoint += self.checkpoint_interval
+
+    def route_rows(self, rows, type_counts, invalid_count=0):
+        """Route rows that were already extracted, e.g. by another process.
+
+        ``rows`` maps each kind to its rows in export order and
+        ``type_counts`` holds the Record types they were extracted from.
+        """
+        self.invalid_count += invalid_count
+
+        for record_type, count in type_counts.items():
+            self.type_counts[record_type] += count
+            if record_type not in self.routes:
+                self.routes[record_type] = classify_record_type(record_type)
+
+        for kind, kind_rows in rows.items():
+            sink = self.sinks.get(kind)
+
+            if self.cache is not None:
+                for row in kind_rows:
+                    self.cache.add(kind, row)
+                    if sink is not None:
+                        sink.add(row)
+                        self.count_row()
+            elif sink is not None:
+                for row in kind_rows:
+                    sink.add(row)
+                    self.count_row()
+
+    def close(self):
+        """Flush every sink and return the tables that loaded cleanly."""
+        loaded = [sink.table for sink in self.sinks.values() if sink.close()]
+
+        kind_counts = collections.Counter()
+        for record_type, count in self.type_counts.items():
+            kind = self.routes[record_type][0]
+            kind_counts[kind] += count
+            hkg_metrics.count('records_parsed', count, kind=kind)
+            LOGGER.debug("%s %s records of type %s."
+                         % (count, kind, record_type))
+
+            if kind not in self.sinks:
+                LOGGER.info("Skipped %s records of unsupported type %s."
+                            % (count, record_type))
+
+        if self.invalid_count:
+            LOGGER.warning("Skipped %s records with invalid values."
+                           % self.invalid_count)
+            hkg_metrics.count('invalid_records', self.invalid_count)
+
+        LOGGER.info("Routed records by kind: %s" % dict(kind_counts))
+
+        if self.cache is not None:
+            # noinspection PyBroadException
+            try:
+                self.cache.close(dict(self.type_counts), self.invalid_count)
+            except Exception as ex:
+                LOGGER.warning("Couldn't write the parse cache: %s" % ex)
+
+        return loaded
@@ -0,0 +1,138 @@
+import datetime
+import math
+from xml.etree import ElementTree
+
+EARTH_RADIUS = 6371008.8
+
+# Columns of hk_workout_route_point after workout_id, in order
+POINT_FIELDS = ('ele', 'speed', 'course', 'hAcc', 'vAcc')
+
+
+def parse_gpx_time(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def iter_route_points(source):
+    """Yield the track points of a GPX route file or stream one at a time.
+
+    A point is a tuple of its time, latitude, longitude, elevation and
+    the speed, course and horizontal and vertical accuracy Apple writes
+    into the point's extensions. Missing values are None and points
+    without a time are skipped. Every point is cleared from the tree
+    once it's read, so a long route never sits in memory as a whole.
+    """
+    events = ElementTree.iterparse(source, ('start', 'end'))
+    # Tags carry the namespace of the root element, so they are compared
+    # as whole strings instead of stripping the namespace of every tag.
+    event, root = next(events)
+    namespace = root.tag[:root.tag.rfind('}') + 1]
+    segment_tag = namespace + 'trkseg'
+    point_tag = namespace + 'trkpt'
+    time_tag = namespace + 'time'
+    field_tags = {namespace + field: index
+                  for index, field in enumerate(POINT_FIELDS)}
+    segment = None
+
+    for event, element in events:
+        if event == 'start':
+            if element.tag == segment_tag:
+                segment = element
+            continue
+
+        if element.tag != point_tag:
+            continue
+
+        point_time = None
+        fields = [None] * len(POINT_FIELDS)
+        for child in element.iter():
+            tag = child.tag
+            if tag == time_tag:
+                point_time = child.text
+            elif tag in field_tags:
+                fields[field_tags[tag]] = float(child.text)
+
+        if point_time:
+            yield (parse_gpx_time(point_time), float(element.get('lat')),
+                   float(element.get('lon'))) + tuple(fields)
+
+        element.clear()
+        if segment is not None:
+            segment.clear()
+
+
+def segment_distance(point, start, end, scale):
+    """Meters between ``point`` and the segment from ``start`` to ``end``.
+
+    Uses an equirectangular projection, which is accurate to well below
+    a meter over the few kilometers between two points of a route.
+    """
+    x, y = (point[2] - start[2]) * scale, point[1] - start[1]
+    dx, dy = (end[2] - start[2]) * scale, end[1] - start[1]
+    length = dx * dx + dy * dy
+
+    if length > 0:
+        t = max(0.0, min(1.0, (x * dx + y * dy) / length))
+        x, y = x - t * dx, y - t * dy
+
+    return math.radians(math.hypot(x, y)) * EARTH_RADIUS
+
+
+def simplify(points, tolerance):
+    """Drop the points of a route that are closer than ``tolerance``
+    meters to the line through the points kept around them.
+
+    This is the Ramer-Douglas-Peucker algorithm; the first and last point
+    are always kept and the remaining points stay in time order.
+    """
+    if tolerance <= 0 or len(points) < 3:
+        return points
+
+    scale = math.cos(math.radians(points[0][1]))
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(points) - 1)]
+
+    while ranges:
+        first, last = ranges.pop()
+        farthest, distance = None, tolerance
+
+        for index in range(first + 1, last):
+            d = segment_distance(points[index], points[first], points[last],
+                                 scale)
+            if d > distance:
+                farthest, distance = index, d
+
+        if farthest is not None:
+            keep[farthest] = True
+            ranges.append((first, farthest))
+            ranges.append((farthest, last))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+#  Runs in a worker process when routes are loaded in parallel, so it only
+#  takes and returns picklable tuples. Errors are handed back as a message
+#  for the importer to log.
+def load_route(route_info):
+    """Return the workout id and the point rows of a workout's route files.
+
+    The files are read through ``export``, an unpacked export directory or
+    export.zip, by their path inside the export.
+    """
+    workout_id, export, file_paths, tolerance = route_info
+    # A workout can't be in two places at once, the last point wins
+    points = {}
+
+    for file_path in file_paths:
+        try:
+            with export.open(file_path) as route_file:
+                for point in iter_route_points(route_file):
+                    points[point[0]] = point
+        except (ElementTree.ParseError, OSError, ValueError, TypeError) \
+                as ex:
+            return workout_id, None, "%s: %s" % (export.location(file_path),
+                                                 ex)
+
+    points = simplify(sorted(points.values()), tolerance)
+
+    return workout_id, [(workout_id, ) + point for point in points], None
@@ -0,0 +1,105 @@
+import os
+import time
+import zipfile
+from healthkit_grafana import hkg_export
+
+# What an export drops into its directory, the folders change whenever a
+# file is added to them
+WATCHED_NAMES = (hkg_export.EXPORT_XML, hkg_export.EXPORT_ZIP,
+                 'workout-routes', 'clinical-records')
+
+
+def is_complete(path):
+    """Whether an export.xml or export.zip was written to the end."""
+    if path.endswith('.zip'):
+        return zipfile.is_zipfile(path)
+
+    with open(path, 'rb') as export_file:
+        export_file.seek(max(0, os.path.getsize(path) -
+                             hkg_export.SHARD_SCAN_SIZE))
+        return hkg_export.ROOT_END_TAG in export_file.read()
+
+
+class ExportWatcher(object):
+    """Polls an export location for a new export that finished landing.
+
+    The location is what HKG_EXPORT_FILE_PATH points to, a directory or
+    an export.zip. Every poll takes the size and mtime of the export
+    files and folders. An export is ready once two polls in a row saw the
+    same, nothing was modified for ``settle_seconds`` and export.xml ends
+    with its closing tag or export.zip has its central directory, so a
+    copy or an unzip in progress is never imported. Polling is used
+    instead of inotify since it works on every platform and on the bind
+    mounts of Docker for Mac and Windows, which don't pass events on.
+    """
+
+    def __init__(self, path, settle_seconds, retry_seconds):
+        self.path = path
+        self.settle_seconds = settle_seconds
+        self.retry_seconds = retry_seconds
+        self.last_seen = None
+        self.imported = None
+        self.failed = None
+        self.retry_at = None
+
+    def paths(self):
+        if not os.path.isdir(self.path):
+            return [self.path]
+
+        return [os.path.join(self.path, name) for name in WATCHED_NAMES]
+
+    def signature(self):
+        """Return the (path, size, mtime) of every export file there is."""
+        signature = []
+        for path in self.paths():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+
+        return tuple(signature)
+
+    def poll(self):
+        """Return whether an export is ready that wasn't imported yet."""
+        signature = self.signature()
+        settled = signature == self.last_seen
+        self.last_seen = signature
+        # The folders only tell whether the export is still landing, the
+        # import itself moves duplicate clinical records around
+        exports = self.exports()
+
+        if not settled or not exports or exports == self.imported:
+            return False
+
+        if exports == self.failed and time.monotonic() < self.retry_at:
+            return False
+
+        newest = max(mtime for _, _, mtime in signature) / 1e9
+        if time.time() - newest < self.settle_seconds:
+            return False
+
+        try:
+            return all(is_complete(path) for path, _, _ in exports)
+        except OSError:
+            return False
+
+    def exports(self):
+        """The export.xml or export.zip part of the last signature."""
+        return tuple(entry for entry in self.last_seen or ()
+                     if os.path.basename(entry[0]) in
+                     (hkg_export.EXPORT_XML, hkg_export.EXPORT_ZIP)
+                     or entry[0] == self.path)
+
+    def done(self, success):
+        """Remember the export the last import was run on.
+
+        It isn't imported again until it changes, unless the import
+        failed, then it is tried again after ``retry_seconds``.
+        """
+        if success:
+            self.imported = self.exports()
+            self.failed = None
+        else:
+            self.failed = self.exports()
+            self.retry_at = time.monotonic() + self.retry_seconds
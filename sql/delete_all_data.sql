@@ -1,13 +1,23 @@
+DELETE FROM hk_workout_route_point;
 DELETE FROM hk_workout_route;
 DELETE FROM hk_workout_event;
 DELETE FROM hk_workout_metadata;
 DELETE FROM hk_workout;
 
-DELETE FROM hk_quantity_record;
-DELETE FROM hk_category_record;
+DELETE FROM hk_record_metadata;
+DELETE FROM hk_heart_beat;
+DELETE FROM hk_quantity_hour;
+DELETE FROM hk_quantity_sample;
+DELETE FROM hk_category_sample;
+DELETE FROM hk_source;
+DELETE FROM hk_device;
 
 DELETE FROM hk_clinical_observation;
 DELETE FROM hk_clinical_record;
 
 DELETE FROM hk_activity_summary;
 DELETE FROM hk_person;
+
+DELETE FROM hkg_import_checkpoint;
+DELETE FROM hkg_import_watermark;
+DELETE FROM hkg_import_manifest;